@@ -36,13 +36,16 @@ ALLOWED_HOSTS = ['localhost', '127.0.0.1']
 # Application definition
 
 INSTALLED_APPS = [
+    'daphne',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
+    'rest_framework_simplejwt.token_blacklist',
     'corsheaders',
     'channels',
     'chat',
@@ -50,6 +53,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.middleware.instrumentation_middleware',
+    'chat.middleware.compression_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -85,17 +90,69 @@ ASGI_APPLICATION = 'backend.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# DB_POOL_MODE:
+#   off       - a connection per thread, kept for DB_CONN_MAX_AGE seconds (0 closes it after each request)
+#   internal  - a pool of DB_POOL_SIZE connections per process, see chat/db/pool.py
+#   pgbouncer - persistent connections to a PgBouncer in transaction pooling mode
+DB_POOL_MODE = os.getenv('DB_POOL_MODE', 'off')
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        # django.db.backends.postgresql plus the pool and connection wait metrics
+        'ENGINE': 'chat.db',
         'NAME': os.getenv('DB_NAME', 'chat_db'),
         'USER': os.getenv('DB_USER', 'postgres'),
         'PASSWORD': os.getenv('DB_PASSWORD', 'passwoed'),
         'HOST': os.getenv('DB_HOST', 'localhost'),
         'PORT': os.getenv('DB_PORT', '5433'),
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '0')),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+if DB_POOL_MODE == 'internal':
+    DATABASES['default'].update({
+        # Connections go back to the pool at the end of every request
+        'CONN_MAX_AGE': 0,
+        'POOL': {
+            'max_size': int(os.getenv('DB_POOL_SIZE', '10')),
+            'timeout': float(os.getenv('DB_POOL_TIMEOUT', '10')),
+            'check_interval': float(os.getenv('DB_POOL_CHECK_INTERVAL', '30')),
+            'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', '300')),
+            'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME', '3600')),
+        },
+    })
+elif DB_POOL_MODE == 'pgbouncer':
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '600')),
+        # Named cursors do not survive transaction pooling outside a transaction
+        'DISABLE_SERVER_SIDE_CURSORS': True,
+    })
+
+# Requests waiting longer than this for database connections are logged
+DB_CONNECT_WAIT_WARNING_MS = float(os.getenv('DB_CONNECT_WAIT_WARNING_MS', '100'))
+
+# Request metrics, see chat/metrics.py. /metrics only answers these addresses
+METRICS_ALLOWED_IPS = os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
+# Most queries an endpoint ("<View>.<action>", or the view name) may run per request.
+# 'log' reports requests over budget, 'raise' fails them (tests)
+QUERY_BUDGET_MODE = os.getenv('QUERY_BUDGET_MODE', 'log')
+QUERY_BUDGETS = {
+    'ChatViewSet.list': 4,
+    'ChatViewSet.retrieve': 5,
+    'ChatViewSet.group_chats': 6,
+    'ChatViewSet.join_chat': 12,
+    'ChatViewSet.leave_chat': 10,
+    'ChatViewSet.find_anonymous_chat': 12,
+    'ChatViewSet.sync': 8,
+    'MessageViewSet.list': 5,
+    'MessageViewSet.create': 5,
+    'MessageViewSet.search': 2,
+    'UserViewSet.me': 1,
+    'InterestViewSet.list': 1,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -178,12 +235,16 @@ CORS_ALLOW_HEADERS = [
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'chat.authentication.ClaimsJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'chat.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
 }
 
 # JWT settings
@@ -200,17 +261,126 @@ SIMPLE_JWT = {
     'USER_ID_CLAIM': 'user_id',
     'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',),
     'TOKEN_TYPE_CLAIM': 'token_type',
+    # Tokens carry role/age/gender so requests need no users table lookup
+    'TOKEN_OBTAIN_SERIALIZER': 'chat.authentication.ChatTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'chat.authentication.ChatTokenRefreshSerializer',
+}
+
+# Refresh token blacklist (see chat/blacklist.py). The default keeps the
+# simplejwt tables with a Bloom filter in front, chat.blacklist.RedisTokenBlacklist
+# keeps it in Redis only. Expired rows are removed by `manage.py compact_tokens`.
+TOKEN_BLACKLIST = {
+    'BACKEND': os.getenv('TOKEN_BLACKLIST_BACKEND', 'chat.blacklist.BloomTokenBlacklist'),
+    'OPTIONS': {
+        'url': os.getenv('TOKEN_BLACKLIST_REDIS_URL', 'redis://127.0.0.1:6379/4'),
+        'capacity': int(os.getenv('TOKEN_BLACKLIST_CAPACITY', '100000')),
+        'refresh_interval': 5,
+    },
+}
+
+# Per-process cache of users whose token claims were invalidated (see chat/authentication.py)
+USER_CACHE = {
+    'TTL': int(os.getenv('USER_CACHE_TTL', '60')),
+    'MAX_ENTRIES': int(os.getenv('USER_CACHE_MAX_ENTRIES', '10000')),
 }
 
 # Channels settings
+# Chat groups are spread over the Redis nodes with a consistent hash ring,
+# e.g. CHANNEL_REDIS_HOSTS=redis://10.0.0.1:6379,redis://10.0.0.2:6379
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'chat.layers.ShardedRedisChannelLayer',
         'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],
+            "hosts": os.getenv('CHANNEL_REDIS_HOSTS', 'redis://127.0.0.1:6379').split(','),
+            # Groups with more members than this are delivered in several Lua calls per node
+            "fanout_batch_size": int(os.getenv('CHANNEL_FANOUT_BATCH_SIZE', 500)),
         },
     },
 }
 
 # Custom user model
 AUTH_USER_MODEL = 'chat.User'
+
+# Messages embedded in a chat detail response (GET /api/chats/<id>/?chat_id=<id>)
+CHAT_DETAIL_MESSAGES = int(os.getenv('CHAT_DETAIL_MESSAGES', '50'))
+
+# Chat and message lists serialized from values() rows (chat/fast_serializers.py)
+FAST_SERIALIZATION = os.getenv('FAST_SERIALIZATION', 'True') == 'True'
+
+# Responses of at least MIN_BYTES are compressed with brotli (if the brotli
+# package is installed) or gzip, whichever the client accepts
+RESPONSE_COMPRESSION = {
+    'MIN_BYTES': int(os.getenv('RESPONSE_COMPRESSION_MIN_BYTES', '1024')),
+    'GZIP_LEVEL': int(os.getenv('RESPONSE_COMPRESSION_GZIP_LEVEL', '6')),
+    'BROTLI_QUALITY': int(os.getenv('RESPONSE_COMPRESSION_BROTLI_QUALITY', '5')),
+}
+
+# Upper bound for POST /api/messages/bulk/
+MESSAGE_BULK_MAX_ITEMS = int(os.getenv('MESSAGE_BULK_MAX_ITEMS', '500'))
+
+# Queued write path for POST /api/messages/ (see chat/writer.py). Messages are
+# journaled, acknowledged with a provisional id and inserted in batches.
+MESSAGE_WRITER = {
+    'ENABLED': os.getenv('MESSAGE_WRITER_ENABLED', 'False') == 'True',
+    'BATCH_SIZE': int(os.getenv('MESSAGE_WRITER_BATCH_SIZE', '200')),
+    'FLUSH_INTERVAL': float(os.getenv('MESSAGE_WRITER_FLUSH_INTERVAL', '0.05')),
+    'JOURNAL_DIR': os.getenv('MESSAGE_WRITER_JOURNAL_DIR', str(BASE_DIR / 'var' / 'message_journal')),
+    'FSYNC': os.getenv('MESSAGE_WRITER_FSYNC', 'True') == 'True',
+}
+
+# Anonymous users without activity for this long are removed by `manage.py gc_anonymous`
+ANONYMOUS_STALE_AFTER = timedelta(seconds=int(os.getenv('ANONYMOUS_STALE_AFTER', str(24 * 3600))))
+
+# Monthly message partitions, see chat/partitions.py
+# `manage.py rollover_partitions` keeps this many future months created in advance
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv('MESSAGE_PARTITIONS_AHEAD', '3'))
+# `manage.py archive_messages` moves months older than this out of the database
+MESSAGE_HOT_MONTHS = int(os.getenv('MESSAGE_HOT_MONTHS', '12'))
+MESSAGE_ARCHIVE_DIR = os.getenv('MESSAGE_ARCHIVE_DIR', str(BASE_DIR / 'var' / 'message_archive'))
+
+# Incremental sync (GET /api/chats/sync/?since=<version>, see chat/sync.py)
+SYNC = {
+    # Change log entries read per call, clients call again while has_more is set
+    'MAX_CHANGES': int(os.getenv('SYNC_MAX_CHANGES', '1000')),
+    # Older versions get 410 Gone, `manage.py prune_changelog` keeps the log a day longer
+    'TOKEN_MAX_AGE': timedelta(days=int(os.getenv('SYNC_TOKEN_MAX_AGE_DAYS', '7'))),
+}
+
+# How long clients may reuse a page of group chat search results
+GROUP_CHATS_CACHE_SECONDS = int(os.getenv('GROUP_CHATS_CACHE_SECONDS', '30'))
+
+# Anonymous chat matchmaking queue. The in-process backend serves a single
+# server process, use chat.matchmaking.RedisMatchmakingBackend for several.
+MATCHMAKING = {
+    'BACKEND': os.getenv('MATCHMAKING_BACKEND', 'chat.matchmaking.InMemoryMatchmakingBackend'),
+    'OPTIONS': {
+        'url': os.getenv('MATCHMAKING_REDIS_URL', 'redis://127.0.0.1:6379/1'),
+    },
+}
+
+# Shared cache, the first tier is a per-process LRU (see chat/cache.py)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('CACHE_REDIS_URL', 'redis://127.0.0.1:6379/2'),
+    },
+}
+
+CHAT_CACHE = {
+    'ALIAS': 'default',
+    'TIMEOUT': int(os.getenv('CHAT_CACHE_TIMEOUT', '300')),
+    'LOCAL_TIMEOUT': int(os.getenv('CHAT_CACHE_LOCAL_TIMEOUT', '5')),
+    'LOCAL_MAX_ENTRIES': int(os.getenv('CHAT_CACHE_LOCAL_MAX_ENTRIES', '1024')),
+}
+
+# Online / typing / read signals of the chat socket (see chat/presence.py).
+# Use chat.presence.RedisPresenceStore when running several processes.
+PRESENCE = {
+    'BACKEND': os.getenv('PRESENCE_BACKEND', 'chat.presence.InMemoryPresenceStore'),
+    'OPTIONS': {
+        'url': os.getenv('PRESENCE_REDIS_URL', 'redis://127.0.0.1:6379/3'),
+    },
+    'TTL': 30,
+    'TYPING_INTERVAL': 2,
+    'READ_FLUSH_INTERVAL': 5,
+}
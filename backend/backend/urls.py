@@ -18,12 +18,13 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from chat.views import ChatViewSet, MessageViewSet, InterestViewSet, UserViewSet
+from chat import async_views
 from django.contrib.auth import views as auth_views
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
 )
-from .views import GetCsrfToken
+from .views import GetCsrfToken, metrics
 
 router = DefaultRouter()
 router.register(r'chats', ChatViewSet)
@@ -44,4 +45,9 @@ urlpatterns = [
     path('api/users/anonymous/', UserViewSet.as_view({"post": "create_anonymous"}), name='user_anonymous'),
     path('api/chats/anonymous/', ChatViewSet.as_view({"post": "find_anonymous_chat"}), name='chat_anonymous'),
     path('api/csrf/', GetCsrfToken.as_view(), name='csrf_token'),
+    path('metrics/', metrics, name='metrics'),
+    # Async implementations of the hottest endpoints, see chat/async_views.py
+    path('api/async/users/me/', async_views.me, name='async_user_me'),
+    path('api/async/chats/<int:pk>/', async_views.chat_detail, name='async_chat_detail'),
+    path('api/async/messages/', async_views.messages, name='async_message_list'),
 ]
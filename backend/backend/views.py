@@ -1,9 +1,17 @@
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.utils.decorators import method_decorator
 from django.views import View
+from chat.metrics import render_metrics
 
 @method_decorator(ensure_csrf_cookie, name='dispatch')
 class GetCsrfToken(View):
     def get(self, request):
-        return JsonResponse({'csrfToken': request.META.get('CSRF_COOKIE', '')}) 
\ No newline at end of file
+        return JsonResponse({'csrfToken': request.META.get('CSRF_COOKIE', '')}) 
+
+def metrics(request):
+    """Request histograms of this process in the Prometheus text format"""
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,5 +1,8 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.contrib.postgres.search import SearchQuery
+from django.http import StreamingHttpResponse
+from .export import export_chat, streaming_chunks
 from .models import User, Chat, Message, Interest, ChatUser, ChatInterest
 
 @admin.register(User)
@@ -21,14 +24,37 @@ class ChatAdmin(admin.ModelAdmin):
     list_display = ('name', 'type', 'created_at')
     list_filter = ('type', 'created_at')
     search_fields = ('name',)
+    actions = ['export_messages']
+
+    @admin.action(description='Export messages (.jsonl.gz)')
+    def export_messages(self, request, queryset):
+        # Streamed chat by chat, concatenated gzip streams are one valid file
+        chat_ids = list(queryset.values_list('pk', flat=True))
+        chunks = (chunk for chat_id in chat_ids for chunk in export_chat(chat_id, compress=True))
+        response = StreamingHttpResponse(
+            streaming_chunks(request, chunks),
+            content_type='application/gzip'
+        )
+        response['Content-Disposition'] = 'attachment; filename="messages.jsonl.gz"'
+        return response
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('sender', 'chat', 'content', 'created_at')
     list_filter = ('created_at', 'chat')
-    search_fields = ('content', 'sender__username')
+    search_fields = ('sender__username',)
     date_hierarchy = 'created_at'
 
+    def get_search_results(self, request, queryset, search_term):
+        # Content is matched through the full-text index instead of icontains
+        filtered = queryset
+        queryset, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            queryset |= filtered.filter(
+                search_vector=SearchQuery(search_term, config='simple', search_type='websearch')
+            )
+        return queryset, may_have_duplicates
+
 @admin.register(Interest)
 class InterestAdmin(admin.ModelAdmin):
     list_display = ('interest',)
@@ -0,0 +1,182 @@
+"""
+Async versions of the hottest read/write endpoints.
+
+DRF 3.14 views are synchronous, under ASGI every request to them holds a
+worker thread for its whole duration, database round trips included. The
+views below are plain Django async views over the async ORM, so a request
+waiting on Postgres or Redis only costs a suspended coroutine.
+
+They are mounted under ``/api/async/`` next to the DRF viewsets and return
+the same payloads:
+
+    GET  /api/async/users/me/
+    GET  /api/async/chats/<id>/
+    GET  /api/async/messages/?chat=<id>&before=&after=&page_size=&layout=
+    POST /api/async/messages/
+
+Authentication is JWT only (``Authorization: Bearer <access>``). The GET
+endpoints answer in MessagePack when the client asks for it.
+"""
+import json
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import NotFound
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from .authentication import get_user_for_token
+from .cache import chat_cache, chat_detail_key, etag_matches, make_etag
+from .consumers import abroadcast_message
+from .fast_serializers import get_plan
+from .models import Chat, ChatUser, Message, User
+from .pagination import MessageCursorPagination
+from .renderers import MSGPACK_MEDIA_TYPE, MessagePackRenderer
+from .serializers import ChatSerializer, MessageBulkItemSerializer, MessageSerializer, UserSerializer
+from .writer import get_message_writer, writer_settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def authenticate(request):
+    """The active user of the request's access token, or None"""
+    parts = request.headers.get('Authorization', '').split()
+    if len(parts) != 2 or parts[0] not in jwt_settings.AUTH_HEADER_TYPES:
+        return None
+    try:
+        return await sync_to_async(get_user_for_token)(AccessToken(parts[1]))
+    except (TokenError, AuthenticationFailed):
+        return None
+
+
+def async_api_view(methods):
+    """Method check and JWT authentication for an async view"""
+    def decorator(view):
+        @csrf_exempt
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse(
+                    {'detail': f'Method "{request.method}" not allowed.'}, status=405,
+                    headers={'Allow': ', '.join(methods)}
+                )
+            request.user = await authenticate(request)
+            if request.user is None:
+                return JsonResponse(
+                    {'detail': 'Authentication credentials were not provided.'}, status=401,
+                    headers={'WWW-Authenticate': f'{jwt_settings.AUTH_HEADER_TYPES[0]} realm="api"'}
+                )
+            return await view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# The shared cache tier is a blocking Redis client, keep it off the event loop
+cache_get = sync_to_async(chat_cache.get, thread_sensitive=False)
+cache_set = sync_to_async(chat_cache.set, thread_sensitive=False)
+
+
+def wants_msgpack(request):
+    return request.GET.get('format') == 'msgpack' or MSGPACK_MEDIA_TYPE in request.headers.get('Accept', '')
+
+
+def data_response(request, data, headers=None):
+    """JSON or MessagePack, as DRF's content negotiation would pick"""
+    if wants_msgpack(request):
+        response = HttpResponse(MessagePackRenderer().render(data), content_type=MSGPACK_MEDIA_TYPE, headers=headers)
+    else:
+        response = JsonResponse(data, headers=headers)
+    patch_vary_headers(response, ('Accept',))
+    return response
+
+
+@async_api_view(['GET'])
+async def me(request):
+    # request.user only has the token claims loaded, the profile needs the row
+    user = await User.objects.aget(pk=request.user.pk)
+    return JsonResponse(UserSerializer(user).data)
+
+
+@async_api_view(['GET'])
+async def chat_detail(request, pk):
+    """Same payload and cache entry as GET /api/chats/<id>/"""
+    key = chat_detail_key(pk)
+    entry = await cache_get(key)
+    if entry is None:
+        queryset = ChatSerializer.setup_eager_loading(Chat.objects.all())
+        try:
+            chat = await queryset.aget(pk=pk)
+        except Chat.DoesNotExist:
+            return JsonResponse({'detail': 'No Chat matches the given query.'}, status=404)
+        data = ChatSerializer(chat).data
+        entry = {'data': data, 'etag': make_etag(data)}
+        await cache_set(key, entry)
+
+    headers = {'ETag': entry['etag']}
+    if etag_matches(request, entry['etag']):
+        return HttpResponse(status=304, headers=headers)
+    return data_response(request, entry['data'], headers=headers)
+
+
+@async_api_view(['GET', 'POST'])
+async def messages(request):
+    if request.method == 'POST':
+        return await create_message(request)
+
+    # Unlike the DRF list, only chats the user belongs to are visible
+    queryset = Message.objects.filter(
+        chat_id__in=ChatUser.objects.filter(user=request.user).values('chat_id')
+    )
+    paginator = MessageCursorPagination()
+    chat_id = request.GET.get('chat')
+    if chat_id:
+        try:
+            chat_id = int(chat_id)
+        except ValueError:
+            return JsonResponse({'chat': ['A valid integer is required.']}, status=400)
+        queryset = queryset.filter(chat_id=chat_id)
+        paginator.archive_chat_id = chat_id
+        paginator.archive_user = request.user
+
+    plan = get_plan(MessageSerializer) if settings.FAST_SERIALIZATION else None
+    queryset = MessageSerializer.setup_eager_loading(queryset)
+    try:
+        page = await paginator.apaginate_queryset(plan.values(queryset) if plan else queryset, request)
+    except NotFound as e:
+        return JsonResponse({'detail': str(e.detail)}, status=404)
+    if plan:
+        data = plan.represent(page, fallback=lambda message: MessageSerializer(message).data)
+    else:
+        data = MessageSerializer(page, many=True).data
+    return data_response(request, paginator.get_paginated_data(data))
+
+
+async def create_message(request):
+    try:
+        payload = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'detail': 'JSON parse error'}, status=400)
+    serializer = MessageBulkItemSerializer(data=payload)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    chat_id = serializer.validated_data['chat']
+    content = serializer.validated_data['content']
+
+    # request.user only has the token claims loaded, the serialized sender needs the whole row
+    membership = await ChatUser.objects.select_related('user').filter(user=request.user, chat_id=chat_id).afirst()
+    if membership is None:
+        return JsonResponse({'chat': 'Chat not found or you are not a participant'}, status=400)
+
+    if writer_settings()['ENABLED']:
+        # Starting the writer queries the database and journal writes hit the disk
+        entry = await sync_to_async(lambda: get_message_writer().submit(chat_id, request.user.id, content))()
+        return JsonResponse({**entry.to_dict(), 'status': 'queued'}, status=202)
+
+    message = await Message.objects.acreate(chat_id=chat_id, sender=membership.user, content=content)
+    data = MessageSerializer(message).data
+    await abroadcast_message(chat_id, data)
+    return JsonResponse(data, status=201)
@@ -0,0 +1,145 @@
+"""
+JWT authentication without a users table lookup per request.
+
+Tokens issued by ``ChatRefreshToken`` carry the user fields the API reads on
+every request (``CLAIM_FIELDS``). ``ClaimsJWTAuthentication`` builds
+``request.user`` from them: a real ``User`` instance, so it can be used in
+queries and foreign keys, with every other field deferred and loaded on
+first access.
+
+Claims are a snapshot taken when the refresh token was issued. When a user
+is updated, deleted or has a token blacklisted, ``invalidate_user`` records
+the time in the shared cache. Tokens issued before that time are resolved
+against the database instead, through a small per-process cache. Each
+process reads the revocation time once per ``USER_CACHE['TTL']`` seconds per
+user, which bounds how long a stale claim can be served elsewhere.
+"""
+import time
+from django.conf import settings
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from .blacklist import get_token_blacklist
+from .cache import LocalLRUCache, chat_cache
+from .models import User
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Fields copied into tokens, enough for permission checks and logging
+CLAIM_FIELDS = ('username', 'role', 'age', 'gender')
+USER_FIELDS = ('id', 'is_active') + CLAIM_FIELDS
+
+
+class ChatRefreshToken(RefreshToken):
+    """Refresh token carrying the user claims, access tokens inherit them.
+
+    Blacklist checks go through the store of ``settings.TOKEN_BLACKLIST``
+    instead of a database join.
+    """
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        for field in CLAIM_FIELDS:
+            token[field] = getattr(user, field)
+        return token
+
+    def check_blacklist(self):
+        if get_token_blacklist().contains(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError('Token is blacklisted')
+
+    def blacklist(self):
+        get_token_blacklist().add(self)
+        user_id = self.payload.get(api_settings.USER_ID_CLAIM)
+        if user_id is not None:
+            invalidate_user(user_id)
+
+
+class ChatTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = ChatRefreshToken
+
+
+class ChatTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = ChatRefreshToken
+
+
+def build_user_cache():
+    config = getattr(settings, 'USER_CACHE', {})
+    return LocalLRUCache(
+        max_entries=config.get('MAX_ENTRIES', 10000),
+        timeout=config.get('TTL', 60),
+    )
+
+
+user_cache = build_user_cache()
+
+
+def revoked_key(user_id):
+    return f"auth:revoked:{user_id}"
+
+
+def invalidate_user(user_id):
+    """Stop trusting claims of tokens issued up to now, in every process"""
+    user_cache.delete_many([user_id])
+    # Access tokens inherit the refresh token's iat, so the marker must outlive both
+    timeout = int(api_settings.REFRESH_TOKEN_LIFETIME.total_seconds())
+    try:
+        chat_cache.shared.set(revoked_key(user_id), time.time(), timeout)
+    except Exception as e:
+        logger.warning(f"Shared cache unavailable on user invalidation: {str(e)}")
+
+
+def user_state(user_id):
+    """Revocation time and database row of a user, cached per process"""
+    state = user_cache.get(user_id)
+    if state is None:
+        try:
+            revoked_at = chat_cache.shared.get(revoked_key(user_id))
+        except Exception as e:
+            logger.warning(f"Shared cache unavailable on user lookup: {str(e)}")
+            revoked_at = None
+        state = {'revoked_at': revoked_at or 0, 'values': None}
+        user_cache.set(user_id, state)
+    return state
+
+
+def user_from_values(values):
+    """A User with only ``values`` loaded, the other fields load on access"""
+    # from_db expects the values in the model's field order
+    field_names = [f.attname for f in User._meta.concrete_fields if f.attname in values]
+    return User.from_db('default', field_names, [values[name] for name in field_names])
+
+
+def get_user_for_token(validated_token):
+    """Resolve a validated access token to a user without a query where possible"""
+    try:
+        user_id = int(validated_token[api_settings.USER_ID_CLAIM])
+    except (KeyError, TypeError, ValueError):
+        raise AuthenticationFailed('Token contained no recognizable user identification', code='token_not_valid')
+
+    state = user_state(user_id)
+    issued_at = validated_token.get('iat', 0)
+    if issued_at > state['revoked_at'] and all(field in validated_token for field in CLAIM_FIELDS):
+        values = {'id': user_id, 'is_active': True}
+        values.update({field: validated_token[field] for field in CLAIM_FIELDS})
+        return user_from_values(values)
+
+    if state['values'] is None:
+        row = User.objects.filter(pk=user_id).values(*USER_FIELDS).first()
+        # Deleted users are remembered as well, their tokens fail without a query
+        state['values'] = row or {}
+    if not state['values']:
+        raise AuthenticationFailed('User not found', code='user_not_found')
+    if not state['values']['is_active']:
+        raise AuthenticationFailed('User is inactive', code='user_inactive')
+    return user_from_values(state['values'])
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication building request.user from the token claims"""
+
+    def get_user(self, validated_token):
+        return get_user_for_token(validated_token)
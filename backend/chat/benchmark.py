@@ -0,0 +1,382 @@
+"""
+Load-test harness for the chat API.
+
+``generate_dataset`` fills the database with a tagged, reproducible data set
+(same seed, same data): users, group chats with interests and members,
+anonymous chats waiting in the matchmaking queue and any number of messages
+spread over the last months, all through bulk inserts. ``drop_dataset``
+removes it again.
+
+``run_scenario`` replays one of ``SCENARIOS`` against the data set with a
+given concurrency. Requests go through Django's ASGI application in-process,
+so the database, Redis and every middleware are exercised as under daphne,
+minus the socket. Results carry throughput and latency percentiles and are
+meant to be saved per commit and compared (see ``manage.py bench_api``).
+"""
+import asyncio
+import json
+import random
+import time
+import uuid
+from datetime import timedelta
+from urllib.parse import urlsplit
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.utils import timezone
+from .authentication import ChatRefreshToken
+from .cleanup import delete_users, forget, table
+from .matchmaking import MatchTicket, get_matchmaker
+from .models import Chat, ChatInterest, ChatType, ChatUser, Interest, Message, User, UserRole
+from .partitions import add_months, create_partition, list_partitions, month_start, partition_name
+import logging
+
+logger = logging.getLogger(__name__)
+
+GENDERS = ('male', 'female')
+WORDS = (
+    'hello', 'anyone', 'here', 'music', 'movies', 'games', 'tonight', 'weekend', 'coffee', 'travel',
+    'really', 'think', 'about', 'maybe', 'later', 'thanks', 'great', 'idea', 'sure', 'why',
+)
+
+
+def user_prefix(tag):
+    return f"bench_{tag}_"
+
+
+def chat_prefix(tag):
+    return f"bench {tag} "
+
+
+def generate_dataset(tag, users=1000, group_chats=100, anonymous_chats=100, messages=100000,
+                     members_per_chat=10, interests=20, months=3, seed=0, batch_size=10000, progress=None):
+    """Create a benchmark data set, returns the number of rows per kind.
+
+    ``progress(kind, count)`` is called after every batch of messages.
+    """
+    rng = random.Random(seed)
+    password = make_password(None)
+    now = timezone.now()
+
+    Interest.objects.bulk_create(
+        [Interest(interest=f"bench {n}") for n in range(interests)], ignore_conflicts=True
+    )
+    interest_ids = list(
+        Interest.objects.filter(interest__in=[f"bench {n}" for n in range(interests)]).values_list('id', flat=True)
+    )
+
+    members = User.objects.bulk_create([
+        User(username=f"{user_prefix(tag)}u{n}", password=password, role=UserRole.USER,
+             age=rng.randint(18, 60), gender=rng.choice(GENDERS))
+        for n in range(users)
+    ], batch_size=batch_size)
+
+    members_per_chat = min(members_per_chat, users)
+    chats = []
+    chat_members = []
+    chat_interests = []
+    for n in range(group_chats):
+        chosen = rng.sample(interest_ids, k=min(rng.randint(1, 3), len(interest_ids)))
+        chats.append(Chat(
+            name=f"{chat_prefix(tag)}{n}", type=ChatType.GROUP,
+            # Normally maintained by signals and add_participant, which bulk inserts skip
+            interest_ids=chosen, participant_count=members_per_chat,
+        ))
+        chat_members.append(rng.sample(members, k=members_per_chat))
+        chat_interests.append(chosen)
+    chats = Chat.objects.bulk_create(chats, batch_size=batch_size)
+    ChatUser.objects.bulk_create([
+        ChatUser(chat=chat, user=user) for chat, users_in_chat in zip(chats, chat_members) for user in users_in_chat
+    ], batch_size=batch_size)
+    ChatInterest.objects.bulk_create([
+        ChatInterest(chat=chat, interest_id=interest_id)
+        for chat, chosen in zip(chats, chat_interests) for interest_id in chosen
+    ], batch_size=batch_size)
+
+    waiting = create_waiting_chats(tag, anonymous_chats, rng, password, batch_size)
+
+    # Old messages get partitions of their own instead of piling up in the default one
+    existing = set(list_partitions())
+    first_month = month_start(now - timedelta(days=30 * months))
+    month = first_month
+    while month <= month_start(now):
+        if partition_name(month) not in existing:
+            create_partition(month)
+        month = add_months(month, 1)
+
+    written = 0
+    span = (now - first_month).total_seconds()
+    while written < messages and chats:
+        batch = []
+        for _ in range(min(batch_size, messages - written)):
+            index = rng.randrange(len(chats))
+            batch.append(Message(
+                chat=chats[index], sender=rng.choice(chat_members[index]),
+                content=' '.join(rng.choices(WORDS, k=rng.randint(2, 12))),
+                created_at=first_month + timedelta(seconds=rng.random() * span),
+            ))
+        Message.objects.bulk_create(batch)
+        written += len(batch)
+        if progress:
+            progress('messages', written)
+
+    return {
+        'users': users + waiting,
+        'group_chats': group_chats,
+        'anonymous_chats': waiting,
+        'messages': written,
+    }
+
+
+def create_waiting_chats(tag, count, rng, password, batch_size):
+    """Anonymous chats with one participant, queued for matchmaking"""
+    users = User.objects.bulk_create([
+        User(username=f"{user_prefix(tag)}a{n}", password=password, role=UserRole.ANONYMOUS,
+             age=rng.randint(18, 60), gender=rng.choice(GENDERS))
+        for n in range(count)
+    ], batch_size=batch_size)
+    chats = Chat.objects.bulk_create([
+        Chat(type=ChatType.ANONYMOUS, participant_count=1,
+             preferences={'min_age': None, 'max_age': None, 'preferred_gender': rng.choice(GENDERS)})
+        for _ in users
+    ], batch_size=batch_size)
+    ChatUser.objects.bulk_create(
+        [ChatUser(chat=chat, user=user) for chat, user in zip(chats, users)], batch_size=batch_size
+    )
+    matchmaker = get_matchmaker()
+    for chat, user in zip(chats, users):
+        matchmaker.enqueue(MatchTicket.for_chat(chat, user))
+    return len(chats)
+
+
+def drop_dataset(tag, batch_size=1000):
+    """Delete everything a data set (and the scenarios run on it) created"""
+    counts = {'users': 0, 'chats': 0, 'messages': 0}
+    group_ids = list(Chat.objects.filter(name__startswith=chat_prefix(tag)).values_list('id', flat=True))
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table(Message)} WHERE chat_id = ANY(%s)", [group_ids])
+        counts['messages'] += cursor.rowcount
+        for model in (ChatUser, ChatInterest):
+            cursor.execute(f"DELETE FROM {table(model)} WHERE chat_id = ANY(%s)", [group_ids])
+        cursor.execute(f"DELETE FROM {table(Chat)} WHERE id = ANY(%s)", [group_ids])
+        counts['chats'] += cursor.rowcount
+    forget([], group_ids, [])
+
+    # Users go through the anonymous cleanup, which also removes their emptied anonymous chats
+    users = User.objects.filter(username__startswith=user_prefix(tag)).order_by('id').values_list('id', flat=True)
+    while True:
+        user_ids = list(users[:batch_size])
+        if not user_ids:
+            break
+        with transaction.atomic(), connection.cursor() as cursor:
+            batch, chat_ids, empty_chat_ids = delete_users(cursor, user_ids)
+        forget(user_ids, chat_ids, empty_chat_ids)
+        for key, value in batch.items():
+            counts[key] += value
+    return counts
+
+
+async def asgi_request(app, method, url, token=None, body=b''):
+    """Send one request through an ASGI application, returns the status code"""
+    parts = urlsplit(url)
+    headers = [
+        (b'host', b'localhost'),
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode()),
+    ]
+    if token:
+        headers.append((b'authorization', f"Bearer {token}".encode()))
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': parts.path,
+        'raw_path': parts.path.encode(),
+        'query_string': parts.query.encode(),
+        'root_path': '',
+        'headers': headers,
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 80),
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    disconnected = asyncio.Event()
+    status = 0
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body' and not message.get('more_body'):
+            disconnected.set()
+
+    await app(scope, receive, send)
+    return status
+
+
+def access_token(user):
+    return str(ChatRefreshToken.for_user(user).access_token)
+
+
+class Scenario:
+    """A kind of user operation, made of one or more requests"""
+    name = None
+    description = ''
+
+    def __init__(self, tag, operations, seed=0):
+        self.tag = tag
+        self.rng = random.Random(seed)
+        self.setup(operations)
+
+    def setup(self, operations):
+        """Load what the operations need from the data set, runs synchronously"""
+
+    def operation(self):
+        """Requests of one operation as (method, url, body, token), sent one after another"""
+        raise NotImplementedError
+
+    def members(self, limit=200):
+        """Tokens and chat ids of (user, group chat) memberships"""
+        rows = ChatUser.objects.filter(
+            chat__name__startswith=chat_prefix(self.tag)
+        ).select_related('user').order_by('id')[:limit]
+        return [(access_token(row.user), row.chat_id) for row in rows]
+
+
+class MatchmakingStorm(Scenario):
+    name = 'matchmaking'
+    description = 'new anonymous users asking for a partner at once'
+
+    def setup(self, operations):
+        password = make_password(None)
+        # The seed repeats from run to run, the usernames must not
+        nonce = uuid.uuid4().hex[:8]
+        users = User.objects.bulk_create([
+            User(username=f"{user_prefix(self.tag)}s{nonce}_{n}", password=password,
+                 role=UserRole.ANONYMOUS, age=self.rng.randint(18, 60), gender=self.rng.choice(GENDERS))
+            for n in range(operations)
+        ])
+        self.tokens = [access_token(user) for user in users]
+
+    def operation(self):
+        body = json.dumps({'preferred_gender': self.rng.choice(GENDERS)}).encode()
+        return [('POST', '/api/chats/find_anonymous_chat/', body, self.tokens.pop())]
+
+
+class GroupSearch(Scenario):
+    name = 'group_search'
+    description = 'group chat discovery by interests'
+
+    def setup(self, operations):
+        self.tokens = [token for token, _ in self.members(50)]
+        self.interests = list(
+            Interest.objects.filter(interest__startswith='bench ').values_list('interest', flat=True)
+        )
+
+    def operation(self):
+        chosen = self.rng.sample(self.interests, k=min(2, len(self.interests)))
+        query = '&'.join(f"interests={name.replace(' ', '+')}" for name in chosen)
+        return [('GET', f'/api/chats/group_chats/?{query}&min_participants=1', b'', self.rng.choice(self.tokens))]
+
+
+class MessageSend(Scenario):
+    name = 'message_send'
+    description = 'members posting to their group chats'
+
+    def setup(self, operations):
+        self.memberships = self.members()
+
+    def operation(self):
+        token, chat_id = self.rng.choice(self.memberships)
+        body = json.dumps({'chat': chat_id, 'content': ' '.join(self.rng.choices(WORDS, k=6))}).encode()
+        return [('POST', '/api/messages/', body, token)]
+
+
+class MessageList(Scenario):
+    name = 'message_list'
+    description = 'members opening a chat, newest page of messages'
+
+    def setup(self, operations):
+        self.memberships = self.members()
+
+    def operation(self):
+        token, chat_id = self.rng.choice(self.memberships)
+        return [('GET', f'/api/messages/?chat={chat_id}', b'', token)]
+
+
+class JoinLeaveChurn(Scenario):
+    name = 'join_leave'
+    description = 'users joining a group chat and leaving it again'
+
+    def setup(self, operations):
+        users = User.objects.filter(
+            username__startswith=user_prefix(self.tag), role=UserRole.USER
+        ).order_by('id')[:200]
+        self.tokens = [access_token(user) for user in users]
+        self.chat_ids = list(
+            Chat.objects.filter(name__startswith=chat_prefix(self.tag)).values_list('id', flat=True)[:200]
+        )
+
+    def operation(self):
+        token, chat_id = self.rng.choice(self.tokens), self.rng.choice(self.chat_ids)
+        return [
+            ('POST', f'/api/chats/{chat_id}/join_chat/', b'', token),
+            ('POST', f'/api/chats/{chat_id}/leave_chat/', b'', token),
+        ]
+
+
+SCENARIOS = {scenario.name: scenario for scenario in (
+    MatchmakingStorm, GroupSearch, MessageSend, MessageList, JoinLeaveChurn,
+)}
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def run_operations(app, scenario, operations, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    # Built up front, the scenarios' random generators stay out of the timing
+    planned = [scenario.operation() for _ in range(operations)]
+
+    async def one(requests):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            for method, url, body, token in requests:
+                status = await asgi_request(app, method, url, token, body)
+                if status >= 400:
+                    errors += 1
+                    break
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(requests) for requests in planned])
+    return time.perf_counter() - started, latencies, errors
+
+
+def run_scenario(app, name, tag, operations=500, concurrency=32, seed=0):
+    """Run one scenario, returns its throughput and latency percentiles"""
+    scenario = SCENARIOS[name](tag, operations, seed=seed)
+    elapsed, latencies, errors = asyncio.run(run_operations(app, scenario, operations, concurrency))
+    latencies.sort()
+    return {
+        'operations': operations,
+        'concurrency': concurrency,
+        'errors': errors,
+        'ops_per_second': operations / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+    }
@@ -0,0 +1,191 @@
+"""
+Refresh token blacklist with O(1) membership checks.
+
+Every refresh and every logout of an anonymous user asks whether a token
+is blacklisted. simplejwt answers with a join over ``BlacklistedToken`` and
+``OutstandingToken``, two tables that anonymous users fill quickly. The
+store here is chosen with ``settings.TOKEN_BLACKLIST``:
+
+* ``BloomTokenBlacklist`` keeps the database tables as the source of truth
+  and puts a per-process Bloom filter in front of them. A token that is not
+  blacklisted, the common case, is answered without a query; a hit is
+  confirmed in the database. Other processes' additions are picked up every
+  ``refresh_interval`` seconds.
+* ``RedisTokenBlacklist`` stores one key per blacklisted jti that expires
+  with the token.
+
+Expired rows are removed with ``compact_expired_tokens`` (see the
+``compact_tokens`` command), whatever the store.
+"""
+import hashlib
+import math
+import threading
+import time
+from functools import lru_cache
+from django.conf import settings
+from django.utils.module_loading import import_string
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import aware_utcnow, datetime_from_epoch
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BaseTokenBlacklist:
+    """Interface of a blacklist store"""
+
+    def add(self, token):
+        """Blacklist a refresh token"""
+        raise NotImplementedError
+
+    def contains(self, jti):
+        raise NotImplementedError
+
+
+class RedisTokenBlacklist(BaseTokenBlacklist):
+    """One key per blacklisted jti, Redis drops it when the token expires"""
+
+    def __init__(self, url='redis://127.0.0.1:6379/4', prefix='blacklist', **options):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def key(self, jti):
+        return f"{self.prefix}:jti:{jti}"
+
+    def add(self, token):
+        ttl = max(int(token['exp'] - time.time()), 1)
+        self.client.set(self.key(token[api_settings.JTI_CLAIM]), 1, ex=ttl)
+
+    def contains(self, jti):
+        return bool(self.client.exists(self.key(jti)))
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings"""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+
+class BloomTokenBlacklist(BaseTokenBlacklist):
+    """Database blacklist behind a per-process Bloom filter"""
+    # Rows committed out of id order by concurrent transactions are re-read
+    reload_overlap = 100
+
+    def __init__(self, capacity=100000, error_rate=0.001, refresh_interval=5, rebuild_interval=3600, **options):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.lock = threading.Lock()
+        self.filter = None
+        self.last_id = 0
+        self.refreshed_at = 0
+        self.built_at = 0
+
+    def rows(self, min_id=0):
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+        return BlacklistedToken.objects.filter(
+            id__gt=min_id, token__expires_at__gt=aware_utcnow()
+        ).order_by('id').values_list('id', 'token__jti')
+
+    def sync(self):
+        """Pull blacklist rows added since the last sync, rebuild now and then"""
+        now = time.monotonic()
+        with self.lock:
+            if self.filter is not None and now - self.refreshed_at < self.refresh_interval:
+                return
+            rebuild = (
+                self.filter is None
+                or self.filter.count > self.filter.capacity
+                or now - self.built_at > self.rebuild_interval
+            )
+            if rebuild:
+                rows = list(self.rows())
+                # Expired tokens are left out, so a rebuild also shrinks the filter back
+                self.filter = BloomFilter(max(self.capacity, len(rows) * 2), self.error_rate)
+                self.built_at = now
+                self.last_id = 0
+            else:
+                rows = list(self.rows(max(self.last_id - self.reload_overlap, 0)))
+            for row_id, jti in rows:
+                self.filter.add(jti)
+                self.last_id = max(self.last_id, row_id)
+            self.refreshed_at = now
+
+    def contains(self, jti):
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+        self.sync()
+        if jti not in self.filter:
+            return False
+        # Possibly a false positive, the table has the final word
+        return BlacklistedToken.objects.filter(token__jti=jti).exists()
+
+    def add(self, token):
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+        from .models import User
+        jti = token[api_settings.JTI_CLAIM]
+        outstanding, _ = OutstandingToken.objects.get_or_create(
+            jti=jti,
+            defaults={
+                'user': User.objects.filter(pk=token.get(api_settings.USER_ID_CLAIM)).first(),
+                'created_at': token.current_time,
+                'token': str(token),
+                'expires_at': datetime_from_epoch(token['exp']),
+            }
+        )
+        BlacklistedToken.objects.get_or_create(token=outstanding)
+        self.sync()
+        with self.lock:
+            self.filter.add(jti)
+
+
+def compact_expired_tokens(batch_size=1000):
+    """Delete expired blacklisted and outstanding tokens in batches.
+
+    Returns the number of (blacklisted, outstanding) rows removed.
+    """
+    from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+    now = aware_utcnow()
+    removed = []
+    for queryset in (
+        BlacklistedToken.objects.filter(token__expires_at__lte=now),
+        OutstandingToken.objects.filter(expires_at__lte=now),
+    ):
+        total = 0
+        while True:
+            # Short transactions, the tables stay writable while compaction runs
+            ids = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            queryset.model.objects.filter(pk__in=ids).delete()
+            total += len(ids)
+        removed.append(total)
+    return tuple(removed)
+
+
+@lru_cache(maxsize=None)
+def get_token_blacklist():
+    """The configured blacklist store, one instance per process"""
+    config = getattr(settings, 'TOKEN_BLACKLIST', {})
+    backend_class = import_string(config.get('BACKEND', 'chat.blacklist.BloomTokenBlacklist'))
+    return backend_class(**config.get('OPTIONS', {}))
@@ -0,0 +1,166 @@
+"""
+Read-through cache for rarely changing API payloads.
+
+Values are looked up in a small in-process LRU first and in the shared
+cache (Redis, see ``settings.CACHES``) second. Writes go to both tiers.
+Invalidation deletes from both tiers of the current process; other
+processes drop their copy when its short local TTL runs out, so
+``LOCAL_TIMEOUT`` is the upper bound for cross-process staleness.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LocalLRUCache:
+    """Thread-safe in-process cache with a TTL and LRU eviction"""
+
+    def __init__(self, max_entries=1024, timeout=5):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.timeout)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class TieredCache:
+    """Local LRU in front of a Django cache backend"""
+
+    def __init__(self, alias='default', timeout=300, local_timeout=5, local_max_entries=1024, prefix='chat'):
+        self.alias = alias
+        self.timeout = timeout
+        self.prefix = prefix
+        self.local = LocalLRUCache(max_entries=local_max_entries, timeout=local_timeout)
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def make_key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def get(self, key):
+        key = self.make_key(key)
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        try:
+            value = self.shared.get(key)
+        except Exception as e:
+            logger.warning(f"Shared cache unavailable on get: {str(e)}")
+            return None
+        if value is not None:
+            self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        key = self.make_key(key)
+        self.local.set(key, value)
+        try:
+            self.shared.set(key, value, self.timeout)
+        except Exception as e:
+            logger.warning(f"Shared cache unavailable on set: {str(e)}")
+
+    def delete_many(self, keys):
+        keys = [self.make_key(key) for key in keys]
+        self.local.delete_many(keys)
+        try:
+            self.shared.delete_many(keys)
+        except Exception as e:
+            logger.warning(f"Shared cache unavailable on delete: {str(e)}")
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def clear(self):
+        self.local.clear()
+        try:
+            self.shared.clear()
+        except Exception as e:
+            logger.warning(f"Shared cache unavailable on clear: {str(e)}")
+
+
+def build_cache():
+    config = getattr(settings, 'CHAT_CACHE', {})
+    return TieredCache(
+        alias=config.get('ALIAS', 'default'),
+        timeout=config.get('TIMEOUT', 300),
+        local_timeout=config.get('LOCAL_TIMEOUT', 5),
+        local_max_entries=config.get('LOCAL_MAX_ENTRIES', 1024),
+    )
+
+
+chat_cache = build_cache()
+
+INTEREST_LIST_KEY = 'interests:list'
+
+
+def chat_detail_key(chat_id):
+    return f"chats:{chat_id}"
+
+
+def make_etag(data):
+    payload = json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder).encode()
+    return quote_etag(hashlib.md5(payload).hexdigest())
+
+
+def cached_response(request, key, build):
+    """Serve ``build()`` through the cache with ETag / If-None-Match support"""
+    entry = chat_cache.get(key)
+    if entry is None:
+        data = build()
+        entry = {'data': data, 'etag': make_etag(data)}
+        chat_cache.set(key, entry)
+
+    headers = {'ETag': entry['etag']}
+    if etag_matches(request, entry['etag']):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(entry['data'], headers=headers)
+
+
+def etag_matches(request, etag):
+    """Whether the client's If-None-Match already covers ``etag``"""
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    # Weak comparison, as If-None-Match requires
+    etags = [value.removeprefix('W/') for value in parse_etags(if_none_match)]
+    return '*' in etags or etag in etags
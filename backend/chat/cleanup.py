@@ -0,0 +1,122 @@
+"""
+Garbage collection of abandoned anonymous sessions.
+
+``leave_chat`` cleans up after anonymous users who leave properly. Users
+who just close the tab leave their ``User``, ``ChatUser`` and ``Message``
+rows and a half-empty anonymous chat behind. ``collect_stale_anonymous``
+removes them in batches.
+
+A user is stale when neither their account, their last login nor their last
+message is newer than the cutoff. Each batch is one short transaction of
+set-based statements over at most ``batch_size`` users. The users are
+claimed with ``FOR UPDATE SKIP LOCKED``, so a request touching one of them
+is never blocked and concurrent collectors do not collide. Deletes run in
+foreign key order because the ORM's cascades are bypassed. Caches and the
+matchmaking queue are updated afterwards.
+"""
+import time
+from django.db import connection, transaction
+from .models import Chat, ChatInterest, ChatType, ChatUser, Message, User, UserRole
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def claim_stale_users(cursor, cutoff, batch_size):
+    cursor.execute(
+        f"""
+        SELECT u.id FROM {table(User)} u
+        WHERE u.role = %s
+          AND GREATEST(u.date_joined, COALESCE(u.last_login, u.date_joined)) < %s
+          AND NOT EXISTS (
+              SELECT 1 FROM {table(Message)} m WHERE m.sender_id = u.id AND m.created_at >= %s
+          )
+        ORDER BY u.id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+        """,
+        [UserRole.ANONYMOUS, cutoff, cutoff, batch_size]
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def delete_users(cursor, user_ids):
+    """Delete a batch of users and everything hanging off them, returns row counts"""
+    from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+
+    # Memberships go first, the counters of the chats they were in drop with them
+    cursor.execute(
+        f"""
+        WITH removed AS (
+            DELETE FROM {table(ChatUser)} WHERE user_id = ANY(%s) RETURNING chat_id
+        ), counts AS (
+            SELECT chat_id, count(*) AS n FROM removed GROUP BY chat_id
+        )
+        UPDATE {table(Chat)} c
+        SET participant_count = GREATEST(c.participant_count - counts.n, 0)
+        FROM counts WHERE c.id = counts.chat_id
+        RETURNING c.id, c.type, c.participant_count
+        """,
+        [user_ids]
+    )
+    touched = cursor.fetchall()
+    chat_ids = [chat_id for chat_id, _, _ in touched]
+    empty_chat_ids = [chat_id for chat_id, chat_type, count in touched
+                      if chat_type == ChatType.ANONYMOUS and count == 0]
+
+    counts = {'users': len(user_ids), 'chats': len(empty_chat_ids)}
+    cursor.execute(
+        f"DELETE FROM {table(Message)} WHERE sender_id = ANY(%s) OR chat_id = ANY(%s)",
+        [user_ids, empty_chat_ids]
+    )
+    counts['messages'] = cursor.rowcount
+    if empty_chat_ids:
+        # Whoever else was in these chats is gone already, the counter is 0
+        cursor.execute(f"DELETE FROM {table(ChatUser)} WHERE chat_id = ANY(%s)", [empty_chat_ids])
+        cursor.execute(f"DELETE FROM {table(ChatInterest)} WHERE chat_id = ANY(%s)", [empty_chat_ids])
+        cursor.execute(f"DELETE FROM {table(Chat)} WHERE id = ANY(%s)", [empty_chat_ids])
+
+    # OutstandingToken.user is SET_NULL, the M2M tables of AbstractUser cascade
+    cursor.execute(f"UPDATE {table(OutstandingToken)} SET user_id = NULL WHERE user_id = ANY(%s)", [user_ids])
+    for through in (User.groups.through, User.user_permissions.through):
+        cursor.execute(f"DELETE FROM {table(through)} WHERE user_id = ANY(%s)", [user_ids])
+    cursor.execute(f"DELETE FROM {table(User)} WHERE id = ANY(%s)", [user_ids])
+    return counts, chat_ids, empty_chat_ids
+
+
+def forget(user_ids, chat_ids, empty_chat_ids):
+    """What the ORM signals would have done for the deleted rows"""
+    from .authentication import invalidate_user
+    from .cache import chat_cache, chat_detail_key
+    from .matchmaking import get_matchmaker
+
+    chat_cache.delete_many([chat_detail_key(chat_id) for chat_id in chat_ids])
+    for user_id in user_ids:
+        invalidate_user(user_id)
+    matchmaker = get_matchmaker()
+    for chat_id in empty_chat_ids:
+        matchmaker.remove(chat_id)
+
+
+def collect_stale_anonymous(cutoff, batch_size=500, pause=0):
+    """Delete anonymous users inactive since ``cutoff`` batch by batch.
+
+    Yields the row counts of every batch, ``pause`` seconds between batches
+    leave room for the regular traffic on the same tables.
+    """
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            user_ids = claim_stale_users(cursor, cutoff, batch_size)
+            if not user_ids:
+                return
+            counts, chat_ids, empty_chat_ids = delete_users(cursor, user_ids)
+        forget(user_ids, chat_ids, empty_chat_ids)
+        yield counts
+        if len(user_ids) < batch_size:
+            return
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,118 @@
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from .models import ChatUser, Message
+from .presence import TypingThrottle, get_presence_store, presence_settings, read_receipts
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def chat_group_name(chat_id):
+    """Name of the channel layer group that receives a chat's events"""
+    return f"chat_{chat_id}"
+
+
+async def abroadcast_message(chat_id, data):
+    """Push a persisted message to everyone connected to the chat socket"""
+    try:
+        await get_channel_layer().group_send(
+            chat_group_name(chat_id),
+            {'type': 'chat.message', 'message': data}
+        )
+    except Exception as e:
+        # The message is already saved, clients will get it on the next fetch
+        logger.warning(f"Failed to broadcast message to chat {chat_id}: {str(e)}")
+
+
+broadcast_message = async_to_sync(abroadcast_message)
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """Push a chat's messages and presence signals to its connected participants.
+
+    Client events:
+        {"type": "heartbeat"}                  keep the presence entry alive
+        {"type": "typing"}                     rate limited per connection
+        {"type": "read", "message_id": <id>}   buffered, flushed periodically
+        {"type": "presence"}                   ask for the current online list
+    """
+
+    async def connect(self):
+        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
+        self.group_name = chat_group_name(self.chat_id)
+        user = self.scope.get('user')
+
+        if not user or not user.is_authenticated:
+            await self.close(code=4401)
+            return
+
+        if not await self.is_participant(user):
+            logger.warning(f"User {user.username} is not a member of chat {self.chat_id}, closing socket")
+            await self.close(code=4403)
+            return
+
+        self.user = user
+        self.presence = get_presence_store()
+        self.typing = TypingThrottle(presence_settings()['TYPING_INTERVAL'])
+        read_receipts.ensure_flusher()
+
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+        await self.presence.touch(self.chat_id, user.id, self.channel_name)
+        await self.send_presence_state()
+        await self.broadcast('chat.presence', user_id=user.id, online=True)
+
+    async def disconnect(self, code):
+        if not hasattr(self, 'user'):
+            return
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if await self.presence.leave(self.chat_id, self.user.id, self.channel_name):
+            await self.broadcast('chat.presence', user_id=self.user.id, online=False)
+
+    async def receive_json(self, content, **kwargs):
+        # Messages are written through the REST API, the socket only carries signals
+        event_type = content.get('type')
+        if event_type == 'heartbeat':
+            await self.presence.touch(self.chat_id, self.user.id, self.channel_name)
+        elif event_type == 'typing':
+            if self.typing.allow():
+                await self.broadcast('chat.typing', user_id=self.user.id)
+        elif event_type == 'read':
+            message_id = content.get('message_id')
+            if not isinstance(message_id, int) or message_id <= read_receipts.position(self.chat_id, self.user.id):
+                return
+            # Only positions that moved forward cost a lookup, ids of other chats are dropped
+            if await self.in_chat(message_id) and read_receipts.record(self.chat_id, self.user.id, message_id):
+                await self.broadcast('chat.read', user_id=self.user.id, message_id=message_id)
+        elif event_type == 'presence':
+            await self.send_presence_state()
+
+    async def broadcast(self, event_type, **payload):
+        await self.channel_layer.group_send(self.group_name, {'type': event_type, **payload})
+
+    async def send_presence_state(self):
+        await self.send_json({'type': 'presence.state', 'online': await self.presence.online(self.chat_id)})
+
+    async def chat_message(self, event):
+        await self.send_json({'type': 'message', 'message': event['message']})
+
+    async def chat_presence(self, event):
+        await self.send_json({'type': 'presence', 'user_id': event['user_id'], 'online': event['online']})
+
+    async def chat_typing(self, event):
+        if event['user_id'] != self.user.id:
+            await self.send_json({'type': 'typing', 'user_id': event['user_id']})
+
+    async def chat_read(self, event):
+        await self.send_json({'type': 'read', 'user_id': event['user_id'], 'message_id': event['message_id']})
+
+    @database_sync_to_async
+    def is_participant(self, user):
+        return ChatUser.objects.filter(user=user, chat_id=self.chat_id).exists()
+
+    @database_sync_to_async
+    def in_chat(self, message_id):
+        return Message.objects.filter(id=message_id, chat_id=self.chat_id).exists()
@@ -0,0 +1,61 @@
+"""
+PostgreSQL backend with optional in-process connection pooling.
+
+``ENGINE: 'chat.db'`` behaves like ``django.db.backends.postgresql``. With a
+``POOL`` dict in the database settings (keyword arguments of
+``ConnectionPool``), connections are taken from a per-process pool instead
+of being opened, and given back instead of being closed. Either way the
+time spent getting a connection and running queries is reported per
+request.
+"""
+import time
+from django.db.backends.postgresql import base, creation
+from ..metrics import record_query, record_wait
+from .pool import close_pools, get_pool
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle pooled connections would keep the test database in use
+        close_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Query counts and times per request, see chat/metrics.py
+        self.execute_wrappers.append(record_query)
+
+    @property
+    def pool(self):
+        options = self.settings_dict.get('POOL')
+        if not options:
+            return None
+        # Test databases and the maintenance database get pools of their own
+        key = (self.alias, self.settings_dict['NAME'], self.settings_dict['HOST'], self.settings_dict['PORT'])
+        return get_pool(key, options)
+
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is None:
+            started = time.monotonic()
+            connection = super().get_new_connection(conn_params)
+            record_wait(time.monotonic() - started)
+            return connection
+        connection = pool.getconn(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        # Set by the parent when it opens a connection, a reused one needs it as well
+        self.isolation_level = base.IsolationLevel(
+            self.settings_dict['OPTIONS'].get('isolation_level', base.IsolationLevel.READ_COMMITTED)
+        )
+        return connection
+
+    def _close(self):
+        pool = self.pool
+        if pool is None or self.connection is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            pool.putconn(self.connection)
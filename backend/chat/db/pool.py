@@ -0,0 +1,150 @@
+"""
+In-process pool of psycopg2 connections.
+
+Django opens a connection per thread and, with ``CONN_MAX_AGE = 0``, closes
+it at the end of every request. Under ASGI every ``sync_to_async`` call may
+run in another thread, so a busy process connects and disconnects all the
+time. ``ConnectionPool`` keeps up to ``max_size`` connections per process:
+``getconn`` hands out an idle one (checking its health first when it has
+been idle for a while) or opens a new one, and blocks for up to ``timeout``
+seconds when all of them are in use. ``putconn`` takes it back, rolling back
+whatever transaction was left open.
+
+The time spent waiting for a connection is added to the ``RequestTimings``
+of the current request, see chat/metrics.py.
+"""
+import threading
+import time
+from collections import deque
+import psycopg2
+from psycopg2 import extensions
+from ..metrics import record_wait
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """Thread-safe pool of database connections with health checks"""
+
+    def __init__(self, max_size=10, timeout=10, check_interval=30, max_idle=300, max_lifetime=3600):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        # (connection, returned at), the most recently used is reused first
+        self.idle = deque()
+        self.created_at = {}
+        self.stats = {'connects': 0, 'checkouts': 0, 'timeouts': 0, 'discarded': 0, 'wait': 0.0}
+
+    def getconn(self, connect):
+        """A healthy connection, opened with ``connect()`` when none is idle"""
+        started = time.monotonic()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.stats['timeouts'] += 1
+            raise psycopg2.OperationalError(
+                f"No database connection available within {self.timeout}s, pool of {self.max_size} exhausted"
+            )
+        try:
+            connection = self.take_idle()
+            if connection is None:
+                connection = connect()
+                with self.lock:
+                    self.created_at[id(connection)] = time.monotonic()
+                    self.stats['connects'] += 1
+        except BaseException:
+            self.slots.release()
+            raise
+
+        wait = time.monotonic() - started
+        with self.lock:
+            self.stats['checkouts'] += 1
+            self.stats['wait'] += wait
+        record_wait(wait)
+        return connection
+
+    def take_idle(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return None
+                connection, returned_at = self.idle.pop()
+            now = time.monotonic()
+            if now - returned_at > self.max_idle or self.expired(connection, now):
+                self.discard(connection)
+            elif now - returned_at > self.check_interval and not self.is_usable(connection):
+                self.discard(connection)
+            else:
+                return connection
+
+    def putconn(self, connection):
+        """Give a connection back, broken or expired ones are closed"""
+        try:
+            status = connection.info.transaction_status if not connection.closed else None
+            if status in (extensions.TRANSACTION_STATUS_INTRANS, extensions.TRANSACTION_STATUS_INERROR):
+                connection.rollback()
+                status = connection.info.transaction_status
+            if status != extensions.TRANSACTION_STATUS_IDLE or self.expired(connection, time.monotonic()):
+                self.discard(connection)
+            else:
+                with self.lock:
+                    self.idle.append((connection, time.monotonic()))
+        except psycopg2.Error:
+            self.discard(connection)
+        finally:
+            self.slots.release()
+
+    def expired(self, connection, now):
+        return now - self.created_at.get(id(connection), now) > self.max_lifetime
+
+    @staticmethod
+    def is_usable(connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+    def discard(self, connection):
+        with self.lock:
+            self.created_at.pop(id(connection), None)
+            self.stats['discarded'] += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def close_all(self):
+        """Close the idle connections, e.g. before the database is dropped"""
+        with self.lock:
+            idle, self.idle = list(self.idle), deque()
+        for connection, _ in idle:
+            self.discard(connection)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, size=len(self.created_at), idle=len(self.idle), max_size=self.max_size)
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(key, options):
+    """The pool of one database configuration, created on first use"""
+    with pools_lock:
+        pool = pools.get(key)
+        if pool is None:
+            pool = pools[key] = ConnectionPool(**options)
+        return pool
+
+
+def close_pools():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close_all()
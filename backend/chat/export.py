@@ -0,0 +1,107 @@
+"""
+Streaming export of a chat's history as NDJSON, optionally gzip compressed.
+
+Archived months are read from their files chat member by chat member,
+the months still in the database through a server-side cursor, and every
+line is encoded and compressed on the way out. Memory use does not depend
+on the size of the chat.
+"""
+import heapq
+import json
+import zlib
+from datetime import datetime
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from rest_framework import serializers
+from .models import Message
+from .partitions import GZIP_WBITS, archived_partitions, iter_chat
+
+EXPORT_FIELDS = ('id', 'chat', 'sender', 'content', 'created_at')
+
+
+def archived_rows(chat_id):
+    partitions = sorted(archived_partitions(), key=lambda p: p['range_start'])
+    for partition in partitions:
+        for row in iter_chat(partition['path'], chat_id):
+            row['created_at'] = datetime.fromisoformat(row['created_at'])
+            yield row
+
+
+def database_rows(chat_id, chunk_size=2000):
+    queryset = Message.objects.filter(chat_id=chat_id)
+    # A month being archived is in the file already, a rehydrated one is back in the database only
+    for partition in archived_partitions():
+        queryset = queryset.exclude(created_at__gte=partition['range_start'], created_at__lt=partition['range_end'])
+    rows = queryset.order_by('created_at', 'id').values_list(
+        'id', 'chat_id', 'sender_id', 'content', 'created_at'
+    ).iterator(chunk_size=chunk_size)
+    for values in rows:
+        yield dict(zip(EXPORT_FIELDS, values))
+
+
+def export_rows(chat_id, chunk_size=2000):
+    """Every message of a chat, oldest first, as dicts of EXPORT_FIELDS"""
+    # Rehydrated months may sit between archived ones
+    return heapq.merge(
+        archived_rows(chat_id), database_rows(chat_id, chunk_size=chunk_size),
+        key=lambda row: (row['created_at'], row['id'])
+    )
+
+
+def ndjson_chunks(rows, chunk_bytes=1 << 16):
+    """Encode rows as NDJSON, yielding chunks of about ``chunk_bytes``"""
+    # Same date format as the API
+    created_at = serializers.DateTimeField()
+    lines = []
+    size = 0
+    for row in rows:
+        row = {field: row[field] for field in EXPORT_FIELDS}
+        row['created_at'] = created_at.to_representation(row['created_at'])
+        line = json.dumps(row, ensure_ascii=False).encode() + b'\n'
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield b''.join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield b''.join(lines)
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress a stream of chunks into one gzip stream"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chat(chat_id, compress=False, chunk_size=2000):
+    """The export of a chat as a stream of bytes"""
+    chunks = ndjson_chunks(export_rows(chat_id, chunk_size=chunk_size))
+    return gzip_chunks(chunks) if compress else chunks
+
+
+async def aiter_chunks(chunks):
+    """Hand a blocking chunk iterator to an ASGI server one chunk at a time"""
+    chunks = iter(chunks)
+    # Same thread for every chunk, the server-side cursor belongs to its connection
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    while True:
+        chunk = await next_chunk(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def streaming_chunks(request, chunks):
+    """Chunks for a StreamingHttpResponse to ``request``.
+
+    Under ASGI Django collects a sync iterator into a list before sending
+    it, the export has to be an async iterator there to stay streamed.
+    """
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        return aiter_chunks(chunks)
+    return chunks
@@ -0,0 +1,163 @@
+"""
+Read-only serialization of hot list endpoints without model instances.
+
+A serializer class is compiled once into a ``FieldPlan``: the ``values()``
+lookups it needs and, per output field, how to turn the looked up value into
+what the serializer would have returned. Forward nested serializers become
+joined lookups (``sender__username``), reverse ``many=True`` ones one extra
+query per page, ordered by id like the prefetches of the serializer.
+
+The output is the same as the serializer's, field order included, so the
+rendered JSON is byte for byte the same. Method fields cannot be compiled,
+a serializer lists the values they take in list responses in
+``plan_defaults`` (callables, called once per row).
+"""
+from functools import lru_cache
+from rest_framework import serializers
+from rest_framework.relations import RelatedField
+from .metrics import timed_serialization
+
+# Fields whose to_representation returns a values() result unchanged
+IDENTITY_FIELDS = (
+    serializers.IntegerField, serializers.CharField, serializers.BooleanField,
+    serializers.ReadOnlyField,
+)
+
+
+def converter(field):
+    if type(field) in IDENTITY_FIELDS or isinstance(field, serializers.PrimaryKeyRelatedField):
+        return None
+    if isinstance(field, serializers.JSONField) and not field.binary:
+        return None
+    return field.to_representation
+
+
+def column(lookup, convert):
+    if convert is None:
+        return lambda row, related: row[lookup]
+
+    def get(row, related):
+        value = row[lookup]
+        return None if value is None else convert(value)
+    return get
+
+
+def reverse_relation(model, accessor):
+    for relation in model._meta.related_objects:
+        if relation.get_accessor_name() == accessor:
+            return relation
+    raise ValueError(f"{model.__name__}.{accessor} is not a reverse relation")
+
+
+class FieldPlan:
+    """A ModelSerializer compiled into values() lookups and per field getters"""
+
+    def __init__(self, serializer_class, defaults=None, prefix=''):
+        self.serializer_class = serializer_class
+        self.model = serializer_class.Meta.model
+        self.defaults = defaults or {}
+        self.prefix = prefix
+        self.lookups = []
+        self.steps = []
+        # (field name, relation, plan) of the reverse many=True fields
+        self.related = []
+        self.compile(serializer_class())
+
+    def add_lookup(self, source):
+        lookup = self.prefix + source
+        if lookup not in self.lookups:
+            self.lookups.append(lookup)
+        return lookup
+
+    def compile(self, serializer):
+        for field in serializer._readable_fields:
+            name = field.field_name
+            if name in self.defaults:
+                factory = self.defaults[name]
+                self.steps.append((name, lambda row, related, factory=factory: factory()))
+            elif isinstance(field, serializers.ListSerializer):
+                self.compile_many(name, field)
+            elif isinstance(field, serializers.ModelSerializer):
+                self.compile_nested(name, field)
+            elif isinstance(field, RelatedField) and not isinstance(field, serializers.PrimaryKeyRelatedField):
+                raise ValueError(f"{type(field).__name__} {name} cannot be compiled")
+            elif isinstance(field, (serializers.SerializerMethodField, serializers.Serializer)) or '.' in field.source:
+                raise ValueError(f"{name} cannot be compiled, give it a plan default")
+            else:
+                self.steps.append((name, column(self.add_lookup(field.source), converter(field))))
+        self.add_lookup('id')
+
+    def compile_nested(self, name, field):
+        if self.prefix:
+            raise ValueError(f"{name}: only one level of nested serializers can be compiled")
+        nested = FieldPlan(type(field), prefix=f"{self.prefix}{field.source}__")
+        if nested.related:
+            raise ValueError(f"{name}: nested serializers cannot have many=True fields")
+        for lookup in nested.lookups:
+            self.add_lookup(lookup)
+        pk = nested.prefix + 'id'
+
+        def get(row, related):
+            # A null foreign key leaves every joined column null
+            if row[pk] is None:
+                return None
+            return nested.represent_row(row, related)
+        self.steps.append((name, get))
+
+    def compile_many(self, name, field):
+        if self.prefix:
+            raise ValueError(f"{name}: many=True fields can only be compiled at the top level")
+        relation = reverse_relation(self.model, field.source)
+        plan = FieldPlan(type(field.child))
+        self.related.append((name, relation, plan))
+        self.steps.append((name, lambda row, related: related[name].get(row['id'], [])))
+
+    def values(self, queryset):
+        """``queryset`` reading only the columns of the plan"""
+        return queryset.prefetch_related(None).values(*self.lookups)
+
+    def load_related(self, rows):
+        """Rows of the many=True fields of ``rows``, grouped by field and parent id"""
+        related = {}
+        if not self.related:
+            return related
+        ids = [row['id'] for row in rows]
+        for name, relation, plan in self.related:
+            fk = relation.field.attname
+            groups = {}
+            queryset = relation.related_model.objects.filter(**{f"{fk}__in": ids}).order_by('id')
+            for child in queryset.values(*plan.lookups, fk):
+                groups.setdefault(child[fk], []).append(child)
+            related[name] = {
+                parent: plan.represent_rows(children, plan.load_related(children))
+                for parent, children in groups.items()
+            }
+        return related
+
+    def represent_row(self, row, related):
+        return {name: get(row, related) for name, get in self.steps}
+
+    def represent_rows(self, rows, related):
+        return [self.represent_row(row, related) for row in rows]
+
+    def represent(self, rows, fallback=None):
+        """Serialize values() rows, instances among them go through ``fallback``"""
+        rows = list(rows)
+        values = [row for row in rows if isinstance(row, dict)]
+        related = self.load_related(values)
+        return timed_serialization(self.represent_page, rows, related, fallback)
+
+    def represent_page(self, rows, related, fallback):
+        data = []
+        for row in rows:
+            if isinstance(row, dict):
+                data.append(self.represent_row(row, related))
+            else:
+                # Messages read back from the archive files are model instances
+                data.append(fallback(row))
+        return data
+
+
+@lru_cache(maxsize=None)
+def get_plan(serializer_class):
+    return FieldPlan(serializer_class, defaults=getattr(serializer_class, 'plan_defaults', None))
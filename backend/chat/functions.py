@@ -0,0 +1,39 @@
+from django.db.models import CharField, Func, IntegerField, Lookup
+
+
+class ArrayOverlapCount(Func):
+    """Number of distinct elements two arrays have in common"""
+    template = 'cardinality(ARRAY(SELECT unnest(%(expressions)s)))'
+    arg_joiner = ') INTERSECT SELECT unnest('
+    output_field = IntegerField()
+
+
+class HTMLEscape(Func):
+    """The text with &, <, >, " and ' escaped like django.utils.html.escape.
+
+    ts_headline keeps entities as whole tokens, so a headline of the escaped
+    text carries no markup but its StartSel/StopSel.
+    """
+    template = (
+        "replace(replace(replace(replace(replace(%(expressions)s, "
+        "'&', '&amp;'), '<', '&lt;'), '>', '&gt;'), '\"', '&quot;'), '''', '&#x27;')"
+    )
+
+
+@CharField.register_lookup
+class TrigramContains(Lookup):
+    """Case-insensitive containment on the bare column.
+
+    ``icontains`` compiles to ``UPPER(col) LIKE UPPER(...)``, which an index
+    on the column cannot serve. ``col ILIKE '%...%'`` is served by a
+    gin_trgm_ops index.
+    """
+    lookup_name = 'trgm_icontains'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} ILIKE {rhs}", [*lhs_params, *rhs_params]
+
+    def get_db_prep_lookup(self, value, connection):
+        return '%s', [f"%{connection.ops.prep_for_like_query(value)}%"]
@@ -0,0 +1,126 @@
+"""
+Channel layer for running the chat socket on several Redis nodes.
+
+channels_redis picks a node with ``crc32(name) % len(hosts)``, so adding a
+node moves almost every group and channel. This layer places names on a
+hash ring with virtual nodes instead, so a new node only takes over its
+share of the keys.
+
+The stock ``group_send`` also delivers to one node after another, with
+all channels of a node in a single Lua call. For a big chat that call
+blocks the node for the whole fan-out. Here the nodes are written to
+concurrently, and a group with more than ``fanout_batch_size`` members is
+delivered in batches of that size.
+"""
+import asyncio
+import bisect
+import hashlib
+import time
+from channels_redis.core import RedisChannelLayer
+import logging
+
+logger = logging.getLogger(__name__)
+
+GROUP_SEND_LUA = """
+local over_capacity = 0
+local current_time = ARGV[#ARGV - 1]
+local expiry = ARGV[#ARGV]
+for i=1,#KEYS do
+    if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+        redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+        redis.call('EXPIRE', KEYS[i], expiry)
+    else
+        over_capacity = over_capacity + 1
+    end
+end
+return over_capacity
+"""
+
+
+class HashRing:
+    """Consistent hash ring mapping names to node indexes"""
+
+    def __init__(self, nodes, virtual_nodes=160):
+        self.points = []
+        self.indexes = []
+        ring = sorted(
+            (self.hash(f"{node}#{replica}"), index)
+            for index, node in enumerate(nodes)
+            for replica in range(virtual_nodes)
+        )
+        for point, index in ring:
+            self.points.append(point)
+            self.indexes.append(index)
+
+    @staticmethod
+    def hash(value):
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+    def node(self, value):
+        position = bisect.bisect(self.points, self.hash(value)) % len(self.points)
+        return self.indexes[position]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+
+    def __init__(self, hosts=None, virtual_nodes=160, fanout_batch_size=500, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.fanout_batch_size = fanout_batch_size
+        # Ring positions depend on the node addresses, not on their order in settings
+        self.ring = HashRing([self.node_name(host) for host in self.hosts], virtual_nodes)
+
+    @staticmethod
+    def node_name(host):
+        if 'address' in host:
+            return str(host['address'])
+        return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}/{host.get('db', 0)}"
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        return self.ring.node(value)
+
+    async def group_send(self, group, message):
+        """Send a message to the entire group, all nodes in parallel"""
+        assert self.valid_group_name(group), "Group name not valid"
+        key = self._group_key(group)
+        connection = self.connection(self.consistent_hash(group))
+        # Discard old channels based on group_expiry
+        await connection.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+        channel_names = [x.decode('utf8') for x in await connection.zrange(key, 0, -1)]
+        if not channel_names:
+            return
+
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(channel_names, message)
+
+        over_capacity = await asyncio.gather(*[
+            self.send_to_node(index, channel_keys, channel_keys_to_message, channel_keys_to_capacity)
+            for index, channel_keys in connection_to_channel_keys.items()
+        ])
+        if sum(over_capacity):
+            logger.info(
+                f"{sum(over_capacity)} of {len(channel_names)} channels over capacity in group {group}"
+            )
+
+    async def send_to_node(self, index, channel_keys, channel_keys_to_message, channel_keys_to_capacity):
+        """Deliver to the channels living on one node, fanout_batch_size keys per Lua call"""
+        connection = self.connection(index)
+        over_capacity = 0
+        for start in range(0, len(channel_keys), self.fanout_batch_size):
+            batch = channel_keys[start:start + self.fanout_batch_size]
+            pipe = connection.pipeline(transaction=False)
+            for channel_key in batch:
+                pipe.zremrangebyscore(channel_key, min=0, max=int(time.time()) - int(self.expiry))
+            await pipe.execute()
+
+            args = [channel_keys_to_message[channel_key] for channel_key in batch]
+            args += [channel_keys_to_capacity[channel_key] for channel_key in batch]
+            args += [time.time(), self.expiry]
+            over_capacity += await connection.eval(GROUP_SEND_LUA, len(batch), *batch, *args)
+        return over_capacity
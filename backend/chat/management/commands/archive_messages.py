@@ -0,0 +1,35 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.partitions import add_months, archive_partition, list_partitions, month_start, partition_month
+
+
+class Command(BaseCommand):
+    help = 'Move monthly message partitions older than the hot window into compressed archive files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hot-months', type=int, default=None,
+                            help='Months kept in the database, defaults to settings.MESSAGE_HOT_MONTHS')
+        parser.add_argument('--dir', default=None, help='Archive directory, defaults to settings.MESSAGE_ARCHIVE_DIR')
+
+    def handle(self, *args, **options):
+        hot_months = options['hot_months']
+        if hot_months is None:
+            hot_months = settings.MESSAGE_HOT_MONTHS
+        directory = options['dir'] or settings.MESSAGE_ARCHIVE_DIR
+        cutoff = add_months(month_start(timezone.now()), -hot_months)
+
+        total = 0
+        started = time.perf_counter()
+        for name in list_partitions():
+            if partition_month(name) >= cutoff:
+                continue
+            partition_started = time.perf_counter()
+            count = archive_partition(name, directory)
+            total += count
+            self.stdout.write(f"{name}: {count} messages in {time.perf_counter() - partition_started:.2f}s")
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {total} messages in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.0f} messages/s)"
+        ))
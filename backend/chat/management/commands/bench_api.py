@@ -0,0 +1,74 @@
+import json
+import platform
+import subprocess
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from chat.benchmark import SCENARIOS, run_scenario
+
+
+class Command(BaseCommand):
+    help = 'Run load scenarios against a data set from bench_seed and report throughput and latency percentiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', help=f"Any of {', '.join(SCENARIOS)}, all by default")
+        parser.add_argument('--tag', default='load', help='Data set created by bench_seed')
+        parser.add_argument('--operations', type=int, default=500, help='Operations per scenario')
+        parser.add_argument('--concurrency', type=int, default=32, help='Operations in flight at once')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Save the results as JSON, e.g. bench-<commit>.json')
+        parser.add_argument('--baseline', help='Results of an earlier run to compare with')
+
+    def handle(self, *args, **options):
+        names = options['scenarios'] or list(SCENARIOS)
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        baseline = {}
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                baseline = json.load(file)['results']
+
+        app = get_asgi_application()
+        results = {}
+        self.stdout.write(f"{'scenario':<14} {'ops/s':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}  errors")
+        for name in names:
+            result = results[name] = run_scenario(
+                app, name, options['tag'],
+                operations=options['operations'], concurrency=options['concurrency'], seed=options['seed'],
+            )
+            self.stdout.write(
+                f"{name:<14} {result['ops_per_second']:8.0f} {result['p50_ms']:7.1f}ms {result['p90_ms']:7.1f}ms "
+                f"{result['p99_ms']:7.1f}ms {result['max_ms']:7.1f}ms  {result['errors']}"
+            )
+            if name in baseline:
+                self.stdout.write(self.compare(result, baseline[name]))
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump({
+                    'commit': self.commit(),
+                    'created_at': timezone.now().isoformat(),
+                    'python': platform.python_version(),
+                    'options': {key: options[key] for key in ('tag', 'operations', 'concurrency', 'seed')},
+                    'results': results,
+                }, file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results saved to {options['output']}"))
+
+    def compare(self, result, previous):
+        def change(key):
+            before = previous[key]
+            return (result[key] - before) / before * 100 if before else 0.0
+        return (
+            f"{'':<14} {change('ops_per_second'):+7.1f}% {change('p50_ms'):+7.1f}% "
+            f"{change('p90_ms'):+7.1f}% {change('p99_ms'):+7.1f}%  vs baseline"
+        )
+
+    @staticmethod
+    def commit():
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,69 @@
+import asyncio
+import json
+import time
+import uuid
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+from chat.benchmark import asgi_request
+from chat.models import User, Chat, ChatType, Message
+
+
+class Command(BaseCommand):
+    help = 'Compare requests/s and p99 latency of the DRF endpoints and their async versions under concurrent load'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=32, help='Requests in flight at once')
+        parser.add_argument('--history', type=int, default=200, help='Messages in the benchmark chat')
+
+    def handle(self, *args, **options):
+        tag = uuid.uuid4().hex[:8]
+        user = User.objects.create_user(username=f"bench_{tag}", password=uuid.uuid4().hex, role='USER')
+        chat = Chat.objects.create(name=f"bench {tag}", type=ChatType.GROUP)
+        chat.add_participant(user)
+        Message.objects.bulk_create(
+            Message(chat=chat, sender=user, content=f"message {n}") for n in range(options['history'])
+        )
+        token = str(AccessToken.for_user(user))
+        body = json.dumps({'chat': chat.id, 'content': 'benchmark'}).encode()
+
+        endpoints = [
+            ('users/me', 'GET', '/api/users/me/', '/api/async/users/me/', b''),
+            ('chat detail', 'GET', f'/api/chats/{chat.id}/', f'/api/async/chats/{chat.id}/', b''),
+            ('message list', 'GET', f'/api/messages/?chat={chat.id}', f'/api/async/messages/?chat={chat.id}', b''),
+            ('message create', 'POST', '/api/messages/', '/api/async/messages/', body),
+        ]
+        try:
+            # Requests go through Django's ASGI handler in-process, like under daphne minus the socket
+            app = get_asgi_application()
+            for name, method, sync_url, async_url, payload in endpoints:
+                for label, url in (('sync', sync_url), ('async', async_url)):
+                    rps, p99, errors = asyncio.run(
+                        self.load(app, method, url, token, payload, options['requests'], options['concurrency'])
+                    )
+                    line = f"{name:<15} {label:<6} {rps:8.0f} req/s   p99 {p99 * 1000:7.1f} ms"
+                    self.stdout.write(line + (f"   {errors} errors" if errors else ''))
+        finally:
+            chat.delete()
+            user.delete()
+
+    async def load(self, app, method, url, token, body, total, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        errors = 0
+
+        async def one():
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                status = await asgi_request(app, method, url, token, body)
+                latencies.append(time.perf_counter() - started)
+                if status >= 400:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one() for _ in range(total)])
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        return total / elapsed, latencies[max(int(len(latencies) * 0.99) - 1, 0)], errors
@@ -0,0 +1,79 @@
+import asyncio
+import multiprocessing
+import time
+import uuid
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+
+def run_worker(group, members, messages, barrier, results):
+    """One sender process: a group of ``members`` channels receiving ``messages`` broadcasts"""
+    config = settings.CHANNEL_LAYERS['default']
+    layer = import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+
+    async def main():
+        channels = [await layer.new_channel() for _ in range(members)]
+        for channel in channels:
+            await layer.group_add(group, channel)
+        # Every process starts sending at the same time
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+        started = time.perf_counter()
+        for n in range(messages):
+            await layer.group_send(group, {'type': 'chat.message', 'message': {'id': n}})
+            await asyncio.gather(*[layer.receive(channel) for channel in channels])
+        elapsed = time.perf_counter() - started
+
+        for channel in channels:
+            await layer.group_discard(group, channel)
+        await layer.close_pools()
+        return elapsed
+
+    results.put((messages * members, asyncio.run(main())))
+
+
+class Command(BaseCommand):
+    help = 'Measure group fan-out throughput of the channel layer with 1..N sender processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                            help='Highest number of processes to run')
+        parser.add_argument('--members', type=int, default=200, help='Channels in each process group')
+        parser.add_argument('--messages', type=int, default=200, help='Broadcasts sent by each process')
+
+    def handle(self, *args, **options):
+        if 'redis' not in settings.CHANNEL_LAYERS['default']['BACKEND'].lower():
+            raise CommandError('The fan-out benchmark needs a Redis channel layer')
+
+        hosts = settings.CHANNEL_LAYERS['default'].get('CONFIG', {}).get('hosts', [])
+        self.stdout.write(f"{len(hosts)} redis node(s), {options['members']} members per group")
+
+        context = multiprocessing.get_context('fork')
+        baseline = None
+        processes = 1
+        while processes <= options['processes']:
+            delivered, elapsed = self.run(context, processes, options['members'], options['messages'])
+            rate = delivered / elapsed
+            baseline = baseline or rate
+            self.stdout.write(
+                f"{processes:>3} process(es): {delivered} deliveries in {elapsed:.2f}s, "
+                f"{rate:.0f} msg/s, x{rate / baseline:.2f}"
+            )
+            processes *= 2
+
+    def run(self, context, processes, members, messages):
+        tag = uuid.uuid4().hex[:8]
+        barrier = context.Barrier(processes)
+        results = context.Queue()
+        workers = [
+            context.Process(target=run_worker, args=(f"bench_{tag}_{n}", members, messages, barrier, results))
+            for n in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        outcome = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        # Processes run side by side, the slowest one bounds the wall time
+        return sum(delivered for delivered, _ in outcome), max(elapsed for _, elapsed in outcome)
@@ -0,0 +1,60 @@
+import gzip
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from chat.fast_serializers import get_plan
+from chat.middleware import brotli
+from chat.models import Chat, Message
+from chat.pagination import message_columns
+from chat.renderers import JSONRenderer, MessagePackRenderer
+from chat.serializers import MessageSerializer
+
+
+class Command(BaseCommand):
+    help = 'Size and encoding time of a message page in every response format and compression'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chat', type=int, help='Chat to read, the one with the most messages by default')
+        parser.add_argument('--page-size', type=int, default=50, help='Messages per page')
+        parser.add_argument('--rounds', type=int, default=200, help='Encodings per format')
+
+    def handle(self, *args, **options):
+        chat_id = options['chat']
+        if chat_id is None:
+            chat_id = (
+                Chat.objects.annotate(message_total=Count('messages')).order_by('-message_total')
+                .values_list('id', flat=True).first()
+            )
+        if chat_id is None:
+            raise CommandError('No chat to read, create a data set with bench_seed first')
+        plan = get_plan(MessageSerializer)
+        queryset = Message.objects.filter(chat_id=chat_id).order_by('-created_at', '-id')[:options['page_size']]
+        rows = plan.represent(plan.values(queryset))
+        columns, users = message_columns(rows)
+        pages = {
+            'rows': {'next': None, 'previous': None, 'results': rows},
+            'columns': {'next': None, 'previous': None, 'results': columns, 'users': users},
+        }
+        renderers = {'json': JSONRenderer(), 'msgpack': MessagePackRenderer()}
+        compression = settings.RESPONSE_COMPRESSION
+        encodings = {
+            'identity': lambda body: body,
+            'gzip': lambda body: gzip.compress(body, compresslevel=compression['GZIP_LEVEL'], mtime=0),
+        }
+        if brotli is not None:
+            encodings['br'] = lambda body: brotli.compress(body, quality=compression['BROTLI_QUALITY'])
+
+        self.stdout.write(f"chat {chat_id}, {len(rows)} messages per page")
+        self.stdout.write(f"{'format':<9} {'layout':<8} {'encoding':<9} {'bytes':>8} {'bytes/msg':>10} {'us/page':>9}")
+        for format, renderer in renderers.items():
+            for layout, page in pages.items():
+                for encoding, compress in encodings.items():
+                    started = time.perf_counter()
+                    for _ in range(options['rounds']):
+                        body = compress(renderer.render(page))
+                    elapsed = (time.perf_counter() - started) / options['rounds']
+                    self.stdout.write(
+                        f"{format:<9} {layout:<8} {encoding:<9} {len(body):8d} "
+                        f"{len(body) / max(len(rows), 1):10.1f} {elapsed * 1e6:9.0f}"
+                    )
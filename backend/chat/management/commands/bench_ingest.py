@@ -0,0 +1,55 @@
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from chat.models import User, Chat, ChatType
+
+
+class Command(BaseCommand):
+    help = 'Compare message throughput of POST /api/messages/ and POST /api/messages/bulk/'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000, help='Messages to send through each path')
+        parser.add_argument('--batch-size', type=int, default=100, help='Messages per bulk request')
+        parser.add_argument('--chats', type=int, default=5, help='Chats the messages are spread over')
+
+    def handle(self, *args, **options):
+        total = options['messages']
+        batch_size = options['batch_size']
+        tag = uuid.uuid4().hex[:8]
+
+        user = User.objects.create_user(username=f"bench_{tag}", password=uuid.uuid4().hex, role='USER')
+        chats = [Chat.objects.create(name=f"bench {tag} {n}", type=ChatType.GROUP) for n in range(options['chats'])]
+        for chat in chats:
+            chat.add_participant(user)
+
+        # Authenticate like a real bot: JWT on every request
+        client = APIClient(SERVER_NAME='localhost')
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}")
+        payload = [{'chat': chats[n % len(chats)].id, 'content': f"message {n}"} for n in range(total)]
+
+        try:
+            started = time.perf_counter()
+            for item in payload:
+                response = client.post('/api/messages/', item, format='json')
+                # 202 when the write queue takes the message
+                assert response.status_code in (201, 202), response.content
+            single = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for offset in range(0, total, batch_size):
+                response = client.post(
+                    '/api/messages/bulk/', {'messages': payload[offset:offset + batch_size]}, format='json'
+                )
+                # 207 when some messages of the batch were refused
+                assert response.status_code in (201, 207), response.content
+            bulk = time.perf_counter() - started
+        finally:
+            for chat in chats:
+                chat.delete()
+            user.delete()
+
+        self.stdout.write(f"single: {total} messages in {single:.2f}s, {total / single:.0f} msg/s")
+        self.stdout.write(f"bulk:   {total} messages in {bulk:.2f}s, {total / bulk:.0f} msg/s (batch {batch_size})")
+        self.stdout.write(self.style.SUCCESS(f"speedup: x{single / bulk:.1f}"))
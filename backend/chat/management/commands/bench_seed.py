@@ -0,0 +1,54 @@
+import time
+from django.core.management.base import BaseCommand
+from chat.benchmark import drop_dataset, generate_dataset
+
+
+class Command(BaseCommand):
+    help = 'Generate (or drop with --drop) a reproducible benchmark data set'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tag', default='load', help='Names the data set, scenarios and --drop refer to it')
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--group-chats', type=int, default=100)
+        parser.add_argument('--anonymous-chats', type=int, default=100, help='Anonymous chats waiting for a partner')
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--members-per-chat', type=int, default=10)
+        parser.add_argument('--interests', type=int, default=20)
+        parser.add_argument('--months', type=int, default=3, help='Messages are spread over this many months')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows per INSERT')
+        parser.add_argument('--drop', action='store_true', help='Delete the data set instead')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['drop']:
+            counts = drop_dataset(options['tag'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Dropped {counts['users']} users, {counts['chats']} chats, {counts['messages']} messages "
+                f"in {time.perf_counter() - started:.1f}s"
+            ))
+            return
+
+        def progress(kind, count):
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"{count} {kind} ({elapsed:.1f}s)")
+
+        counts = generate_dataset(
+            options['tag'],
+            users=options['users'],
+            group_chats=options['group_chats'],
+            anonymous_chats=options['anonymous_chats'],
+            messages=options['messages'],
+            members_per_chat=options['members_per_chat'],
+            interests=options['interests'],
+            months=options['months'],
+            seed=options['seed'],
+            batch_size=options['batch_size'],
+            progress=progress,
+        )
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {counts['users']} users, {counts['group_chats']} group chats, "
+            f"{counts['anonymous_chats']} waiting anonymous chats, {counts['messages']} messages in {elapsed:.1f}s "
+            f"({counts['messages'] / elapsed if elapsed else 0:.0f} messages/s)"
+        ))
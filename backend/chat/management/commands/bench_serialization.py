@@ -0,0 +1,60 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from rest_framework.renderers import JSONRenderer as StockJSONRenderer
+from chat.fast_serializers import get_plan
+from chat.models import Chat, Message
+from chat.renderers import JSONRenderer, orjson
+from chat.serializers import MessageSerializer
+
+
+class Command(BaseCommand):
+    help = 'Compare messages serialized per second by MessageSerializer and by its compiled field plan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chat', type=int, help='Chat to read, the one with the most messages by default')
+        parser.add_argument('--page-size', type=int, default=200, help='Messages per page')
+        parser.add_argument('--rounds', type=int, default=50, help='Pages serialized per mode')
+
+    def handle(self, *args, **options):
+        chat_id = options['chat']
+        if chat_id is None:
+            chat_id = (
+                Chat.objects.annotate(message_total=Count('messages')).order_by('-message_total')
+                .values_list('id', flat=True).first()
+            )
+        if chat_id is None:
+            raise CommandError('No chat to read, create a data set with bench_seed first')
+        queryset = Message.objects.filter(chat_id=chat_id).order_by('-created_at', '-id')[:options['page_size']]
+        plan = get_plan(MessageSerializer)
+        stock, fast = StockJSONRenderer(), JSONRenderer()
+
+        def drf():
+            messages = list(MessageSerializer.setup_eager_loading(queryset))
+            started = time.perf_counter()
+            body = stock.render(MessageSerializer(messages, many=True).data)
+            return body, len(messages), time.perf_counter() - started
+
+        def compiled():
+            rows = list(plan.values(queryset))
+            started = time.perf_counter()
+            body = fast.render(plan.represent(rows))
+            return body, len(rows), time.perf_counter() - started
+
+        if drf()[0] != compiled()[0]:
+            self.stderr.write(self.style.WARNING('The two modes rendered different bytes'))
+        self.stdout.write(f"chat {chat_id}, orjson {'on' if orjson else 'off'}")
+        self.stdout.write(f"{'mode':<10} {'messages/s':>12} {'with query':>12}")
+        results = {}
+        for name, run in (('drf', drf), ('compiled', compiled)):
+            count = serialize_time = 0
+            started = time.perf_counter()
+            for _ in range(options['rounds']):
+                _, rows, elapsed = run()
+                count += rows
+                serialize_time += elapsed
+            total = time.perf_counter() - started
+            results[name] = count / serialize_time if serialize_time else 0
+            self.stdout.write(f"{name:<10} {results[name]:12.0f} {count / total if total else 0:12.0f}")
+        if results['drf']:
+            self.stdout.write(self.style.SUCCESS(f"{results['compiled'] / results['drf']:.1f}x faster"))
@@ -0,0 +1,20 @@
+import time
+from django.core.management.base import BaseCommand
+from chat.blacklist import compact_expired_tokens
+
+
+class Command(BaseCommand):
+    help = 'Delete expired outstanding and blacklisted refresh tokens in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows deleted per statement')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Repeat every N seconds instead of running once')
+
+    def handle(self, *args, **options):
+        while True:
+            blacklisted, outstanding = compact_expired_tokens(options['batch_size'])
+            self.stdout.write(f"Removed {blacklisted} blacklisted and {outstanding} outstanding expired tokens")
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,41 @@
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from chat.export import export_chat
+from chat.models import Chat
+
+
+class Command(BaseCommand):
+    help = 'Write the message history of chats as NDJSON, archived months included'
+
+    def add_arguments(self, parser):
+        parser.add_argument('chat_ids', nargs='+', type=int)
+        parser.add_argument('--output', default='-', help='File to write, - for stdout')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched per round trip')
+
+    def handle(self, *args, **options):
+        missing = set(options['chat_ids']) - set(
+            Chat.objects.filter(pk__in=options['chat_ids']).values_list('pk', flat=True)
+        )
+        if missing:
+            raise CommandError(f"Chats not found: {', '.join(map(str, sorted(missing)))}")
+
+        to_stdout = options['output'] == '-'
+        out = sys.stdout.buffer if to_stdout else open(options['output'], 'wb')
+        written = 0
+        started = time.perf_counter()
+        try:
+            for chat_id in options['chat_ids']:
+                # Concatenated gzip streams are a valid gzip file
+                for chunk in export_chat(chat_id, compress=options['gzip'], chunk_size=options['chunk_size']):
+                    out.write(chunk)
+                    written += len(chunk)
+        finally:
+            if to_stdout:
+                out.flush()
+            else:
+                out.close()
+        self.stderr.write(self.style.SUCCESS(
+            f"Exported {len(options['chat_ids'])} chats, {written} bytes in {time.perf_counter() - started:.2f}s"
+        ))
@@ -0,0 +1,46 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.cleanup import collect_stale_anonymous
+
+
+class Command(BaseCommand):
+    help = 'Delete anonymous users, their memberships, messages and empty chats after a period of inactivity'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale-after', type=int, default=None,
+                            help='Seconds without activity, defaults to settings.ANONYMOUS_STALE_AFTER')
+        parser.add_argument('--batch-size', type=int, default=500, help='Users deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to sleep between batches')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Repeat every N seconds instead of running once')
+
+    def handle(self, *args, **options):
+        stale_after = settings.ANONYMOUS_STALE_AFTER
+        if options['stale_after'] is not None:
+            stale_after = timedelta(seconds=options['stale_after'])
+
+        while True:
+            self.collect(timezone.now() - stale_after, options['batch_size'], options['pause'])
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def collect(self, cutoff, batch_size, pause):
+        totals = {'users': 0, 'chats': 0, 'messages': 0}
+        batches = 0
+        started = time.perf_counter()
+        for counts in collect_stale_anonymous(cutoff, batch_size=batch_size, pause=pause):
+            batches += 1
+            for key, value in counts.items():
+                totals[key] += value
+            self.stdout.write(
+                f"batch {batches}: {counts['users']} users, {counts['chats']} chats, {counts['messages']} messages"
+            )
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Removed {totals['users']} users, {totals['chats']} chats, {totals['messages']} messages "
+            f"in {batches} batches, {elapsed:.2f}s ({totals['users'] / elapsed if elapsed else 0:.0f} users/s)"
+        ))
@@ -0,0 +1,33 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.models import ChangeLogEntry
+
+
+class Command(BaseCommand):
+    help = 'Delete sync change log entries no valid version token can reach any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='Entries deleted per statement')
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        # A day more than the tokens live, for transactions still running when a token was issued
+        cutoff = timezone.now() - settings.SYNC['TOKEN_MAX_AGE'] - timedelta(days=1)
+        total = 0
+        started = time.perf_counter()
+        while True:
+            ids = list(
+                ChangeLogEntry.objects.filter(created_at__lt=cutoff).order_by('id')
+                .values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not ids:
+                break
+            total += ChangeLogEntry.objects.filter(id__in=ids).delete()[0]
+            time.sleep(options['pause'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {total} change log entries older than {cutoff:%Y-%m-%d %H:%M} "
+            f"in {time.perf_counter() - started:.1f}s"
+        ))
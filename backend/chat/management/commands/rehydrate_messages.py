@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import ArchivedPartition
+from chat.partitions import rehydrate_partition
+
+
+class Command(BaseCommand):
+    help = 'Load archived months of messages back into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('months', nargs='+', help='Months as YYYY-MM')
+
+    def handle(self, *args, **options):
+        for month in options['months']:
+            name = f"chat_message_p{month.replace('-', '_')}"
+            if not ArchivedPartition.objects.filter(name=name).exists():
+                raise CommandError(f"{month} is not archived")
+            count = rehydrate_partition(name)
+            self.stdout.write(self.style.SUCCESS(f"{name}: {count} messages restored"))
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.partitions import ensure_partitions
+
+
+class Command(BaseCommand):
+    help = 'Create the monthly message partitions of the coming months'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=None,
+                            help='Months created in advance, defaults to settings.MESSAGE_PARTITIONS_AHEAD')
+
+    def handle(self, *args, **options):
+        months_ahead = options['months_ahead']
+        if months_ahead is None:
+            months_ahead = settings.MESSAGE_PARTITIONS_AHEAD
+        created = ensure_partitions(months_ahead)
+        for name in created:
+            self.stdout.write(f"created {name}")
+        self.stdout.write(self.style.SUCCESS(f"{len(created)} partitions created"))
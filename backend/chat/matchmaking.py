@@ -0,0 +1,282 @@
+"""
+Matchmaking for anonymous chats.
+
+Users waiting for a partner are kept in an index instead of being found
+with a scan over every anonymous chat. Waiting tickets are bucketed by
+(gender, preferred gender) and ordered by age inside a bucket, so a lookup
+only touches the buckets the seeker is interested in and the age range the
+seeker asked for. Claiming a ticket removes it atomically, so two users can
+never be paired with the same waiting chat.
+
+The backend is chosen with ``settings.MATCHMAKING``. The in-process backend
+is enough for a single server process, the Redis backend shares the queue
+between processes and hosts.
+"""
+import bisect
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from django.conf import settings
+from django.utils.module_loading import import_string
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Age used for users who did not tell it, it never satisfies an age bound
+UNKNOWN_AGE = -1
+
+
+class MatchTicket:
+    """A user's profile and partner preferences for one anonymous chat"""
+    fields = ('chat_id', 'user_id', 'age', 'gender', 'min_age', 'max_age', 'preferred_gender')
+
+    def __init__(self, chat_id=None, user_id=None, age=None, gender=None,
+                 min_age=None, max_age=None, preferred_gender=None):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.age = age
+        self.gender = gender or None
+        self.min_age = min_age
+        self.max_age = max_age
+        self.preferred_gender = preferred_gender or None
+
+    @classmethod
+    def for_chat(cls, chat, user):
+        preferences = chat.preferences or {}
+        return cls(
+            chat_id=chat.id,
+            user_id=user.id,
+            age=user.age,
+            gender=user.gender,
+            min_age=preferences.get('min_age'),
+            max_age=preferences.get('max_age'),
+            preferred_gender=preferences.get('preferred_gender'),
+        )
+
+    @property
+    def score(self):
+        return self.age if self.age is not None else UNKNOWN_AGE
+
+    def age_range(self):
+        """Inclusive range of partner ages this ticket accepts"""
+        low = self.min_age if self.min_age is not None else float('-inf')
+        if self.min_age is None and self.max_age is not None:
+            low = 0
+        high = self.max_age if self.max_age is not None else float('inf')
+        return low, high
+
+    def accepts(self, other):
+        """Whether the partner described by ``other`` fits this ticket's preferences"""
+        if other.user_id is not None and other.user_id == self.user_id:
+            return False
+        if self.preferred_gender and self.preferred_gender != other.gender:
+            return False
+        low, high = self.age_range()
+        return low <= other.score <= high
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+
+class BaseMatchmakingBackend:
+    """Interface of a matchmaking queue"""
+    # Whether waiting tickets survive a restart of the server process
+    persistent = False
+
+    def enqueue(self, ticket):
+        """Put a waiting chat into the queue"""
+        raise NotImplementedError
+
+    def match(self, ticket):
+        """Claim a waiting chat mutually compatible with ``ticket``.
+
+        Returns the claimed ticket, removed from the queue, or None.
+        """
+        raise NotImplementedError
+
+    def remove(self, chat_id):
+        """Drop a chat from the queue, no-op if it is not waiting"""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class InMemoryMatchmakingBackend(BaseMatchmakingBackend):
+    """Process-local queue guarded by a lock"""
+
+    def __init__(self, **options):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # (gender, preferred_gender) -> {'ages': sorted ages, 'queues': {age: OrderedDict}}
+        self.buckets = {}
+        self.tickets = {}
+
+    def enqueue(self, ticket):
+        with self.lock:
+            self._discard(ticket.chat_id)
+            bucket = self.buckets.setdefault(
+                (ticket.gender, ticket.preferred_gender), {'ages': [], 'queues': {}}
+            )
+            queue = bucket['queues'].get(ticket.score)
+            if queue is None:
+                queue = bucket['queues'][ticket.score] = OrderedDict()
+                bisect.insort(bucket['ages'], ticket.score)
+            queue[ticket.chat_id] = ticket
+            self.tickets[ticket.chat_id] = ticket
+
+    def match(self, ticket):
+        low, high = ticket.age_range()
+        with self.lock:
+            for (gender, preferred_gender), bucket in self.buckets.items():
+                if ticket.preferred_gender and gender != ticket.preferred_gender:
+                    continue
+                if preferred_gender and preferred_gender != ticket.gender:
+                    continue
+                ages = bucket['ages']
+                start = bisect.bisect_left(ages, low)
+                end = bisect.bisect_right(ages, high)
+                for age in ages[start:end]:
+                    for candidate in bucket['queues'][age].values():
+                        if candidate.accepts(ticket) and ticket.accepts(candidate):
+                            self._discard(candidate.chat_id)
+                            return candidate
+        return None
+
+    def remove(self, chat_id):
+        with self.lock:
+            self._discard(chat_id)
+
+    def _discard(self, chat_id):
+        ticket = self.tickets.pop(chat_id, None)
+        if ticket is None:
+            return
+        bucket = self.buckets[(ticket.gender, ticket.preferred_gender)]
+        queue = bucket['queues'][ticket.score]
+        del queue[chat_id]
+        if not queue:
+            del bucket['queues'][ticket.score]
+            ages = bucket['ages']
+            del ages[bisect.bisect_left(ages, ticket.score)]
+
+
+class RedisMatchmakingBackend(BaseMatchmakingBackend):
+    """Queue shared between processes.
+
+    Every (gender, preferred_gender) bucket is a sorted set of chat ids
+    scored by age, the tickets themselves are hashes. A ticket is claimed
+    with ZREM, which only one caller can win.
+    """
+    persistent = True
+    batch_size = 50
+
+    def __init__(self, url='redis://127.0.0.1:6379/1', prefix='matchmaking', **options):
+        import redis
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def bucket_key(self, gender, preferred_gender):
+        return f"{self.prefix}:bucket:{gender or ''}:{preferred_gender or ''}"
+
+    def ticket_key(self, chat_id):
+        return f"{self.prefix}:ticket:{chat_id}"
+
+    @property
+    def buckets_key(self):
+        return f"{self.prefix}:buckets"
+
+    def enqueue(self, ticket):
+        bucket = self.bucket_key(ticket.gender, ticket.preferred_gender)
+        mapping = {k: '' if v is None else v for k, v in ticket.to_dict().items()}
+        pipe = self.client.pipeline()
+        pipe.hset(self.ticket_key(ticket.chat_id), mapping=mapping)
+        pipe.zadd(bucket, {ticket.chat_id: ticket.score})
+        pipe.sadd(self.buckets_key, bucket)
+        pipe.execute()
+
+    def match(self, ticket):
+        low, high = ticket.age_range()
+        low = '-inf' if low == float('-inf') else low
+        high = '+inf' if high == float('inf') else high
+        for bucket in self.client.smembers(self.buckets_key):
+            _, gender, preferred_gender = bucket.rsplit(':', 2)
+            if ticket.preferred_gender and gender != ticket.preferred_gender:
+                continue
+            if preferred_gender and preferred_gender != (ticket.gender or ''):
+                continue
+            offset = 0
+            while True:
+                chat_ids = self.client.zrangebyscore(bucket, low, high, start=offset, num=self.batch_size)
+                if not chat_ids:
+                    break
+                pipe = self.client.pipeline()
+                for chat_id in chat_ids:
+                    pipe.hgetall(self.ticket_key(chat_id))
+                for data in pipe.execute():
+                    if not data:
+                        continue
+                    candidate = self.load_ticket(data)
+                    if not (candidate.accepts(ticket) and ticket.accepts(candidate)):
+                        continue
+                    if self.client.zrem(bucket, candidate.chat_id):
+                        self.client.delete(self.ticket_key(candidate.chat_id))
+                        return candidate
+                offset += len(chat_ids)
+        return None
+
+    def remove(self, chat_id):
+        data = self.client.hgetall(self.ticket_key(chat_id))
+        if not data:
+            return
+        ticket = self.load_ticket(data)
+        pipe = self.client.pipeline()
+        pipe.zrem(self.bucket_key(ticket.gender, ticket.preferred_gender), chat_id)
+        pipe.delete(self.ticket_key(chat_id))
+        pipe.execute()
+
+    def clear(self):
+        keys = list(self.client.scan_iter(f"{self.prefix}:*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def load_ticket(self, data):
+        def as_int(value):
+            return int(value) if value not in (None, '') else None
+        return MatchTicket(
+            chat_id=as_int(data.get('chat_id')),
+            user_id=as_int(data.get('user_id')),
+            age=as_int(data.get('age')),
+            gender=data.get('gender'),
+            min_age=as_int(data.get('min_age')),
+            max_age=as_int(data.get('max_age')),
+            preferred_gender=data.get('preferred_gender'),
+        )
+
+
+def load_waiting_tickets():
+    """Tickets for every anonymous chat that is still waiting for a partner"""
+    from .models import Chat, ChatType
+    # A chat whose partner left has one member again, it is over rather than waiting
+    chats = Chat.objects.filter(
+        type=ChatType.ANONYMOUS, participant_count=1, matched_at__isnull=True
+    ).prefetch_related('participants')
+    for chat in chats.iterator(chunk_size=500):
+        yield MatchTicket.for_chat(chat, chat.participants.all()[0])
+
+
+@lru_cache(maxsize=None)
+def get_matchmaker():
+    """The configured matchmaking backend, one instance per process"""
+    config = getattr(settings, 'MATCHMAKING', {})
+    backend_class = import_string(config.get('BACKEND', 'chat.matchmaking.InMemoryMatchmakingBackend'))
+    backend = backend_class(**config.get('OPTIONS', {}))
+    if not backend.persistent:
+        # A fresh process starts with an empty queue, restore it from the database
+        restored = 0
+        for ticket in load_waiting_tickets():
+            backend.enqueue(ticket)
+            restored += 1
+        logger.info(f"Restored {restored} waiting anonymous chats into the matchmaking queue")
+    return backend
@@ -0,0 +1,192 @@
+"""
+Per-endpoint request metrics in the Prometheus text format.
+
+``instrumentation_middleware`` (chat/middleware.py) times every request and
+records, labelled by view and action:
+
+* wall time,
+* number and total time of database queries,
+* time spent turning model instances into response data (serializers and
+  the JSON renderer),
+* time spent getting database connections,
+* response size.
+
+``GET /metrics`` renders the histograms of the process for local scrapers.
+Every process keeps its own histograms, scrape each worker separately.
+
+``settings.QUERY_BUDGETS`` caps the queries of an endpoint. Going over the
+budget is logged, or raises ``QueryBudgetExceeded`` with
+``QUERY_BUDGET_MODE = 'raise'`` (tests).
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestTimings:
+    """Measurements of one request, shared by the threads serving it"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wait = 0.0
+        self.checkouts = 0
+        self.queries = 0
+        self.query_time = 0.0
+        self.serialization = 0.0
+
+    def add_wait(self, wait):
+        with self.lock:
+            self.wait += wait
+            self.checkouts += 1
+
+    def add_query(self, duration):
+        with self.lock:
+            self.queries += 1
+            self.query_time += duration
+
+    def add_serialization(self, duration):
+        with self.lock:
+            self.serialization += duration
+
+
+# Set by the middleware, sync_to_async copies it into the threads running the ORM
+current_timings = ContextVar('request_timings', default=None)
+# True while a serializer is being timed, nested serializers are part of it
+serializing = ContextVar('serializing', default=False)
+
+
+def record_wait(wait):
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add_wait(wait)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper counting the queries of the current request"""
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add_query(time.perf_counter() - started)
+
+
+def timed_serialization(function, *args, **kwargs):
+    """Call ``function``, counting its time as serialization of the current request"""
+    timings = current_timings.get()
+    if timings is None or serializing.get():
+        return function(*args, **kwargs)
+    token = serializing.set(True)
+    started = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        timings.add_serialization(time.perf_counter() - started)
+        serializing.reset(token)
+
+
+class Histogram:
+    """Cumulative histogram with labels, rendered in the Prometheus text format"""
+
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self.series = {}
+
+    def observe(self, label_values, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self.series.items()]
+        for label_values, counts, total in sorted(series):
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return '\n'.join(lines)
+
+
+LABELS = ('view', 'action', 'method')
+
+REQUEST_SECONDS = Histogram('chat_request_duration_seconds', 'Wall time of requests', LABELS, TIME_BUCKETS)
+DB_QUERIES = Histogram('chat_request_db_queries', 'Database queries per request', LABELS, QUERY_BUCKETS)
+DB_QUERY_SECONDS = Histogram('chat_request_db_query_seconds', 'Time in database queries per request', LABELS, TIME_BUCKETS)
+DB_CONNECT_SECONDS = Histogram(
+    'chat_request_db_connect_seconds', 'Time waiting for database connections per request', LABELS, TIME_BUCKETS
+)
+SERIALIZATION_SECONDS = Histogram(
+    'chat_request_serialization_seconds', 'Time in serializers and renderers per request', LABELS, TIME_BUCKETS
+)
+RESPONSE_BYTES = Histogram('chat_response_size_bytes', 'Size of response bodies', LABELS, SIZE_BUCKETS)
+
+HISTOGRAMS = (REQUEST_SECONDS, DB_QUERIES, DB_QUERY_SECONDS, DB_CONNECT_SECONDS, SERIALIZATION_SECONDS, RESPONSE_BYTES)
+
+
+def endpoint_labels(request):
+    """(view, action, method) of a resolved request, e.g. ('ChatViewSet', 'group_chats', 'GET')"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved', '', request.method
+    view = getattr(match.func, 'cls', None) or getattr(match.func, 'view_class', None)
+    # Routers map HTTP methods to viewset actions
+    actions = getattr(match.func, 'actions', None) or {}
+    action = actions.get(request.method.lower(), '')
+    name = view.__name__ if view is not None else match.func.__name__
+    return name, action, request.method
+
+
+def record_request(request, response, duration, timings):
+    labels = endpoint_labels(request)
+    REQUEST_SECONDS.observe(labels, duration)
+    DB_QUERIES.observe(labels, timings.queries)
+    DB_QUERY_SECONDS.observe(labels, timings.query_time)
+    DB_CONNECT_SECONDS.observe(labels, timings.wait)
+    SERIALIZATION_SECONDS.observe(labels, timings.serialization)
+    if not response.streaming:
+        RESPONSE_BYTES.observe(labels, len(response.content))
+    check_query_budget(labels, timings.queries)
+
+
+def check_query_budget(labels, queries):
+    view, action, method = labels
+    budget = settings.QUERY_BUDGETS.get(f"{view}.{action}" if action else view)
+    if budget is None or queries <= budget:
+        return
+    message = f"{view}.{action} ran {queries} queries, its budget is {budget}"
+    if settings.QUERY_BUDGET_MODE == 'raise':
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+def render_metrics():
+    return '\n'.join(histogram.render() for histogram in HISTOGRAMS) + '\n'
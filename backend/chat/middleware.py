@@ -0,0 +1,170 @@
+import gzip
+import re
+import time
+from urllib.parse import parse_qs
+from asgiref.sync import iscoroutinefunction
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from channels.auth import AuthMiddlewareStack
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import sync_and_async_middleware
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+from .authentication import get_user_for_token
+from .metrics import RequestTimings, current_timings, record_request
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+
+@database_sync_to_async
+def get_user_for_raw_token(raw_token):
+    """Resolve an access token to a user, AnonymousUser if it is invalid"""
+    try:
+        return get_user_for_token(AccessToken(raw_token))
+    except (TokenError, AuthenticationFailed) as e:
+        logger.warning(f"Rejected websocket token: {str(e)}")
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """Authenticate websocket connections with a JWT access token.
+
+    Browsers cannot set headers on a WebSocket handshake, so the token is
+    passed in the query string: ``ws://host/ws/chats/1/?token=<access>``.
+    """
+
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        token = query.get('token', [None])[0]
+        if token:
+            scope['user'] = await get_user_for_raw_token(token)
+        return await super().__call__(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    # Session auth still works for the browsable API / admin, JWT wins if given
+    return AuthMiddlewareStack(JWTAuthMiddleware(inner))
+
+
+def report_timings(request, response, started, timings):
+    duration = time.perf_counter() - started
+    response['Server-Timing'] = ', '.join([
+        f'db-connect;dur={timings.wait * 1000:.2f};desc="{timings.checkouts} checkouts"',
+        f'db;dur={timings.query_time * 1000:.2f};desc="{timings.queries} queries"',
+        f'serialize;dur={timings.serialization * 1000:.2f}',
+        f'total;dur={duration * 1000:.2f}',
+    ])
+    if timings.wait * 1000 > settings.DB_CONNECT_WAIT_WARNING_MS:
+        logger.warning(
+            f"{request.method} {request.path} waited {timings.wait * 1000:.0f}ms "
+            f"for {timings.checkouts} database connections"
+        )
+    record_request(request, response, duration, timings)
+    return response
+
+
+@sync_and_async_middleware
+def instrumentation_middleware(get_response):
+    """Time requests, count their queries and report both, see chat/metrics.py"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            started = time.perf_counter()
+            timings = RequestTimings()
+            # ORM calls run in other threads, sync_to_async copies the context there
+            token = current_timings.set(timings)
+            try:
+                response = await get_response(request)
+            finally:
+                current_timings.reset(token)
+            return report_timings(request, response, started, timings)
+    else:
+        def middleware(request):
+            started = time.perf_counter()
+            timings = RequestTimings()
+            token = current_timings.set(timings)
+            try:
+                response = get_response(request)
+            finally:
+                current_timings.reset(token)
+            return report_timings(request, response, started, timings)
+    return middleware
+
+
+# Only API payloads: HTML pages carry CSRF tokens next to reflected input (BREACH)
+COMPRESSIBLE_TYPES = {'application/json', 'application/msgpack'}
+COMPRESSED_PATH_PREFIX = '/api/'
+
+
+def accepted_encodings(header):
+    """Content codings of an Accept-Encoding header with a non-zero q"""
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        match = re.search(r'q=([0-9.]+)', params)
+        try:
+            if match and float(match.group(1)) == 0:
+                continue
+        except ValueError:
+            # Malformed q-value, ignore the entry
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def choose_encoding(header):
+    accepted = accepted_encodings(header)
+    if brotli is not None and ('br' in accepted or '*' in accepted):
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress_response(request, response):
+    """Compress the body with brotli or gzip when it is big enough to be worth it"""
+    if not request.path.startswith(COMPRESSED_PATH_PREFIX):
+        return response
+    if response.streaming or response.has_header('Content-Encoding') or response.status_code in (204, 304):
+        return response
+    if response.get('Content-Type', '').split(';')[0].strip() not in COMPRESSIBLE_TYPES:
+        return response
+    patch_vary_headers(response, ('Accept-Encoding',))
+    options = settings.RESPONSE_COMPRESSION
+    if len(response.content) < options['MIN_BYTES']:
+        return response
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding is None:
+        return response
+    if encoding == 'br':
+        body = brotli.compress(response.content, quality=options['BROTLI_QUALITY'])
+    else:
+        body = gzip.compress(response.content, compresslevel=options['GZIP_LEVEL'], mtime=0)
+    if len(body) >= len(response.content):
+        return response
+    response.content = body
+    response['Content-Length'] = str(len(body))
+    response['Content-Encoding'] = encoding
+    # Same as GZipMiddleware, the compressed body is not byte-identical any more
+    if response.has_header('ETag') and not response['ETag'].startswith('W/'):
+        response['ETag'] = 'W/' + response['ETag']
+    return response
+
+
+@sync_and_async_middleware
+def compression_middleware(get_response):
+    """Negotiate brotli / gzip for API responses, see RESPONSE_COMPRESSION"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            return compress_response(request, await get_response(request))
+    else:
+        def middleware(request):
+            return compress_response(request, get_response(request))
+    return middleware
@@ -0,0 +1,42 @@
+# Generated by Django 5.0.2 on 2026-10-18 05:29
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_participants(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    ChatUser = apps.get_model('chat', 'ChatUser')
+    counts = ChatUser.objects.filter(chat=OuterRef('pk')).order_by().values('chat').annotate(
+        count=Count('id')
+    ).values('count')
+    Chat.objects.update(participant_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chat_preferences'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='participant_count',
+            field=models.PositiveIntegerField(default=0, help_text='Number of ChatUser rows, maintained by add_participant/remove_participant'),
+        ),
+        migrations.RunPython(count_participants, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['type', 'participant_count'], name='chat_type_participants_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatuser',
+            index=models.Index(fields=['chat', 'user'], name='chatuser_chat_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'created_at', 'id'], name='message_chat_created_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.0.2 on 2026-10-18 05:30
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+# 'simple' does no stemming, so it works the same for every language users write in
+CREATE_TRIGGER = """
+CREATE FUNCTION chat_message_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := to_tsvector('pg_catalog.simple', coalesce(NEW.content, ''));
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER chat_message_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF content ON chat_message
+    FOR EACH ROW EXECUTE FUNCTION chat_message_search_vector_update();
+
+UPDATE chat_message SET search_vector = to_tsvector('pg_catalog.simple', coalesce(content, ''));
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS chat_message_search_vector_trigger ON chat_message;
+DROP FUNCTION IF EXISTS chat_message_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_chat_indexes_participant_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+        migrations.AddIndex(
+            model_name='message',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='message_search_vector_idx'),
+        ),
+    ]
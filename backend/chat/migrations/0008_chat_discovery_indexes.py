@@ -0,0 +1,42 @@
+# Generated by Django 5.0.2 on 2026-10-18 05:31
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def collect_interest_ids(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    ChatInterest = apps.get_model('chat', 'ChatInterest')
+    ids = ChatInterest.objects.filter(chat=OuterRef('pk')).order_by().values('chat').annotate(
+        ids=ArrayAgg('interest_id', ordering='interest_id')
+    ).values('ids')
+    Chat.objects.filter(pk__in=ChatInterest.objects.values('chat_id')).update(interest_ids=Subquery(ids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_search_vector'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='chat',
+            name='interest_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), blank=True, default=list, help_text="Copy of the chat's interest ids for indexed discovery, kept in sync by signals", size=None),
+        ),
+        migrations.RunPython(collect_interest_ids, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chat',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='chat_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['interest_ids'], name='chat_interest_ids_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 05:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_chat_discovery_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatuser',
+            name='last_read_message_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 07:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_chatuser_last_read_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='provisional_id',
+            field=models.UUIDField(blank=True, editable=False, null=True, unique=True),
+        ),
+    ]
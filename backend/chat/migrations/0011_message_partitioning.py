@@ -0,0 +1,150 @@
+# Generated by Django 5.0.2 on 2026-10-18 08:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+# chat_message becomes RANGE partitioned by created_at, one partition per
+# month plus a default one. Postgres wants the partition key in every
+# unique constraint, hence the (id, created_at) primary key and the
+# (provisional_id, created_at) unique constraint. Partitioned tables cannot
+# have identity columns before Postgres 17, ids come from a plain sequence.
+PARTITION = """
+ALTER TABLE chat_message RENAME TO chat_message_unpartitioned;
+ALTER TABLE chat_message_unpartitioned RENAME CONSTRAINT chat_message_pkey TO chat_message_unpartitioned_pkey;
+DROP TRIGGER IF EXISTS chat_message_search_vector_trigger ON chat_message_unpartitioned;
+DROP INDEX IF EXISTS message_chat_created_idx;
+DROP INDEX IF EXISTS message_search_vector_idx;
+
+CREATE SEQUENCE chat_message_partitioned_id_seq AS bigint;
+CREATE TABLE chat_message (
+    id bigint NOT NULL DEFAULT nextval('chat_message_partitioned_id_seq'),
+    content text NOT NULL,
+    created_at timestamp with time zone NOT NULL,
+    chat_id bigint NOT NULL,
+    sender_id bigint NOT NULL,
+    search_vector tsvector NULL,
+    provisional_id uuid NULL,
+    CONSTRAINT chat_message_pkey PRIMARY KEY (id, created_at),
+    CONSTRAINT message_provisional_id_uniq UNIQUE (provisional_id, created_at)
+) PARTITION BY RANGE (created_at);
+ALTER SEQUENCE chat_message_partitioned_id_seq OWNED BY chat_message.id;
+
+ALTER TABLE chat_message ADD CONSTRAINT chat_message_chat_id_fk
+    FOREIGN KEY (chat_id) REFERENCES chat_chat (id) DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE chat_message ADD CONSTRAINT chat_message_sender_id_fk
+    FOREIGN KEY (sender_id) REFERENCES chat_user (id) DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX message_chat_created_idx ON chat_message (chat_id, created_at, id);
+CREATE INDEX message_search_vector_idx ON chat_message USING gin (search_vector);
+CREATE INDEX message_sender_idx ON chat_message (sender_id);
+
+CREATE TABLE chat_message_default PARTITION OF chat_message DEFAULT;
+
+DO $$
+DECLARE
+    month timestamp;
+    last_month timestamp := date_trunc('month', now() AT TIME ZONE 'UTC') + interval '3 months';
+BEGIN
+    SELECT date_trunc('month', coalesce(min(created_at), now()) AT TIME ZONE 'UTC')
+        INTO month FROM chat_message_unpartitioned;
+    WHILE month <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF chat_message FOR VALUES FROM (%L) TO (%L)',
+            'chat_message_p' || to_char(month, 'YYYY_MM'),
+            month AT TIME ZONE 'UTC',
+            (month + interval '1 month') AT TIME ZONE 'UTC'
+        );
+        month := month + interval '1 month';
+    END LOOP;
+END
+$$;
+
+INSERT INTO chat_message (id, content, created_at, chat_id, sender_id, search_vector, provisional_id)
+    SELECT id, content, created_at, chat_id, sender_id, search_vector, provisional_id
+    FROM chat_message_unpartitioned;
+SELECT setval('chat_message_partitioned_id_seq', coalesce((SELECT max(id) FROM chat_message), 0) + 1, false);
+DROP TABLE chat_message_unpartitioned;
+
+CREATE TRIGGER chat_message_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF content ON chat_message
+    FOR EACH ROW EXECUTE FUNCTION chat_message_search_vector_update();
+"""
+
+UNPARTITION = """
+ALTER TABLE chat_message RENAME TO chat_message_partitioned;
+ALTER TABLE chat_message_partitioned RENAME CONSTRAINT chat_message_pkey TO chat_message_partitioned_pkey;
+DROP INDEX IF EXISTS message_chat_created_idx;
+DROP INDEX IF EXISTS message_search_vector_idx;
+DROP INDEX IF EXISTS message_sender_idx;
+
+CREATE TABLE chat_message (
+    id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    content text NOT NULL,
+    created_at timestamp with time zone NOT NULL,
+    chat_id bigint NOT NULL REFERENCES chat_chat (id) DEFERRABLE INITIALLY DEFERRED,
+    sender_id bigint NOT NULL REFERENCES chat_user (id) DEFERRABLE INITIALLY DEFERRED,
+    search_vector tsvector NULL,
+    provisional_id uuid NULL UNIQUE
+);
+CREATE INDEX chat_message_chat_id_idx ON chat_message (chat_id);
+CREATE INDEX chat_message_sender_id_idx ON chat_message (sender_id);
+CREATE INDEX message_chat_created_idx ON chat_message (chat_id, created_at, id);
+CREATE INDEX message_search_vector_idx ON chat_message USING gin (search_vector);
+
+INSERT INTO chat_message (id, content, created_at, chat_id, sender_id, search_vector, provisional_id)
+    SELECT id, content, created_at, chat_id, sender_id, search_vector, provisional_id
+    FROM chat_message_partitioned;
+SELECT setval(pg_get_serial_sequence('chat_message', 'id'), coalesce((SELECT max(id) FROM chat_message), 0) + 1, false);
+DROP TABLE chat_message_partitioned;
+
+CREATE TRIGGER chat_message_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF content ON chat_message
+    FOR EACH ROW EXECUTE FUNCTION chat_message_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_message_provisional_id'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(PARTITION, UNPARTITION),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='message',
+                    name='created_at',
+                    field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+                ),
+                migrations.AlterField(
+                    model_name='message',
+                    name='provisional_id',
+                    field=models.UUIDField(blank=True, editable=False, null=True),
+                ),
+                migrations.AddConstraint(
+                    model_name='message',
+                    constraint=models.UniqueConstraint(
+                        fields=('provisional_id', 'created_at'), name='message_provisional_id_uniq'
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedPartition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=63, unique=True)),
+                ('range_start', models.DateTimeField()),
+                ('range_end', models.DateTimeField()),
+                ('path', models.CharField(max_length=500)),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-range_start'],
+            },
+        ),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 5.0.2 on 2026-10-18 06:09
+
+import django.utils.timezone
+from django.db import migrations, models
+
+# Every write to chats, memberships and messages lands in chat_changelogentry,
+# bulk inserts and raw SQL included. Rows moved between partitions by
+# chat/partitions.py are not changes, it turns the log off with
+# SET LOCAL chat.changelog = 'off'. Row triggers on the partitioned
+# chat_message are cloned to every partition, attached later ones too.
+TRIGGERS = """
+CREATE FUNCTION chat_changelog_record() RETURNS trigger AS $$
+DECLARE
+    changed record;
+    chat bigint;
+    member bigint;
+BEGIN
+    IF current_setting('chat.changelog', true) = 'off' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        changed := OLD;
+    ELSE
+        changed := NEW;
+    END IF;
+    IF TG_ARGV[0] = 'chat' THEN
+        chat := changed.id;
+    ELSIF TG_ARGV[0] = 'membership' THEN
+        chat := changed.chat_id;
+        member := changed.user_id;
+    ELSE
+        chat := changed.chat_id;
+    END IF;
+    INSERT INTO chat_changelogentry (txid, kind, object_id, chat_id, user_id, deleted, created_at)
+    VALUES (pg_current_xact_id()::text::bigint, TG_ARGV[0], changed.id, chat, member, TG_OP = 'DELETE', now());
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER chat_chat_changelog AFTER INSERT OR DELETE ON chat_chat
+    FOR EACH ROW EXECUTE FUNCTION chat_changelog_record('chat');
+CREATE TRIGGER chat_chat_changelog_update AFTER UPDATE ON chat_chat
+    FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION chat_changelog_record('chat');
+CREATE TRIGGER chat_chatuser_changelog AFTER INSERT OR DELETE ON chat_chatuser
+    FOR EACH ROW EXECUTE FUNCTION chat_changelog_record('membership');
+CREATE TRIGGER chat_chatuser_changelog_update AFTER UPDATE ON chat_chatuser
+    FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION chat_changelog_record('membership');
+CREATE TRIGGER chat_message_changelog AFTER INSERT OR DELETE ON chat_message
+    FOR EACH ROW EXECUTE FUNCTION chat_changelog_record('message');
+CREATE TRIGGER chat_message_changelog_update AFTER UPDATE ON chat_message
+    FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION chat_changelog_record('message');
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER chat_chat_changelog ON chat_chat;
+DROP TRIGGER chat_chat_changelog_update ON chat_chat;
+DROP TRIGGER chat_chatuser_changelog ON chat_chatuser;
+DROP TRIGGER chat_chatuser_changelog_update ON chat_chatuser;
+DROP TRIGGER chat_message_changelog ON chat_message;
+DROP TRIGGER chat_message_changelog_update ON chat_message;
+DROP FUNCTION chat_changelog_record();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_message_partitioning'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLogEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('txid', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('chat', 'Chat'), ('membership', 'Membership'), ('message', 'Message')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('chat_id', models.BigIntegerField()),
+                ('user_id', models.BigIntegerField(blank=True, null=True)),
+                ('deleted', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['txid', 'id'], name='changelog_txid_idx'), models.Index(fields=['created_at'], name='changelog_created_idx')],
+            },
+        ),
+        migrations.RunSQL(TRIGGERS, DROP_TRIGGERS),
+    ]
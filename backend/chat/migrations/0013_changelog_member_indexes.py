@@ -0,0 +1,21 @@
+# Generated by Django 5.0.2 on 2026-10-18 06:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_changelog'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='changelogentry',
+            index=models.Index(fields=['chat_id', 'txid', 'id'], name='changelog_chat_txid_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='changelogentry',
+            index=models.Index(fields=['user_id', 'txid', 'id'], name='changelog_user_txid_idx'),
+        ),
+    ]
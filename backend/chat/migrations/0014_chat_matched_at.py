@@ -0,0 +1,34 @@
+# Generated by Django 5.0.2 on 2026-10-18 06:28
+
+from django.db import migrations, models
+
+# Anonymous chats that had a partner before the column existed: two members
+# now, or a message from someone who is no longer a member. Not a change
+# clients need to sync, the change log is off for the backfill.
+BACKFILL = """
+SET LOCAL chat.changelog = 'off';
+UPDATE chat_chat AS c SET matched_at = c.created_at
+WHERE c.type = 'ANONYMOUS' AND (
+    c.participant_count > 1
+    OR EXISTS (
+        SELECT 1 FROM chat_message AS m
+        WHERE m.chat_id = c.id
+        AND m.sender_id NOT IN (SELECT cu.user_id FROM chat_chatuser AS cu WHERE cu.chat_id = c.id)
+    )
+);
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_changelog_member_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='matched_at',
+            field=models.DateTimeField(blank=True, help_text='When an anonymous chat got its partner, it never waits in the matchmaking queue again', null=True),
+        ),
+        migrations.RunSQL(BACKFILL, migrations.RunSQL.noop),
+    ]
@@ -1,5 +1,9 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.utils import timezone
 
 class UserRole(models.TextChoices):
@@ -43,13 +47,60 @@ class Chat(models.Model):
         related_name='chats'
     )
     preferences = models.JSONField(null=True, blank=True, help_text="Preferences for anonymous chat matching")
+    participant_count = models.PositiveIntegerField(
+        default=0,
+        help_text="Number of ChatUser rows, maintained by add_participant/remove_participant"
+    )
+    matched_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When an anonymous chat got its partner, it never waits in the matchmaking queue again"
+    )
+    interest_ids = ArrayField(
+        models.BigIntegerField(),
+        default=list,
+        blank=True,
+        help_text="Copy of the chat's interest ids for indexed discovery, kept in sync by signals"
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['type', 'participant_count'], name='chat_type_participants_idx'),
+            GinIndex(fields=['name'], name='chat_name_trgm_idx', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['interest_ids'], name='chat_interest_ids_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name or 'Unnamed'} ({self.type})"
 
+    def add_participant(self, user):
+        """Add a member and bump the stored participant count in one transaction"""
+        with transaction.atomic():
+            # Counter first, so the ChatUser signals see the final state
+            Chat.objects.filter(pk=self.pk).update(participant_count=F('participant_count') + 1)
+            chat_user = ChatUser.objects.create(user=user, chat=self)
+        self.refresh_from_db(fields=['participant_count'])
+        return chat_user
+
+    def refresh_interest_ids(self):
+        """Rebuild the denormalized interest_ids from ChatInterest"""
+        self.interest_ids = list(
+            ChatInterest.objects.filter(chat=self).order_by('interest_id').values_list('interest_id', flat=True)
+        )
+        Chat.objects.filter(pk=self.pk).update(interest_ids=self.interest_ids)
+
+    def remove_participant(self, chat_user):
+        """Remove a member and decrement the stored participant count in one transaction"""
+        with transaction.atomic():
+            Chat.objects.filter(pk=self.pk).update(participant_count=F('participant_count') - 1)
+            chat_user.delete()
+        self.refresh_from_db(fields=['participant_count'])
+
 class Message(models.Model):
+    """Stored in monthly partitions of chat_message, see migration 0011 and chat/partitions.py"""
     content = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Partition key. Set explicitly by the queued writer so replays land on the same row
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     sender = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -60,6 +111,21 @@ class Message(models.Model):
         on_delete=models.CASCADE,
         related_name='messages'
     )
+    # Filled by a database trigger from content, see migration 0007
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Id handed out by the queued write path, makes journal replay idempotent
+    provisional_id = models.UUIDField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Chat history is always read newest first, paginated on (created_at, id)
+            models.Index(fields=['chat', 'created_at', 'id'], name='message_chat_created_idx'),
+            GinIndex(fields=['search_vector'], name='message_search_vector_idx'),
+        ]
+        constraints = [
+            # Unique constraints of a partitioned table must contain the partition key
+            models.UniqueConstraint(fields=['provisional_id', 'created_at'], name='message_provisional_id_uniq'),
+        ]
 
     def __str__(self):
         return f"Message from {self.sender.username} in {self.chat}"
@@ -74,9 +140,14 @@ class ChatUser(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
     joined_at = models.DateTimeField(auto_now_add=True)
+    # Written in batches by chat.presence.ReadReceiptBuffer
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         unique_together = ('user', 'chat')
+        indexes = [
+            models.Index(fields=['chat', 'user'], name='chatuser_chat_user_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} in {self.chat}"
@@ -91,3 +162,50 @@ class ChatInterest(models.Model):
 
     def __str__(self):
         return f"{self.interest} in {self.chat}"
+
+class ArchivedPartition(models.Model):
+    """A month of messages moved out of the database into a compressed file"""
+    name = models.CharField(max_length=63, unique=True)
+    range_start = models.DateTimeField()
+    range_end = models.DateTimeField()
+    path = models.CharField(max_length=500)
+    message_count = models.PositiveIntegerField(default=0)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-range_start']
+
+    def __str__(self):
+        return self.name
+
+class ChangeLogEntry(models.Model):
+    """A write to a chat, membership or message, recorded by database triggers (migration 0012).
+
+    Read by the incremental sync (chat/sync.py). Rows are ordered by
+    (txid, id), ``txid`` being the id of the writing transaction.
+    """
+    class Kind(models.TextChoices):
+        CHAT = 'chat'
+        MEMBERSHIP = 'membership'
+        MESSAGE = 'message'
+
+    txid = models.BigIntegerField()
+    kind = models.CharField(max_length=10, choices=Kind.choices)
+    object_id = models.BigIntegerField()
+    chat_id = models.BigIntegerField()
+    # Member of a membership entry, the only way a user sees the chats they left
+    user_id = models.BigIntegerField(null=True, blank=True)
+    deleted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['txid', 'id'], name='changelog_txid_idx'),
+            # One per branch of the sync query, each reads its entries in order
+            models.Index(fields=['chat_id', 'txid', 'id'], name='changelog_chat_txid_idx'),
+            models.Index(fields=['user_id', 'txid', 'id'], name='changelog_user_txid_idx'),
+            models.Index(fields=['created_at'], name='changelog_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{'delete' if self.deleted else 'upsert'} {self.kind} {self.object_id}"
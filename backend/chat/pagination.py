@@ -0,0 +1,221 @@
+import base64
+from datetime import datetime
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from .models import ChatUser, Message, User
+from .partitions import archived_messages, has_archived_messages
+
+
+def cursor_key(message):
+    """(created_at, id) of a message, instance or values() row"""
+    if isinstance(message, dict):
+        return message['created_at'], message['id']
+    return message.created_at, message.id
+
+
+def message_columns(messages):
+    """Serialized messages as one array per field, the senders side-loaded by id"""
+    columns = {'id': [], 'chat': [], 'sender': [], 'created_at': [], 'content': []}
+    users = {}
+    for message in messages:
+        sender = message['sender']
+        users.setdefault(str(sender['id']), sender)
+        columns['id'].append(message['id'])
+        columns['chat'].append(message['chat'])
+        columns['sender'].append(sender['id'])
+        columns['created_at'].append(message['created_at'])
+        columns['content'].append(message['content'])
+    return columns, users
+
+
+class MessageCursorPagination(BasePagination):
+    """Keyset pagination over (created_at, id).
+
+    Without a cursor the newest page is returned. ``?before=<cursor>`` walks
+    back into the history and ``?after=<cursor>`` walks forward. Every page is
+    a single index range scan, so its cost does not depend on how deep into
+    the history the client is. Results are always in chronological order.
+
+    When the view sets ``archive_chat_id`` and ``archive_user``, pages
+    reaching past the months kept in the database continue into the archive
+    files of that chat, if the user is a member. The archive has no
+    membership filter of its own, the check runs only for pages whose window
+    an archive file of the chat overlaps.
+
+    ``?layout=columns`` returns ``results`` as one array per field and the
+    senders once each in ``users``, a page repeats no keys.
+    """
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    before_query_param = 'before'
+    after_query_param = 'after'
+    invalid_cursor_message = 'Invalid cursor'
+    layout_query_param = 'layout'
+    archive_chat_id = None
+    archive_user = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(self.with_archived(list(self.page_queryset(queryset, request))))
+
+    async def apaginate_queryset(self, queryset, request):
+        """Same as paginate_queryset, for async views over the async ORM"""
+        rows = [row async for row in self.page_queryset(queryset, request)]
+        if self.archive_chat_id is not None:
+            rows = await sync_to_async(self.with_archived)(rows)
+        return self.set_page(rows)
+
+    def page_queryset(self, queryset, request):
+        """The page as an unevaluated queryset, one row over the page size"""
+        self.request = request
+        params = self.get_query_params(request)
+        self.current_page_size = self.get_page_size(request)
+        self.before = before = self.decode_cursor(params.get(self.before_query_param))
+        self.after = self.decode_cursor(params.get(self.after_query_param))
+
+        if self.after is not None:
+            created_at, pk = self.after
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+            ).order_by('created_at', 'id')
+            self.has_next = False
+            self.has_previous = True
+        else:
+            if before is not None:
+                created_at, pk = before
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+                )
+            queryset = queryset.order_by('-created_at', '-id')
+            self.has_previous = False
+            self.has_next = before is not None
+        return queryset[:self.current_page_size + 1]
+
+    def with_archived(self, rows):
+        """Complete the page with archived messages when the database runs short"""
+        limit = self.current_page_size + 1
+        if self.archive_chat_id is None or (self.after is None and len(rows) >= limit):
+            return rows
+        if not self.reaches_archive(rows, limit):
+            return rows
+        if not ChatUser.objects.filter(user=self.archive_user, chat_id=self.archive_chat_id).exists():
+            return rows
+        archived = archived_messages(self.archive_chat_id, before=self.before, after=self.after, limit=limit)
+        if not archived:
+            return rows
+        # Messages of deleted users are gone from the database, they are dropped here as well
+        senders = User.objects.in_bulk({row['sender'] for row in archived})
+        # A partition being archived is in both places for a moment
+        seen = {cursor_key(message)[1] for message in rows}
+        for row in archived:
+            if row['id'] in seen or row['sender'] not in senders:
+                continue
+            rows.append(Message(
+                id=row['id'], chat_id=row['chat'], sender=senders[row['sender']], content=row['content'],
+                created_at=row['created_at'], provisional_id=row['provisional_id'],
+            ))
+        rows.sort(key=cursor_key, reverse=self.after is None)
+        return rows[:limit]
+
+    def reaches_archive(self, rows, limit):
+        """Whether archived messages of the chat could still fall on this page"""
+        if self.after is not None:
+            # Forward pages take what is newer than the cursor, up to the last row once full
+            newer_than, up_to = self.after[0], cursor_key(rows[-1])[0] if len(rows) >= limit else None
+        elif rows:
+            # A short backward page takes what is older than its oldest row
+            newer_than, up_to = None, cursor_key(rows[-1])[0]
+        else:
+            newer_than, up_to = None, self.before[0] if self.before is not None else None
+        return has_archived_messages(self.archive_chat_id, newer_than=newer_than, up_to=up_to)
+
+    def set_page(self, rows):
+        page_size = self.current_page_size
+        if self.after is not None:
+            self.has_next = len(rows) > page_size
+            rows = rows[:page_size]
+        else:
+            self.has_previous = len(rows) > page_size
+            rows = list(reversed(rows[:page_size]))
+        self.page = rows
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_data(self, data):
+        if self.get_query_params(self.request).get(self.layout_query_param) == 'columns':
+            columns, users = message_columns(data)
+            return {
+                'next': self.get_next_link(),
+                'previous': self.get_previous_link(),
+                'results': columns,
+                'users': users,
+            }
+        return {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    @staticmethod
+    def get_query_params(request):
+        # DRF requests and plain Django requests (async views)
+        return getattr(request, 'query_params', request.GET)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(self.get_query_params(request)[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.before_query_param)
+        return replace_query_param(url, self.after_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.after_query_param)
+        return replace_query_param(url, self.before_query_param, self.encode_cursor(self.page[0]))
+
+    def encode_cursor(self, message):
+        created_at, pk = cursor_key(message)
+        raw = f"{created_at.isoformat()}|{pk}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+            created_at, pk = raw.rsplit('|', 1)
+            return datetime.fromisoformat(created_at), int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+class GroupChatPagination(PageNumberPagination):
+    """Page numbers over the ranked group chat discovery results"""
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = 'page_size'
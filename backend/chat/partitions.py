@@ -0,0 +1,350 @@
+"""
+Monthly partitions of chat_message and their cold storage.
+
+The table is RANGE partitioned by ``created_at`` (migration 0011), one
+partition per UTC month named ``chat_message_pYYYY_MM`` plus
+``chat_message_default`` for rows no partition covers.
+
+* ``ensure_partitions`` creates the partitions of the coming months, run it
+  regularly (``manage.py rollover_partitions``).
+* ``archive_partition`` streams an old partition into a gzip JSONL file,
+  records it as an ``ArchivedPartition`` and drops it
+  (``manage.py archive_messages``).
+* ``archived_messages`` reads a chat's messages back from those files, the
+  message list falls back to it when a page reaches into archived months.
+* ``rehydrate_partition`` loads an archived month back into the database
+  (``manage.py rehydrate_messages``).
+
+An archive file is a series of gzip members, one per chat, ordered by
+(created_at, id). A JSON index next to it maps chat ids to the byte range
+of their member, so one chat's history is read without inflating the rest.
+"""
+import json
+import os
+import re
+import zlib
+from datetime import datetime, timezone as dt_timezone
+from functools import lru_cache
+from pathlib import Path
+from django.db import connection, transaction
+from django.utils import timezone
+from .cache import LocalLRUCache
+from .models import ArchivedPartition
+import logging
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = 'chat_message'
+DEFAULT_PARTITION = 'chat_message_default'
+PARTITION_NAME = re.compile(r'^chat_message_p(\d{4})_(\d{2})$')
+COLUMNS = ('id', 'chat_id', 'sender_id', 'content', 'created_at', 'provisional_id')
+GZIP_WBITS = 31
+
+# The archive catalogue changes a few times a month, reads may be a minute stale
+catalogue_cache = LocalLRUCache(max_entries=1, timeout=60)
+
+
+def month_start(value):
+    value = value.astimezone(dt_timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def partition_name(month):
+    return f"{PARENT_TABLE}_p{month:%Y_%m}"
+
+
+def partition_month(name):
+    match = PARTITION_NAME.match(name)
+    if match is None:
+        return None
+    return datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=dt_timezone.utc)
+
+
+def quote(name):
+    return connection.ops.quote_name(name)
+
+
+def list_partitions():
+    """Monthly partitions currently attached, oldest first"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = %s
+            """,
+            [PARENT_TABLE]
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    return sorted(name for name in names if partition_month(name) is not None)
+
+
+def create_partition(month, rows=()):
+    """Attach the partition of ``month``, filled with its rows from the default partition and ``rows``"""
+    name = partition_name(month)
+    start, end = month, add_months(month, 1)
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Moving rows is not a change of the messages, keep them out of the sync change log
+        cursor.execute("SET LOCAL chat.changelog = 'off'")
+        # Built detached and attached at the end, ATTACH only needs a weak lock on the parent
+        cursor.execute(f"CREATE TABLE {quote(name)} (LIKE {PARENT_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        cursor.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s RETURNING *
+            )
+            INSERT INTO {quote(name)} SELECT * FROM moved
+            """,
+            [start, end]
+        )
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= 1000:
+                insert_archived_rows(cursor, name, batch)
+                batch = []
+        if batch:
+            insert_archived_rows(cursor, name, batch)
+        cursor.execute(
+            f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {quote(name)} FOR VALUES FROM (%s) TO (%s)",
+            [start, end]
+        )
+    return name
+
+
+def insert_archived_rows(cursor, table, rows):
+    # The partition has no trigger before it is attached, compute the search vector here
+    cursor.executemany(
+        f"""
+        INSERT INTO {quote(table)} (id, chat_id, sender_id, content, created_at, provisional_id, search_vector)
+        VALUES (%s, %s, %s, %s, %s, %s, to_tsvector('pg_catalog.simple', %s))
+        """,
+        [
+            (row['id'], row['chat'], row['sender'], row['content'], row['created_at'],
+             row['provisional_id'], row['content'])
+            for row in rows
+        ]
+    )
+
+
+def ensure_partitions(months_ahead=3):
+    """Create missing partitions from the current month to ``months_ahead`` months later"""
+    existing = set(list_partitions())
+    current = month_start(timezone.now())
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if partition_name(month) not in existing:
+            created.append(create_partition(month))
+    return created
+
+
+def archive_paths(name, directory):
+    directory = Path(directory)
+    return directory / f"{name}.jsonl.gz", directory / f"{name}.index.json"
+
+
+def write_archive(name, directory):
+    """Stream a partition into its archive file, returns (path, row count)"""
+    data_path, index_path = archive_paths(name, directory)
+    data_path.parent.mkdir(parents=True, exist_ok=True)
+    index = {}
+    count = 0
+    tmp_path = data_path.with_suffix('.tmp')
+
+    def close_member(out, chat_id, compressor, offset, rows):
+        out.write(compressor.flush())
+        index[str(chat_id)] = [offset, out.tell() - offset, rows]
+
+    with open(tmp_path, 'wb') as out, transaction.atomic():
+        cursor = connection.chunked_cursor()
+        cursor.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM {quote(name)} ORDER BY chat_id, created_at, id"
+        )
+        chat_id = compressor = None
+        offset = chat_rows = 0
+        while True:
+            rows = cursor.fetchmany(2000)
+            if not rows:
+                break
+            for message_id, row_chat, sender_id, content, created_at, provisional_id in rows:
+                if row_chat != chat_id:
+                    if compressor is not None:
+                        close_member(out, chat_id, compressor, offset, chat_rows)
+                    chat_id, offset, chat_rows = row_chat, out.tell(), 0
+                    compressor = zlib.compressobj(9, zlib.DEFLATED, GZIP_WBITS)
+                line = json.dumps({
+                    'id': message_id,
+                    'chat': row_chat,
+                    'sender': sender_id,
+                    'content': content,
+                    'created_at': created_at.isoformat(),
+                    'provisional_id': str(provisional_id) if provisional_id else None,
+                })
+                out.write(compressor.compress(line.encode() + b'\n'))
+                chat_rows += 1
+                count += 1
+        if compressor is not None:
+            close_member(out, chat_id, compressor, offset, chat_rows)
+        cursor.close()
+        out.flush()
+        os.fsync(out.fileno())
+
+    # A new file rather than a rewrite, so cached indexes of an earlier archive go stale
+    tmp_index_path = index_path.with_suffix('.tmp')
+    tmp_index_path.write_text(json.dumps(index))
+    os.replace(tmp_index_path, index_path)
+    os.replace(tmp_path, data_path)
+    return data_path, count
+
+
+def archive_partition(name, directory):
+    """Move a monthly partition to cold storage, returns the number of messages"""
+    month = partition_month(name)
+    archived = ArchivedPartition.objects.filter(name=name).first()
+    if archived is None:
+        path, count = write_archive(name, directory)
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {quote(name)}")
+            if cursor.fetchone()[0] != count:
+                raise RuntimeError(f"Partition {name} changed while it was being archived")
+        # Rows are served from the file from now on, the list deduplicates until the drop
+        archived = ArchivedPartition.objects.create(
+            name=name, range_start=month, range_end=add_months(month, 1),
+            path=str(path), message_count=count,
+        )
+        catalogue_cache.clear()
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # DETACH locks the parent exclusively, give up rather than queue behind long queries
+        cursor.execute("SET LOCAL lock_timeout = '5s'")
+        cursor.execute(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {quote(name)}")
+        cursor.execute(f"DROP TABLE {quote(name)}")
+    return archived.message_count
+
+
+def read_archive(path):
+    """Every message of an archive file"""
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    buffer = b''
+    with open(path, 'rb') as data:
+        while True:
+            chunk = decompressor.unconsumed_tail or data.read(1 << 20)
+            if not chunk:
+                break
+            buffer += decompressor.decompress(chunk)
+            if decompressor.eof:
+                # Next gzip member, one per chat
+                rest = decompressor.unused_data
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                if rest:
+                    buffer += decompressor.decompress(rest)
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                yield json.loads(line)
+
+
+def rehydrate_partition(name):
+    """Load an archived month back into the database, returns the number of messages"""
+    archived = ArchivedPartition.objects.get(name=name)
+    create_partition(archived.range_start, rows=read_archive(archived.path))
+    archived.delete()
+    catalogue_cache.clear()
+    return archived.message_count
+
+
+def archived_partitions():
+    catalogue = catalogue_cache.get('partitions')
+    if catalogue is None:
+        catalogue = list(ArchivedPartition.objects.values('name', 'range_start', 'range_end', 'path'))
+        catalogue_cache.set('partitions', catalogue)
+    return catalogue
+
+
+def load_index(path):
+    _, index_path = archive_paths(Path(path).name.removesuffix('.jsonl.gz'), Path(path).parent)
+    # A month rehydrated and archived again gets a new index file, possibly from another process
+    stat = index_path.stat()
+    return read_index(str(index_path), stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=64)
+def read_index(index_path, inode, mtime, size):
+    return json.loads(Path(index_path).read_text())
+
+
+def iter_chat(path, chat_id, read_size=1 << 16):
+    """Messages of one chat in an archive file, decompressed as they are read"""
+    entry = load_index(path).get(str(chat_id))
+    if entry is None:
+        return
+    offset, remaining, _ = entry
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    buffer = b''
+    with open(path, 'rb') as data:
+        data.seek(offset)
+        while remaining:
+            chunk = data.read(min(read_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            *lines, buffer = (buffer + decompressor.decompress(chunk)).split(b'\n')
+            for line in lines:
+                yield json.loads(line)
+
+
+def read_chat(path, chat_id):
+    return list(iter_chat(path, chat_id))
+
+
+def row_key(row):
+    return row['created_at'], row['id']
+
+
+def has_archived_messages(chat_id, newer_than=None, up_to=None):
+    """Whether an archive file holds messages of a chat in the window, from the catalogue and indexes alone"""
+    return any(
+        (newer_than is None or partition['range_end'] > newer_than)
+        and (up_to is None or partition['range_start'] <= up_to)
+        and str(chat_id) in load_index(partition['path'])
+        for partition in archived_partitions()
+    )
+
+
+def archived_messages(chat_id, before=None, after=None, limit=50):
+    """Up to ``limit`` archived messages of a chat next to a (created_at, id) cursor.
+
+    Newest first when walking back from ``before`` (or from the end of the
+    history), oldest first when walking forward from ``after``.
+    """
+    partitions = archived_partitions()
+    if after is not None:
+        candidates = sorted(
+            (p for p in partitions if p['range_end'] > after[0]), key=lambda p: p['range_start']
+        )
+    else:
+        candidates = sorted(
+            (p for p in partitions if before is None or p['range_start'] <= before[0]),
+            key=lambda p: p['range_start'], reverse=True
+        )
+
+    found = []
+    for partition in candidates:
+        rows = read_chat(partition['path'], chat_id)
+        for row in rows:
+            row['created_at'] = datetime.fromisoformat(row['created_at'])
+        if after is not None:
+            rows = [row for row in rows if row_key(row) > tuple(after)]
+        elif before is not None:
+            rows = [row for row in rows if row_key(row) < tuple(before)]
+        found.extend(rows)
+        if len(found) >= limit:
+            break
+    found.sort(key=row_key, reverse=after is None)
+    return found[:limit]
@@ -0,0 +1,232 @@
+"""
+Ephemeral chat signals: who is online, who is typing, who read what.
+
+None of this touches Postgres on the hot path. Presence lives in a store
+with TTL heartbeats (in-process or Redis, see ``settings.PRESENCE``), typing
+notifications are rate limited per connection, and read positions are
+buffered in memory and written to ``ChatUser.last_read_message_id`` in one
+statement every ``READ_FLUSH_INTERVAL`` seconds.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+from .cache import chat_cache, chat_detail_key
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def presence_settings():
+    config = {
+        'BACKEND': 'chat.presence.InMemoryPresenceStore',
+        'OPTIONS': {},
+        'TTL': 30,
+        'TYPING_INTERVAL': 2,
+        'READ_FLUSH_INTERVAL': 5,
+    }
+    config.update(getattr(settings, 'PRESENCE', {}))
+    return config
+
+
+class BasePresenceStore:
+    """Connections per chat, each one alive until its heartbeat expires.
+
+    A user with several tabs open has several connections, the user goes
+    offline when the last one leaves.
+    """
+
+    def __init__(self, ttl=30, **options):
+        self.ttl = ttl
+
+    async def touch(self, chat_id, user_id, channel_name):
+        """Register or refresh a connection"""
+        raise NotImplementedError
+
+    async def leave(self, chat_id, user_id, channel_name):
+        """Drop a connection, returns True if the user has no connections left"""
+        raise NotImplementedError
+
+    async def online(self, chat_id):
+        """Ids of users with at least one live connection"""
+        raise NotImplementedError
+
+    @staticmethod
+    def member(user_id, channel_name):
+        return f"{user_id}|{channel_name}"
+
+    @staticmethod
+    def member_user(member):
+        return int(member.split('|', 1)[0])
+
+
+class InMemoryPresenceStore(BasePresenceStore):
+    """Presence of the connections handled by this process"""
+
+    def __init__(self, ttl=30, **options):
+        super().__init__(ttl=ttl)
+        self.chats = {}
+
+    def alive(self, chat_id):
+        now = time.monotonic()
+        members = self.chats.get(chat_id, {})
+        for member in [m for m, expires in members.items() if expires < now]:
+            del members[member]
+        return members
+
+    async def touch(self, chat_id, user_id, channel_name):
+        self.chats.setdefault(chat_id, {})[self.member(user_id, channel_name)] = time.monotonic() + self.ttl
+
+    async def leave(self, chat_id, user_id, channel_name):
+        members = self.alive(chat_id)
+        members.pop(self.member(user_id, channel_name), None)
+        if not members:
+            self.chats.pop(chat_id, None)
+        return user_id not in {self.member_user(m) for m in members}
+
+    async def online(self, chat_id):
+        return sorted({self.member_user(m) for m in self.alive(chat_id)})
+
+
+class RedisPresenceStore(BasePresenceStore):
+    """Presence shared by every process, one sorted set per chat scored by expiry"""
+
+    def __init__(self, ttl=30, url='redis://127.0.0.1:6379/3', prefix='presence', **options):
+        super().__init__(ttl=ttl)
+        import redis.asyncio
+        self.client = redis.asyncio.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def key(self, chat_id):
+        return f"{self.prefix}:chat:{chat_id}"
+
+    async def touch(self, chat_id, user_id, channel_name):
+        key = self.key(chat_id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {self.member(user_id, channel_name): time.time() + self.ttl})
+            pipe.expire(key, self.ttl * 2)
+            await pipe.execute()
+
+    async def leave(self, chat_id, user_id, channel_name):
+        await self.client.zrem(self.key(chat_id), self.member(user_id, channel_name))
+        return user_id not in await self.online(chat_id)
+
+    async def online(self, chat_id):
+        key = self.key(chat_id)
+        now = time.time()
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zrange(key, 0, -1)
+            _, members = await pipe.execute()
+        return sorted({self.member_user(m) for m in members})
+
+
+@lru_cache(maxsize=None)
+def get_presence_store():
+    config = presence_settings()
+    return import_string(config['BACKEND'])(ttl=config['TTL'], **config['OPTIONS'])
+
+
+class TypingThrottle:
+    """Let a connection broadcast "typing" at most once per interval"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_sent = 0
+
+    def allow(self):
+        now = time.monotonic()
+        if now - self.last_sent < self.interval:
+            return False
+        self.last_sent = now
+        return True
+
+
+class ReadReceiptBuffer:
+    """Highest read message id per (chat, user), flushed to the database in batches"""
+
+    def __init__(self, max_flushed=10000):
+        self.lock = threading.Lock()
+        self.pending = {}
+        # Last position written per key, so a stale report after a flush is still refused.
+        # Least recently written keys are dropped past max_flushed, a stale report for one
+        # of them is buffered again but GREATEST keeps the stored position from going back.
+        self.flushed = OrderedDict()
+        self.max_flushed = max_flushed
+        self.flusher = None
+
+    def position(self, chat_id, user_id):
+        """Highest read message id known for (chat, user), 0 if none"""
+        key = (chat_id, user_id)
+        with self.lock:
+            return max(self.pending.get(key, 0), self.flushed.get(key, 0))
+
+    def record(self, chat_id, user_id, message_id):
+        """Remember a read position, True if it moved forward"""
+        key = (chat_id, user_id)
+        with self.lock:
+            if max(self.pending.get(key, 0), self.flushed.get(key, 0)) >= message_id:
+                return False
+            self.pending[key] = message_id
+        return True
+
+    def flush(self):
+        """Write all buffered positions with one UPDATE, returns the number of rows"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        rows = [(chat_id, user_id, message_id) for (chat_id, user_id), message_id in pending.items()]
+        values = ', '.join(['(%s, %s, %s)'] * len(rows))
+        params = [value for row in rows for value in row]
+        # Positions only move forward, even if a stale client reports an old one
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE chat_chatuser AS cu
+                    SET last_read_message_id = GREATEST(COALESCE(cu.last_read_message_id, 0), v.message_id)
+                    FROM (VALUES {values}) AS v(chat_id, user_id, message_id)
+                    WHERE cu.chat_id = v.chat_id AND cu.user_id = v.user_id
+                    """,
+                    params
+                )
+                rowcount = cursor.rowcount
+        except Exception:
+            # Put the positions back so the next flush retries them
+            for (chat_id, user_id), message_id in pending.items():
+                self.record(chat_id, user_id, message_id)
+            raise
+        # Chat details show the read position of each participant
+        chat_cache.delete_many([chat_detail_key(chat_id) for chat_id in {chat_id for chat_id, _ in pending}])
+        with self.lock:
+            for key, message_id in pending.items():
+                self.flushed[key] = max(self.flushed.get(key, 0), message_id)
+                self.flushed.move_to_end(key)
+            while len(self.flushed) > self.max_flushed:
+                self.flushed.popitem(last=False)
+        return rowcount
+
+    def ensure_flusher(self):
+        """Start the periodic flush task on the running event loop"""
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.get_running_loop().create_task(self.run_flusher())
+
+    async def run_flusher(self):
+        interval = presence_settings()['READ_FLUSH_INTERVAL']
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                flushed = await database_sync_to_async(self.flush)()
+                if flushed:
+                    logger.debug(f"Flushed {flushed} read positions")
+            except Exception as e:
+                logger.error(f"Failed to flush read positions: {str(e)}")
+
+
+read_receipts = ReadReceiptBuffer()
@@ -0,0 +1,82 @@
+import math
+import msgpack
+from rest_framework import renderers
+from .metrics import timed_serialization
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+
+
+def has_non_finite(data):
+    """Whether NaN or an infinity is somewhere in dicts and lists of ``data``"""
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return True
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return False
+
+
+class JSONRenderer(renderers.JSONRenderer):
+    """JSONRenderer reporting its time as serialization time of the request.
+
+    Compact responses are encoded with orjson when it is installed, types
+    orjson does not know (and dates, which DRF formats its own way) go
+    through DRF's encoder so the output is the same. The one difference is
+    floats below 1e-4 or from 1e16 on, written without the exponent padding
+    of ``json`` (``1e16`` instead of ``1e+16``), the same number.
+    orjson writes NaN and infinities as null where the strict stock renderer
+    refuses them, a payload holding one goes through the stock renderer.
+    Indented output and settings orjson cannot follow use the stock renderer.
+    """
+    encoder = renderers.JSONRenderer.encoder_class()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return timed_serialization(self.encode, data, accepted_media_type, renderer_context)
+
+    def encode(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.ensure_ascii or not self.compact or not self.strict:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(
+                data, default=self.encoder.default,
+                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+            )
+        except orjson.JSONEncodeError:
+            # Integers over 64 bits, circular data: let json decide
+            return super().render(data, accepted_media_type, renderer_context)
+        # Only a payload with a null can have had a non-finite float in it
+        if b'null' in ret and has_non_finite(data):
+            return super().render(data, accepted_media_type, renderer_context)
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+
+class MessagePackRenderer(renderers.BaseRenderer):
+    """The JSON payload as MessagePack, asked for with ``Accept: application/msgpack`` or ``?format=msgpack``.
+
+    Dates and other non-JSON types are converted by DRF's encoder, so both
+    formats carry the same values.
+    """
+    media_type = MSGPACK_MEDIA_TYPE
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    encoder = renderers.JSONRenderer.encoder_class()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return timed_serialization(msgpack.packb, data, default=self.encoder.default, use_bin_type=True)
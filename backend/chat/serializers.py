@@ -2,8 +2,43 @@ from rest_framework import serializers
 from .models import User, Chat, Message, Interest, ChatUser, ChatInterest, ChatType
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
-
-class UserSerializer(serializers.ModelSerializer):
+from django.conf import settings
+from django.db.models import Prefetch
+from django.urls import reverse
+from rest_framework.utils.urls import replace_query_param
+from .metrics import timed_serialization
+from .pagination import MessageCursorPagination
+
+
+class EagerLoadingMixin:
+    """Let a serializer declare the relations it renders.
+
+    Viewsets pass their querysets through ``setup_eager_loading`` so that
+    nested serializers read from the prefetch cache instead of issuing one
+    query per row.
+    """
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    # Columns the serializer never renders and that are expensive to load
+    deferred_fields = ()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        if cls.deferred_fields:
+            queryset = queryset.defer(*cls.deferred_fields)
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*cls.prefetch_related_fields)
+        return queryset
+
+class ModelSerializer(serializers.ModelSerializer):
+    """ModelSerializer reporting its time as serialization time of the request"""
+
+    def to_representation(self, instance):
+        return timed_serialization(super().to_representation, instance)
+
+class UserSerializer(ModelSerializer):
     password = serializers.CharField(write_only=True, required=True)
     password2 = serializers.CharField(write_only=True, required=False)
     email = serializers.EmailField(required=False, allow_null=True, allow_blank=True)
@@ -51,26 +86,26 @@ class UserSerializer(serializers.ModelSerializer):
         except Exception as e:
             raise serializers.ValidationError(str(e))
 
-class InterestSerializer(serializers.ModelSerializer):
+class InterestSerializer(ModelSerializer):
     class Meta:
         model = Interest
         fields = ['id', 'interest']
 
-class ChatInterestSerializer(serializers.ModelSerializer):
+class ChatInterestSerializer(ModelSerializer):
     interest = InterestSerializer()
 
     class Meta:
         model = ChatInterest
         fields = ['id', 'interest', 'added_at']
 
-class ChatUserSerializer(serializers.ModelSerializer):
+class ChatUserSerializer(ModelSerializer):
     user = UserSerializer()
 
     class Meta:
         model = ChatUser
-        fields = ['id', 'user', 'joined_at']
+        fields = ['id', 'user', 'joined_at', 'last_read_message_id']
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(EagerLoadingMixin, ModelSerializer):
     sender = UserSerializer(read_only=True)
     chat = serializers.PrimaryKeyRelatedField(queryset=Chat.objects.all())
 
@@ -79,7 +114,31 @@ class MessageSerializer(serializers.ModelSerializer):
         fields = ['id', 'content', 'created_at', 'sender', 'chat']
         read_only_fields = ['created_at', 'sender']
 
-class ChatSerializer(serializers.ModelSerializer):
+    select_related_fields = ('sender',)
+    deferred_fields = ('search_vector',)
+
+class CompactMessageSerializer(ModelSerializer):
+    """Message with the sender as an id, the user itself is side-loaded"""
+    sender = serializers.PrimaryKeyRelatedField(read_only=True)
+    chat = serializers.PrimaryKeyRelatedField(read_only=True)
+
+    class Meta:
+        model = Message
+        fields = ['id', 'content', 'created_at', 'sender', 'chat']
+
+class MessageBulkItemSerializer(serializers.Serializer):
+    """One entry of a bulk message upload, membership is checked by the view"""
+    chat = serializers.IntegerField()
+    content = serializers.CharField()
+
+class MessageSearchSerializer(MessageSerializer):
+    rank = serializers.FloatField(read_only=True)
+    headline = serializers.CharField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['rank', 'headline']
+
+class ChatSerializer(EagerLoadingMixin, ModelSerializer):
     participants = ChatUserSerializer(source='chatuser_set', many=True, read_only=True)
     interests = ChatInterestSerializer(source='chatinterest_set', many=True, read_only=True)
     messages = serializers.SerializerMethodField()
@@ -92,17 +151,67 @@ class ChatSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Chat
-        fields = ['id', 'type', 'name', 'created_at', 'participants', 'interests', 'messages', 'interest_names', 'preferences']
-        read_only_fields = ['created_at']
+        fields = ['id', 'type', 'name', 'created_at', 'participants', 'participant_count', 'interests', 'messages', 'interest_names', 'preferences']
+        read_only_fields = ['created_at', 'participant_count']
 
-    def get_messages(self, obj):
+    prefetch_related_fields = (
+        Prefetch('chatuser_set', queryset=ChatUser.objects.select_related('user').order_by('id')),
+        Prefetch('chatinterest_set', queryset=ChatInterest.objects.select_related('interest').order_by('id')),
+    )
+    # Values of the method fields in the compiled plan (fast_serializers.py), the
+    # history is only embedded in a chat detail response
+    plan_defaults = {'messages': list}
+
+    def embeds_messages(self, obj):
         # Get the chat_id from the request query params
         request = self.context.get('request')
-        if request and request.query_params.get('chat_id') == str(obj.id):
-            messages = Message.objects.filter(chat=obj)
-            return MessageSerializer(messages, many=True).data
+        return bool(request and request.query_params.get('chat_id') == str(obj.id))
+
+    def get_messages(self, obj):
+        # Filled in by to_representation when the history is embedded
         return []
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if self.embeds_messages(instance):
+            data.update(self.get_recent_messages(instance))
+        return data
+
+    def get_recent_messages(self, obj):
+        """Last CHAT_DETAIL_MESSAGES messages, senders side-loaded into ``users``.
+
+        ``messages_previous`` points to the message list endpoint for the
+        older part of the history, None if everything fits.
+        """
+        request = self.context['request']
+        limit = settings.CHAT_DETAIL_MESSAGES
+        messages = list(
+            MessageSerializer.setup_eager_loading(Message.objects.filter(chat=obj))
+            .order_by('-created_at', '-id')[:limit + 1]
+        )
+        has_more = len(messages) > limit
+        messages = list(reversed(messages[:limit]))
+
+        users = {}
+        for message in messages:
+            if message.sender_id not in users:
+                users[message.sender_id] = UserSerializer(message.sender).data
+
+        previous = None
+        if has_more:
+            url = request.build_absolute_uri(reverse('message-list'))
+            url = replace_query_param(url, 'chat', obj.id)
+            previous = replace_query_param(
+                url, MessageCursorPagination.before_query_param,
+                MessageCursorPagination().encode_cursor(messages[0])
+            )
+
+        return {
+            'messages': CompactMessageSerializer(messages, many=True).data,
+            'users': {str(pk): user for pk, user in users.items()},
+            'messages_previous': previous,
+        }
+
     def create(self, validated_data):
         interest_names = validated_data.pop('interest_names', [])
         chat = super().create(validated_data)
@@ -0,0 +1,63 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .authentication import invalidate_user
+from .cache import INTEREST_LIST_KEY, chat_cache, chat_detail_key
+from .models import Chat, ChatInterest, ChatUser, Interest, User
+
+# User fields a chat renders for its participants
+PARTICIPANT_FIELDS = frozenset({'username', 'age', 'gender', 'role', 'email'})
+
+
+@receiver(post_save, sender=ChatInterest)
+@receiver(post_delete, sender=ChatInterest)
+def sync_chat_interest_ids(sender, instance, **kwargs):
+    """Keep Chat.interest_ids in step with the ChatInterest rows"""
+    chat = Chat.objects.filter(pk=instance.chat_id).first()
+    if chat is not None:
+        chat.refresh_interest_ids()
+
+
+@receiver(post_save, sender=Chat)
+@receiver(post_delete, sender=Chat)
+def invalidate_chat(sender, instance, **kwargs):
+    # After commit: a read in between would cache the old row again under the fresh key
+    key = chat_detail_key(instance.pk)
+    transaction.on_commit(lambda: chat_cache.delete(key))
+
+
+@receiver(post_save, sender=ChatUser)
+@receiver(post_delete, sender=ChatUser)
+@receiver(post_save, sender=ChatInterest)
+@receiver(post_delete, sender=ChatInterest)
+def invalidate_chat_relation(sender, instance, **kwargs):
+    key = chat_detail_key(instance.chat_id)
+    transaction.on_commit(lambda: chat_cache.delete(key))
+
+
+@receiver(post_save, sender=Interest)
+@receiver(post_delete, sender=Interest)
+def invalidate_interest(sender, instance, **kwargs):
+    # Chats render interest names, so their cached copies go as well
+    chat_ids = Chat.objects.filter(interest_ids__contains=[instance.pk]).values_list('pk', flat=True)
+    keys = [INTEREST_LIST_KEY] + [chat_detail_key(pk) for pk in chat_ids]
+    transaction.on_commit(lambda: chat_cache.delete_many(keys))
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_chats(sender, instance, created=False, update_fields=None, **kwargs):
+    # A login saves only last_login, nothing the chats show. Deleting a user
+    # deletes its ChatUser rows, which invalidate their chats themselves
+    if created or (update_fields is not None and PARTICIPANT_FIELDS.isdisjoint(update_fields)):
+        return
+    keys = [chat_detail_key(pk) for pk in ChatUser.objects.filter(user=instance).values_list('chat_id', flat=True)]
+    if keys:
+        transaction.on_commit(lambda: chat_cache.delete_many(keys))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_claims(sender, instance, created=False, **kwargs):
+    # A new user has no tokens yet
+    if not created:
+        invalidate_user(instance.pk)
@@ -0,0 +1,143 @@
+"""
+Incremental sync: what changed in a user's chats since a version token.
+
+Database triggers (migration 0012) append every insert, update and delete
+of chats, memberships and messages to ``ChangeLogEntry``. A sync reads the
+entries after the client's position, keeps the last change of each object
+and returns the current state of what still exists plus tombstones for
+what is gone.
+
+Entries are read in (txid, id) order, only from transactions that no
+snapshot can still see running (``txid`` below the xmin of the current
+snapshot). Ids are handed out before commit, so a plain id watermark could
+step over an entry committed late, a transaction watermark cannot. A long
+transaction that wrote something delays the sync of everyone until it
+ends, reads alone do not.
+
+The token is opaque to clients: (txid, id) of the last entry delivered and
+the time it was issued. Tokens older than SYNC['TOKEN_MAX_AGE'] are
+refused with 410 Gone, the client reloads from scratch.
+"""
+import base64
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from .fast_serializers import get_plan
+from .models import ChangeLogEntry, Chat, ChatUser, Message
+from .serializers import ChatSerializer, MessageSerializer
+
+
+class VersionExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = 'Version too old, reload the chats'
+    default_code = 'version_expired'
+
+
+def current_horizon():
+    """Transaction id below which every transaction has ended"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+        return cursor.fetchone()[0]
+
+
+def encode_version(txid, pk):
+    raw = f"{txid}|{pk}|{int(timezone.now().timestamp())}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_version(version):
+    try:
+        raw = base64.urlsafe_b64decode(version.encode()).decode()
+        txid, pk, issued = (int(part) for part in raw.split('|'))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValidationError({'since': ['Invalid version']})
+    if datetime.fromtimestamp(issued, dt_timezone.utc) < timezone.now() - settings.SYNC['TOKEN_MAX_AGE']:
+        raise VersionExpired()
+    return txid, pk
+
+
+def serialize(serializer_class, queryset):
+    if settings.FAST_SERIALIZATION:
+        plan = get_plan(serializer_class)
+        return plan.represent(plan.values(queryset))
+    return serializer_class(serializer_class.setup_eager_loading(queryset), many=True).data
+
+
+def member_chats(user):
+    return ChatUser.objects.filter(user=user).values('chat_id')
+
+
+def changes_since(user, since=None, limit=None):
+    """Changes of ``user``'s chats after the version ``since``, everything they can see without it"""
+    limit = limit or settings.SYNC['MAX_CHANGES']
+    horizon = current_horizon()
+    if since is None:
+        # Changes written from here on are replayed by the next sync, nothing is missed
+        return {
+            'version': encode_version(horizon, 0),
+            'chats': serialize(ChatSerializer, Chat.objects.filter(id__in=member_chats(user)).order_by('id')),
+            'messages': [],
+            'deleted': {'chats': [], 'memberships': [], 'messages': []},
+            'has_more': False,
+        }
+
+    txid, pk = decode_version(since)
+    # txid >= since is redundant with the OR but bounds the index range scans
+    after = (
+        ChangeLogEntry.objects.filter(Q(txid__gt=txid) | Q(txid=txid, id__gt=pk))
+        .filter(txid__gte=txid, txid__lt=horizon)
+        .order_by('txid', 'id')
+        .values_list('id', 'txid', 'kind', 'object_id', 'chat_id', 'user_id', 'deleted')
+    )
+    # An OR of chat and user can use neither index, each branch of the UNION reads its own in order
+    entries = list(
+        after.filter(chat_id__in=member_chats(user))[:limit + 1]
+        .union(after.filter(user_id=user.id)[:limit + 1])
+        .order_by('txid', 'id')[:limit + 1]
+    )
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    chats, deleted_chats = set(), set()
+    deleted_memberships = set()
+    messages, deleted_messages = {}, {}
+    for _, _, kind, object_id, chat_id, member_id, deleted in entries:
+        if kind == ChangeLogEntry.Kind.MESSAGE:
+            (deleted_messages if deleted else messages)[object_id] = chat_id
+            (messages if deleted else deleted_messages).pop(object_id, None)
+            continue
+        if deleted and (kind == ChangeLogEntry.Kind.CHAT or member_id == user.id):
+            # The chat is gone for this user, whether it was deleted or they left it
+            deleted_chats.add(chat_id)
+            chats.discard(chat_id)
+            continue
+        deleted_chats.discard(chat_id)
+        chats.add(chat_id)
+        if kind == ChangeLogEntry.Kind.MEMBERSHIP and deleted:
+            deleted_memberships.add(object_id)
+
+    if has_more:
+        version = encode_version(entries[-1][1], entries[-1][0])
+    else:
+        version = encode_version(horizon, 0)
+    visible = member_chats(user)
+    return {
+        'version': version,
+        'chats': serialize(
+            ChatSerializer, Chat.objects.filter(id__in=list(chats)).filter(id__in=visible).order_by('id')
+        ) if chats else [],
+        'messages': serialize(
+            MessageSerializer,
+            Message.objects.filter(id__in=list(messages)).filter(chat_id__in=visible).order_by('created_at', 'id')
+        ) if messages else [],
+        'deleted': {
+            'chats': sorted(deleted_chats),
+            'memberships': sorted(deleted_memberships),
+            'messages': sorted(pk for pk, chat_id in deleted_messages.items() if chat_id not in deleted_chats),
+        },
+        'has_more': has_more,
+    }
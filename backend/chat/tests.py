@@ -1,3 +1,1079 @@
-from django.test import TestCase
+import collections
+import gzip
+import json
+import msgpack
+import os
+import tempfile
+from pathlib import Path
+from unittest import mock
+import psycopg2
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.db.models import Q
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, TokenError
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken
+from .authentication import ChatRefreshToken, get_user_for_token, user_cache
+from .benchmark import MatchmakingStorm, drop_dataset, generate_dataset
+from .blacklist import compact_expired_tokens, get_token_blacklist
+from .cache import chat_cache
+from .cleanup import collect_stale_anonymous
+from .db.pool import ConnectionPool
+from .export import export_rows
+from .layers import HashRing
+from .metrics import QueryBudgetExceeded
+from .matchmaking import InMemoryMatchmakingBackend, MatchTicket, get_matchmaker, load_waiting_tickets
+from .models import User, Chat, ChatUser, ChatInterest, Interest, Message, ChatType, ArchivedPartition
+from .presence import ReadReceiptBuffer, get_presence_store, read_receipts
+from .partitions import (
+    add_months, archive_partition, archive_paths, catalogue_cache, create_partition, list_partitions,
+    load_index, month_start, rehydrate_partition,
+)
+from .renderers import JSONRenderer
+from .routing import websocket_urlpatterns
+from .views import MessageViewSet
+from .writer import MessageWriter
 
-# Create your tests here.
+
+@override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    QUERY_BUDGET_MODE='raise',
+)
+class ChatQueryCountTests(TestCase):
+    """Chat endpoints must not issue more queries as the data grows"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='viewer', password='pass', role='USER', age=25, gender='male')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.interest = Interest.objects.create(interest='music')
+        self.created = 0
+        get_matchmaker.cache_clear()
+        get_matchmaker()
+        chat_cache.clear()
+
+    def create_chats(self, count, members=3, join=False):
+        chats = []
+        for _ in range(count):
+            self.created += 1
+            chat = Chat.objects.create(name=f"chat {self.created}", type=ChatType.GROUP)
+            for n in range(members):
+                member = User.objects.create_user(username=f"member_{self.created}_{n}", password='pass', role='USER')
+                ChatUser.objects.create(user=member, chat=chat)
+                Message.objects.create(chat=chat, sender=member, content='hello')
+            if join:
+                ChatUser.objects.create(user=self.user, chat=chat)
+            ChatInterest.objects.create(chat=chat, interest=self.interest)
+            chats.append(chat)
+        return chats
+
+    def count_queries(self, method, *args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            response = method(*args, **kwargs)
+        self.assertLess(response.status_code, 300, response.content)
+        return len(context)
+
+    def assertConstantQueries(self, request, grow):
+        small = self.count_queries(*request())
+        grow()
+        large = self.count_queries(*request())
+        self.assertEqual(small, large)
+
+    def test_list(self):
+        self.create_chats(2, join=True)
+        self.assertConstantQueries(
+            lambda: (self.client.get, '/api/chats/'),
+            lambda: self.create_chats(10, members=5, join=True),
+        )
+
+    def test_retrieve(self):
+        chat = self.create_chats(1)[0]
+
+        def grow():
+            for n in range(10):
+                member = User.objects.create_user(username=f"extra_{n}", password='pass')
+                ChatUser.objects.create(user=member, chat=chat)
+                Message.objects.create(chat=chat, sender=member, content='hi')
+
+        self.assertConstantQueries(
+            lambda: (self.client.get, f'/api/chats/{chat.id}/', {'chat_id': chat.id}),
+            grow,
+        )
+
+    def test_group_chats(self):
+        self.create_chats(2)
+        self.assertConstantQueries(
+            lambda: (self.client.get, '/api/chats/group_chats/', {'interests': ['music'], 'min_participants': 1}),
+            lambda: self.create_chats(10, members=5),
+        )
+
+    def test_join_chat(self):
+        small = self.create_chats(1, members=2)[0]
+        large = self.create_chats(1, members=15)[0]
+        self.assertEqual(
+            self.count_queries(self.client.post, f'/api/chats/{small.id}/join_chat/'),
+            self.count_queries(self.client.post, f'/api/chats/{large.id}/join_chat/'),
+        )
+
+    def test_find_anonymous_chat(self):
+        def waiting_chats(count):
+            for n in range(count):
+                self.created += 1
+                waiting = User.objects.create_user(
+                    username=f"anon_{self.created}", password='pass', role='ANONYMOUS', age=30, gender='female'
+                )
+                client = APIClient()
+                client.force_authenticate(waiting)
+                client.post('/api/chats/find_anonymous_chat/', {'preferred_gender': 'male'}, format='json')
+
+        def request():
+            seeker = User.objects.create_user(
+                username=f"seeker_{self.created}", password='pass', role='ANONYMOUS', age=25, gender='male'
+            )
+            self.created += 1
+            client = APIClient()
+            client.force_authenticate(seeker)
+            return client.post, '/api/chats/find_anonymous_chat/', {'preferred_gender': 'female'}, 'json'
+
+        waiting_chats(2)
+        self.assertConstantQueries(request, lambda: waiting_chats(20))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class GroupChatSearchTests(TestCase):
+    def setUp(self):
+        for name in ('Python lovers', 'Pythonistas', 'Cooking 50%_off', 'Gardening'):
+            Chat.objects.create(name=name, type=ChatType.GROUP)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='searcher', password='pass'))
+
+    def search(self, name):
+        results = self.client.get('/api/chats/group_chats/', {'name': name}).json()['results']
+        return [chat['name'] for chat in results]
+
+    def test_name_search(self):
+        self.assertEqual(sorted(self.search('PYTHON')), ['Python lovers', 'Pythonistas'])
+        self.assertIn('Python lovers', self.search('pyton lovers'))
+        # LIKE wildcards in the query are literal
+        self.assertEqual(self.search('50%_'), ['Cooking 50%_off'])
+        self.assertEqual(self.search('0%off'), [])
+
+    def test_name_search_uses_trigram_index(self):
+        queryset = Chat.objects.filter(Q(name__trgm_icontains='python') | Q(name__trigram_similar='python'))
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            if cursor.fetchone() is None:
+                self.skipTest('pg_trgm is not installed')
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        self.assertIn('chat_name_trgm_idx', queryset.explain())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='pass', role='USER')
+        self.chat = Chat.objects.create(name='search', type=ChatType.GROUP)
+        self.chat.add_participant(self.user)
+        for n in range(3):
+            Message.objects.create(chat=self.chat, sender=self.user, content=f"deploy number {n}")
+        Message.objects.create(chat=self.chat, sender=self.user, content='<b>deploy</b> when 1 < 2 & "ready"')
+        hidden = Chat.objects.create(name='hidden', type=ChatType.GROUP)
+        Message.objects.create(chat=hidden, sender=self.user, content='deploy elsewhere')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        response = self.client.get('/api/messages/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_member_chats_only(self):
+        results = self.search(q='deploy')
+        self.assertEqual(len(results), 4)
+        self.assertEqual({message['chat'] for message in results}, {self.chat.id})
+        self.assertEqual(self.search(q='elsewhere'), [])
+        self.assertEqual(self.client.get('/api/messages/search/').status_code, 400)
+
+    def test_limit_is_clamped(self):
+        self.assertEqual(len(self.search(q='deploy', limit=2)), 2)
+        self.assertEqual(len(self.search(q='deploy', limit=0)), 1)
+        self.assertEqual(len(self.search(q='deploy', limit=-5)), 1)
+        self.assertEqual(len(self.search(q='deploy', limit='many')), 4)
+
+    def test_headline_is_escaped(self):
+        [result] = self.search(q='ready')
+        # Only the highlight is markup, the fragment bounds are ts_headline's
+        self.assertIn('deploy&lt;/b&gt; when 1 &lt; 2 &amp; &quot;<mark>ready</mark>', result['headline'])
+        self.assertNotIn('</b>', result['headline'])
+        self.assertEqual(result['content'], '<b>deploy</b> when 1 < 2 & "ready"')
+
+
+class MatchmakingTests(SimpleTestCase):
+    def setUp(self):
+        self.queue = InMemoryMatchmakingBackend()
+        self.queue.enqueue(MatchTicket(chat_id=1, user_id=1, age=30, gender='female', min_age=20, max_age=40, preferred_gender='male'))
+        self.queue.enqueue(MatchTicket(chat_id=2, user_id=2, age=50, gender='female'))
+
+    def test_match_is_mutual(self):
+        # Chat 1 wants a partner of 20-40, so a 45 year old gets chat 2
+        seeker = MatchTicket(user_id=3, age=45, gender='male', preferred_gender='female')
+        self.assertEqual(self.queue.match(seeker).chat_id, 2)
+        self.assertIsNone(self.queue.match(seeker))
+
+    def test_claimed_ticket_leaves_queue(self):
+        seeker = MatchTicket(user_id=3, age=25, gender='male', min_age=18, max_age=35)
+        self.assertEqual(self.queue.match(seeker).chat_id, 1)
+        self.assertIsNone(self.queue.match(MatchTicket(user_id=4, age=25, gender='male', max_age=35)))
+
+    def test_removed_ticket_is_not_matched(self):
+        self.queue.remove(2)
+        self.assertIsNone(self.queue.match(MatchTicket(user_id=3, age=60, gender='female')))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AnonymousMatchTests(TestCase):
+    def setUp(self):
+        get_matchmaker.cache_clear()
+        self.addCleanup(get_matchmaker.cache_clear)
+
+    def find(self, username, gender, preferred_gender):
+        user = User.objects.create_user(username=username, password='pass', role='ANONYMOUS', age=30, gender=gender)
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post('/api/chats/find_anonymous_chat/', {'preferred_gender': preferred_gender}, format='json')
+        return user, client, response
+
+    def test_chat_left_by_partner_is_not_restored(self):
+        waiting = [self.find(f"waiting_{n}", 'female', 'male')[2].json()['id'] for n in range(2)]
+        _, partner, response = self.find('partner', 'male', 'female')
+        matched = response.json()['id']
+        self.assertEqual(response.json()['participant_count'], 2)
+        partner.post(f"/api/chats/{matched}/leave_chat/")
+        self.assertEqual(Chat.objects.get(pk=matched).participant_count, 1)
+
+        # Both chats have one member, only the one that never had a partner is waiting
+        self.assertEqual([ticket.chat_id for ticket in load_waiting_tickets()], [n for n in waiting if n != matched])
+
+    def test_failed_match_puts_ticket_back(self):
+        _, _, waiting = self.find('waiting', 'female', 'male')
+        with mock.patch.object(Chat, 'add_participant', side_effect=psycopg2.OperationalError('gone')):
+            _, _, response = self.find('unlucky', 'male', 'female')
+        self.assertEqual(response.status_code, 500)
+        self.assertIsNone(Chat.objects.get(pk=waiting.json()['id']).matched_at)
+
+        _, _, response = self.find('partner', 'male', 'female')
+        self.assertEqual(response.json()['id'], waiting.json()['id'])
+        self.assertIsNotNone(Chat.objects.get(pk=waiting.json()['id']).matched_at)
+
+
+class HashRingTests(SimpleTestCase):
+    nodes = ['redis-a:6379/0', 'redis-b:6379/0', 'redis-c:6379/0']
+    groups = [f"chat_{n}" for n in range(3000)]
+
+    def assignment(self, nodes):
+        ring = HashRing(nodes)
+        return {group: nodes[ring.node(group)] for group in self.groups}
+
+    def test_assignment_is_stable(self):
+        self.assertEqual(self.assignment(self.nodes), self.assignment(list(self.nodes)))
+        # Positions depend on the node names, not on their order
+        self.assertEqual(self.assignment(self.nodes), self.assignment(list(reversed(self.nodes))))
+        shares = collections.Counter(self.assignment(self.nodes).values())
+        self.assertEqual(set(shares), set(self.nodes))
+        self.assertGreater(min(shares.values()), len(self.groups) / len(self.nodes) * 0.8)
+
+    def test_added_node_moves_few_groups(self):
+        before = self.assignment(self.nodes)
+        after = self.assignment(self.nodes + ['redis-d:6379/0'])
+        moved = [group for group in self.groups if before[group] != after[group]]
+        # Only groups taken over by the new node move, about a quarter of them
+        self.assertEqual({after[group] for group in moved}, {'redis-d:6379/0'})
+        self.assertLess(len(moved), len(self.groups) * 0.35)
+        self.assertGreater(len(moved), len(self.groups) * 0.15)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ChatCacheTests(TestCase):
+    def setUp(self):
+        chat_cache.clear()
+        self.user = User.objects.create_user(username='viewer', password='pass', role='USER')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.chat = Chat.objects.create(name='cached', type=ChatType.GROUP)
+
+    def test_etag_not_modified(self):
+        response = self.client.get(f'/api/chats/{self.chat.id}/')
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/api/chats/{self.chat.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_membership_change_invalidates(self):
+        etag = self.client.get(f'/api/chats/{self.chat.id}/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat.add_participant(self.user)
+        response = self.client.get(f'/api/chats/{self.chat.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['participant_count'], 1)
+
+    def test_participant_change_invalidates(self):
+        self.chat.add_participant(self.user)
+        etag = self.client.get(f'/api/chats/{self.chat.id}/')['ETag']
+        self.user.last_login = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.user.save(update_fields=['last_login'])
+        self.assertEqual(callbacks, [])
+
+        self.user.username = 'renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        response = self.client.get(f'/api/chats/{self.chat.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['participants'][0]['user']['username'], 'renamed')
+
+    def test_read_position_flush_invalidates(self):
+        self.chat.add_participant(self.user)
+        message = Message.objects.create(chat=self.chat, sender=self.user, content='read me')
+        etag = self.client.get(f'/api/chats/{self.chat.id}/')['ETag']
+        buffer = ReadReceiptBuffer()
+        buffer.record(self.chat.id, self.user.id, message.id)
+        buffer.flush()
+        response = self.client.get(f'/api/chats/{self.chat.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['participants'][0]['last_read_message_id'], message.id)
+
+    def test_interest_rename_invalidates_list(self):
+        interest = Interest.objects.create(interest='chess')
+        self.client.get('/api/interests/')
+        interest.interest = 'go'
+        with self.captureOnCommitCallbacks(execute=True):
+            interest.save()
+        self.assertEqual(self.client.get('/api/interests/').data[0]['interest'], 'go')
+
+    def test_invalidated_after_commit(self):
+        etag = self.client.get(f'/api/chats/{self.chat.id}/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.chat.name = 'renamed'
+            self.chat.save()
+            # Still in the transaction: a reader caching now would keep the old row
+            self.assertEqual(
+                self.client.get(f'/api/chats/{self.chat.id}/', HTTP_IF_NONE_MATCH=etag).status_code, 304
+            )
+        self.assertEqual(len(callbacks), 1)
+        response = self.client.get(f'/api/chats/{self.chat.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['name'], 'renamed')
+
+
+class MessageWriterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer', password='pass', role='USER')
+        self.chat = Chat.objects.create(name='queued', type=ChatType.GROUP)
+        journal_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(journal_dir.cleanup)
+        self.journal_dir = journal_dir.name
+
+    def test_flush_keeps_order(self):
+        writer = MessageWriter(journal_dir=self.journal_dir, fsync=False)
+        entries = [writer.submit(self.chat.id, self.user.id, f"message {n}") for n in range(3)]
+        writer.flush()
+        messages = list(Message.objects.filter(chat=self.chat).order_by('id'))
+        self.assertEqual([str(m.provisional_id) for m in messages], [e.provisional_id for e in entries])
+        self.assertEqual(writer.journal.path.stat().st_size, 0)
+
+    def test_written_segments_are_deleted_while_queue_is_busy(self):
+        writer = MessageWriter(batch_size=2, flush_interval=0, journal_dir=self.journal_dir, fsync=False)
+        for n in range(3):
+            writer.submit(self.chat.id, self.user.id, f"message {n}")
+        first = writer.journal.path
+        batch = writer.take_batch()
+        writer.submit(self.chat.id, self.user.id, 'message 3')
+        writer.write(batch, broadcast=False)
+        writer.acknowledge(batch)
+        # message 2 is still queued from the first segment
+        self.assertTrue(first.exists())
+
+        batch = writer.take_batch()
+        writer.submit(self.chat.id, self.user.id, 'message 4')
+        writer.write(batch, broadcast=False)
+        writer.acknowledge(batch)
+        # The queue never ran empty, only the unwritten message is left on disk
+        self.assertEqual(len(writer.queue), 1)
+        self.assertEqual([path.name for path in Path(self.journal_dir).iterdir()], [writer.journal.path.name])
+        self.assertEqual(len(writer.journal.path.read_text().splitlines()), 1)
+
+    def test_replay_skips_written_messages(self):
+        crashed = MessageWriter(journal_dir=self.journal_dir, fsync=False)
+        entries = [crashed.submit(self.chat.id, self.user.id, f"message {n}") for n in range(2)]
+        # The first message made it to the database before the process died
+        crashed.write(entries[:1])
+        crashed.journal.file.close()
+
+        MessageWriter(journal_dir=self.journal_dir, fsync=False).replay()
+        self.assertEqual(Message.objects.filter(chat=self.chat).count(), 2)
+        self.assertFalse(crashed.journal.path.exists())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class MessagePaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='pager', password='pass', role='USER')
+        self.chat = Chat.objects.create(name='pages', type=ChatType.GROUP)
+        self.chat.add_participant(self.user)
+        messages = [Message.objects.create(chat=self.chat, sender=self.user, content=f"m{n}") for n in range(8)]
+        # Four messages in the same instant, the id breaks the tie
+        Message.objects.filter(pk__in=[m.pk for m in messages[2:6]]).update(created_at=messages[2].created_at)
+        self.expected = [m.content for m in Message.objects.filter(chat=self.chat).order_by('created_at', 'id')]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def walk(self, url, link):
+        pages = []
+        while url:
+            page = self.client.get(url).json()
+            pages.append([m['content'] for m in page['results']])
+            url = page[link]
+        return pages
+
+    def test_before_and_after(self):
+        backwards = self.walk(f'/api/messages/?chat={self.chat.id}&page_size=3', 'previous')
+        self.assertEqual([len(page) for page in backwards], [3, 3, 2])
+        self.assertEqual([m for page in reversed(backwards) for m in page], self.expected)
+
+        oldest = self.client.get(f'/api/messages/?chat={self.chat.id}&page_size=3').json()
+        while oldest['previous']:
+            oldest = self.client.get(oldest['previous']).json()
+        self.assertIsNone(oldest['previous'])
+        forwards = self.walk(oldest['next'], 'next')
+        self.assertEqual([m['content'] for m in oldest['results']] + [m for page in forwards for m in page], self.expected)
+        # Walking forward ends on the newest page
+        self.assertEqual(forwards[-1][-1], self.expected[-1])
+
+    def test_page_boundary_inside_a_tie(self):
+        # page_size=2 puts page boundaries between messages with the same created_at
+        pages = self.walk(f'/api/messages/?chat={self.chat.id}&page_size=2', 'previous')
+        self.assertEqual([m for page in reversed(pages) for m in page], self.expected)
+
+    def test_invalid_cursor(self):
+        for param in ('before', 'after'):
+            for cursor in ('garbage!', 'bm90IGEgY3Vyc29y', ''):
+                response = self.client.get('/api/messages/', {'chat': self.chat.id, param: cursor})
+                self.assertEqual(response.status_code, 200 if cursor == '' else 404, (param, cursor))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class MessageBulkTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='poster', password='pass', role='USER')
+        self.chats = [Chat.objects.create(name=f"bulk {n}", type=ChatType.GROUP) for n in range(2)]
+        for chat in self.chats:
+            chat.add_participant(self.user)
+        self.foreign = Chat.objects.create(name='foreign', type=ChatType.GROUP)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        patcher = mock.patch.object(MessageViewSet, 'broadcast_message')
+        self.broadcast = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, items):
+        return self.client.post('/api/messages/bulk/', {'messages': items}, format='json')
+
+    def test_all_created(self):
+        response = self.post([{'chat': chat.id, 'content': f"to {chat.name}"} for chat in self.chats])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['failed'], 0)
+        self.assertEqual([m.content for m in Message.objects.order_by('id')], ['to bulk 0', 'to bulk 1'])
+        self.assertEqual(self.broadcast.call_count, 2)
+
+    def test_mixed_results(self):
+        response = self.post([
+            {'chat': self.chats[0].id, 'content': 'kept'},
+            {'chat': self.foreign.id, 'content': 'not a member'},
+            {'chat': self.chats[1].id},
+            {'chat': 999999, 'content': 'no such chat'},
+        ])
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual((response.data['created'], response.data['failed']), (1, 3))
+        self.assertEqual([result['status'] for result in response.data['results']], [201, 400, 400, 400])
+        self.assertEqual([result['index'] for result in response.data['results']], [0, 1, 2, 3])
+        self.assertIn('chat', response.data['results'][1]['errors'])
+        self.assertIn('content', response.data['results'][2]['errors'])
+        self.assertEqual(response.data['results'][0]['message']['content'], 'kept')
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['kept'])
+        self.broadcast.assert_called_once()
+
+    @override_settings(MESSAGE_BULK_MAX_ITEMS=2)
+    def test_limits(self):
+        response = self.post([{'chat': self.chats[0].id, 'content': str(n)} for n in range(3)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.post([]).status_code, 400)
+        self.assertEqual(self.client.post('/api/messages/bulk/', {'messages': 'hi'}, format='json').status_code, 400)
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(self.post([{'chat': self.chats[0].id, 'content': str(n)} for n in range(2)]).status_code, 201)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        chat_cache.clear()
+        self.user = User.objects.create_user(username='async', password='pass', role='USER')
+        self.chat = Chat.objects.create(name='async', type=ChatType.GROUP)
+        self.chat.add_participant(self.user)
+        for n in range(3):
+            Message.objects.create(chat=self.chat, sender=self.user, content=f"message {n}")
+        self.headers = {'Authorization': f"Bearer {AccessToken.for_user(self.user)}"}
+        self.client = APIClient(headers=self.headers)
+
+    async def test_same_payload_as_drf(self):
+        for sync_url, async_url in [
+            ('/api/users/me/', '/api/async/users/me/'),
+            (f'/api/chats/{self.chat.id}/', f'/api/async/chats/{self.chat.id}/'),
+            (f'/api/messages/?chat={self.chat.id}', f'/api/async/messages/?chat={self.chat.id}'),
+        ]:
+            expected = (await sync_to_async(self.client.get)(sync_url)).json()
+            response = await self.async_client.get(async_url, headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), expected)
+
+    async def test_requires_token(self):
+        response = await self.async_client.get('/api/async/users/me/')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_create_with_claims_token(self):
+        # Claims tokens give a request.user with the profile fields deferred
+        token = await sync_to_async(ChatRefreshToken.for_user)(self.user)
+        headers = {'Authorization': f"Bearer {token.access_token}"}
+        with mock.patch('chat.async_views.abroadcast_message') as broadcast:
+            response = await self.async_client.post(
+                '/api/async/messages/', {'chat': self.chat.id, 'content': 'from async'},
+                content_type='application/json', headers=headers
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['content'], 'from async')
+        self.assertEqual(response.json()['sender']['username'], 'async')
+        self.assertIn('email', response.json()['sender'])
+        broadcast.assert_awaited_once()
+
+    def test_sync_create_loads_sender_once(self):
+        client = APIClient(headers={'Authorization': f"Bearer {ChatRefreshToken.for_user(self.user).access_token}"})
+        with mock.patch.object(MessageViewSet, 'broadcast_message'), CaptureQueriesContext(connection) as context:
+            response = client.post('/api/messages/', {'chat': self.chat.id, 'content': 'from drf'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['sender']['username'], 'async')
+        # No lazy load of the deferred profile fields while serializing the sender
+        lazy = [q['sql'] for q in context.captured_queries if q['sql'].startswith('SELECT "chat_user"."id", "chat_user"."email"')]
+        self.assertEqual(lazy, [])
+
+
+@override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE={'BACKEND': 'chat.presence.InMemoryPresenceStore', 'TYPING_INTERVAL': 60},
+)
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        get_presence_store.cache_clear()
+        read_receipts.pending.clear()
+        read_receipts.flushed.clear()
+        self.alice = User.objects.create_user(username='alice', password='pass', role='USER')
+        self.bob = User.objects.create_user(username='bob', password='pass', role='USER')
+        self.chat = Chat.objects.create(name='sockets', type=ChatType.GROUP)
+        self.chat.add_participant(self.alice)
+        self.chat.add_participant(self.bob)
+        self.messages = [
+            Message.objects.create(chat=self.chat, sender=self.alice, content=f"message {n}") for n in range(3)
+        ]
+        self.other = Message.objects.create(
+            chat=Chat.objects.create(name='other', type=ChatType.GROUP), sender=self.alice, content='elsewhere'
+        )
+        patcher = mock.patch.object(read_receipts, 'ensure_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(get_presence_store.cache_clear)
+
+    def communicator(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chats/{self.chat.id}/')
+        communicator.scope['user'] = user
+        return communicator
+
+    async def connect(self, user, online):
+        """Open a socket, check the presence state it gets and skip its own online event"""
+        communicator = self.communicator(user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'presence.state', 'online': sorted(online)})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'presence', 'user_id': user.id, 'online': True})
+        return communicator
+
+    async def test_presence(self):
+        alice = await self.connect(self.alice, [self.alice.id])
+        bob = await self.connect(self.bob, [self.alice.id, self.bob.id])
+        self.assertEqual(await alice.receive_json_from(), {'type': 'presence', 'user_id': self.bob.id, 'online': True})
+        await bob.disconnect()
+        self.assertEqual(await alice.receive_json_from(), {'type': 'presence', 'user_id': self.bob.id, 'online': False})
+        await alice.send_json_to({'type': 'presence'})
+        self.assertEqual(await alice.receive_json_from(), {'type': 'presence.state', 'online': [self.alice.id]})
+        await alice.disconnect()
+
+    async def test_non_member_is_refused(self):
+        outsider = await sync_to_async(User.objects.create_user)(username='outsider', password='pass', role='USER')
+        communicator = self.communicator(outsider)
+        connected, code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4403)
+
+    async def test_typing_is_throttled(self):
+        alice = await self.connect(self.alice, [self.alice.id])
+        bob = await self.connect(self.bob, [self.alice.id, self.bob.id])
+        await alice.receive_json_from()
+        for _ in range(3):
+            await alice.send_json_to({'type': 'typing'})
+        self.assertEqual(await bob.receive_json_from(), {'type': 'typing', 'user_id': self.alice.id})
+        self.assertTrue(await bob.receive_nothing())
+        # The sender does not hear its own typing
+        self.assertTrue(await alice.receive_nothing())
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_read_receipts(self):
+        alice = await self.connect(self.alice, [self.alice.id])
+        first, _, last = [message.id for message in self.messages]
+        await alice.send_json_to({'type': 'read', 'message_id': last})
+        self.assertEqual(await alice.receive_json_from(), {'type': 'read', 'user_id': self.alice.id, 'message_id': last})
+
+        self.assertEqual(await sync_to_async(read_receipts.flush)(), 1)
+        self.assertEqual(
+            await ChatUser.objects.filter(chat=self.chat, user=self.alice).values_list('last_read_message_id', flat=True).aget(),
+            last
+        )
+        # An older position after the flush, a message of another chat, a malformed id: all dropped
+        for message_id in (first, self.other.id + 1000, self.other.id, 'last'):
+            await alice.send_json_to({'type': 'read', 'message_id': message_id})
+        self.assertTrue(await alice.receive_nothing())
+        self.assertEqual(read_receipts.pending, {})
+        await alice.disconnect()
+
+    def test_flushed_positions_are_bounded(self):
+        buffer = ReadReceiptBuffer(max_flushed=2)
+        first, _, last = [message.id for message in self.messages]
+        self.other.chat.add_participant(self.alice)
+        buffer.record(self.chat.id, self.alice.id, last)
+        buffer.record(self.chat.id, self.bob.id, last)
+        buffer.flush()
+        buffer.record(self.other.chat_id, self.alice.id, self.other.id)
+        buffer.flush()
+        self.assertEqual(list(buffer.flushed), [(self.chat.id, self.bob.id), (self.other.chat_id, self.alice.id)])
+
+        # The evicted key takes a stale report again, the flush does not move the stored position back
+        self.assertTrue(buffer.record(self.chat.id, self.alice.id, first))
+        buffer.flush()
+        self.assertEqual(
+            ChatUser.objects.filter(chat=self.chat, user=self.alice).values_list('last_read_message_id', flat=True).get(),
+            last
+        )
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ClaimsAuthenticationTests(TestCase):
+    def setUp(self):
+        chat_cache.clear()
+        user_cache.clear()
+        self.user = User.objects.create_user(username='claims', password='pass', role='USER', age=30)
+        self.token = ChatRefreshToken.for_user(self.user).access_token
+
+    def test_user_from_claims(self):
+        with self.assertNumQueries(0):
+            user = get_user_for_token(self.token)
+            self.assertEqual((user.pk, user.role, user.age), (self.user.pk, 'USER', 30))
+
+    def test_update_invalidates_claims(self):
+        self.user.role = 'ADMIN'
+        self.user.save()
+        self.assertEqual(get_user_for_token(self.token).role, 'ADMIN')
+        with self.assertNumQueries(0):
+            get_user_for_token(self.token)
+
+    def test_deleted_user_is_rejected(self):
+        self.user.delete()
+        with self.assertRaises(AuthenticationFailed):
+            get_user_for_token(self.token)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class TokenBlacklistTests(TestCase):
+    def setUp(self):
+        get_token_blacklist.cache_clear()
+        self.user = User.objects.create_user(username='blacklist', password='pass', role='ANONYMOUS')
+
+    def test_blacklisted_token_is_rejected(self):
+        token = ChatRefreshToken.for_user(self.user)
+        token.blacklist()
+        with self.assertRaises(TokenError):
+            ChatRefreshToken(str(token))
+
+    def test_clean_token_needs_no_query(self):
+        ChatRefreshToken.for_user(self.user).blacklist()
+        token = str(ChatRefreshToken.for_user(self.user))
+        with self.assertNumQueries(0):
+            ChatRefreshToken(token)
+
+    def test_compaction_removes_expired(self):
+        token = ChatRefreshToken.for_user(self.user)
+        token.blacklist()
+        ChatRefreshToken.for_user(self.user)
+        OutstandingToken.objects.filter(jti=token['jti']).update(expires_at=timezone.now())
+        self.assertEqual(compact_expired_tokens(batch_size=1), (1, 1))
+        self.assertEqual(OutstandingToken.objects.count(), 1)
+
+
+class AnonymousCleanupTests(TestCase):
+    def create_anonymous(self, name, days_idle):
+        user = User.objects.create_user(username=name, password='pass', role='ANONYMOUS')
+        User.objects.filter(pk=user.pk).update(date_joined=timezone.now() - timedelta(days=days_idle))
+        return user
+
+    def test_stale_sessions_are_removed(self):
+        stale = self.create_anonymous('stale', days_idle=3)
+        active = self.create_anonymous('active', days_idle=0)
+        anonymous_chat = Chat.objects.create(type=ChatType.ANONYMOUS)
+        anonymous_chat.add_participant(stale)
+        group = Chat.objects.create(name='group', type=ChatType.GROUP)
+        group.add_participant(stale)
+        group.add_participant(active)
+        Message.objects.create(chat=group, sender=stale, content='bye')
+        Message.objects.filter(sender=stale).update(created_at=timezone.now() - timedelta(days=2))
+
+        batches = list(collect_stale_anonymous(timezone.now() - timedelta(days=1), batch_size=10))
+        self.assertEqual(batches, [{'users': 1, 'chats': 1, 'messages': 1}])
+        self.assertFalse(User.objects.filter(pk=stale.pk).exists())
+        self.assertFalse(Chat.objects.filter(pk=anonymous_chat.pk).exists())
+        group.refresh_from_db()
+        self.assertEqual(group.participant_count, 1)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class MessagePartitionTests(TestCase):
+    def setUp(self):
+        catalogue_cache.clear()
+        self.user = User.objects.create_user(username='history', password='pass', role='USER')
+        self.chat = Chat.objects.create(name='history', type=ChatType.GROUP)
+        self.chat.add_participant(self.user)
+        self.old_month = add_months(month_start(timezone.now()), -14)
+        for n in range(4):
+            message = Message.objects.create(chat=self.chat, sender=self.user, content=f"old {n}")
+            # Lands in the default partition, no partition covers that month yet
+            Message.objects.filter(pk=message.pk).update(created_at=self.old_month + timedelta(hours=n))
+        for n in range(2):
+            Message.objects.create(chat=self.chat, sender=self.user, content=f"new {n}")
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        self.archive_dir = archive_dir.name
+        self.client = APIClient(headers={'Authorization': f"Bearer {AccessToken.for_user(self.user)}"})
+
+    def test_history_continues_into_archive(self):
+        name = create_partition(self.old_month)
+        self.assertIn(name, list_partitions())
+        self.assertEqual(archive_partition(name, self.archive_dir), 4)
+        self.assertNotIn(name, list_partitions())
+        self.assertEqual(Message.objects.filter(chat=self.chat).count(), 2)
+
+        contents = []
+        url = f'/api/messages/?chat={self.chat.id}&page_size=3'
+        while url:
+            page = self.client.get(url).json()
+            contents = [m['content'] for m in page['results']] + contents
+            url = page['previous']
+        self.assertEqual(contents, ['old 0', 'old 1', 'old 2', 'old 3', 'new 0', 'new 1'])
+
+        self.assertEqual(rehydrate_partition(name), 4)
+        self.assertFalse(ArchivedPartition.objects.exists())
+        self.assertEqual(Message.objects.filter(chat=self.chat, search_vector__isnull=False).count(), 6)
+
+    def history(self, client):
+        contents = []
+        url = f'/api/messages/?chat={self.chat.id}&page_size=3'
+        while url:
+            page = client.get(url).json()
+            contents = [m['content'] for m in page['results']] + contents
+            url = page['previous']
+        return contents
+
+    def test_archive_is_skipped_outside_its_window(self):
+        archive_partition(create_partition(self.old_month), self.archive_dir)
+        newest = self.client.get(f'/api/messages/?chat={self.chat.id}&page_size=3').json()
+        self.assertEqual([m['content'] for m in newest['results']], ['old 3', 'new 0', 'new 1'])
+        short = Chat.objects.create(name='short', type=ChatType.GROUP)
+        short.add_participant(self.user)
+        Message.objects.create(chat=short, sender=self.user, content='only')
+
+        def membership_checks(url):
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            return [query['sql'] for query in context if '"chat_chatuser"' in query['sql']]
+
+        # A forward page newer than every archived month, a chat with nothing archived
+        latest = self.client.get(f'/api/messages/?chat={self.chat.id}&page_size=1').json()
+        self.assertEqual(membership_checks(latest['previous'].replace('before=', 'after=')), [])
+        self.assertEqual(membership_checks(f'/api/messages/?chat={short.id}'), [])
+        # A backward page running past the database still reaches the archive
+        self.assertEqual(len(membership_checks(newest['previous'])), 1)
+
+    def test_rewritten_index_is_reloaded(self):
+        name = create_partition(self.old_month)
+        archive_partition(name, self.archive_dir)
+        path = ArchivedPartition.objects.get(name=name).path
+        self.assertEqual(load_index(path)[str(self.chat.id)][2], 4)
+        # Archiving the month again after a rehydrate puts a new index file in place
+        _, index_path = archive_paths(name, self.archive_dir)
+        tmp_path = index_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps({}))
+        os.replace(tmp_path, index_path)
+        self.assertEqual(load_index(path), {})
+
+    def test_archive_is_for_members_only(self):
+        archive_partition(create_partition(self.old_month), self.archive_dir)
+        outsider = User.objects.create_user(username='outsider', password='pass', role='USER')
+        client = APIClient(headers={'Authorization': f"Bearer {AccessToken.for_user(outsider)}"})
+        self.assertNotIn('old 0', self.history(client))
+
+    def test_export_streams_archive_and_database(self):
+        archive_partition(create_partition(self.old_month), self.archive_dir)
+        admin = User.objects.create_user(username='admin', password='pass', role='ADMIN')
+        client = APIClient(headers={'Authorization': f"Bearer {AccessToken.for_user(admin)}"})
+
+        response = client.get(f'/api/chats/{self.chat.id}/export/?compress=gzip')
+        self.assertEqual(response.status_code, 200)
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(
+            [json.loads(line)['content'] for line in lines],
+            ['old 0', 'old 1', 'old 2', 'old 3', 'new 0', 'new 1']
+        )
+        self.assertEqual(self.client.get(f'/api/chats/{self.chat.id}/export/').status_code, 403)
+
+    def test_export_after_rehydrating_a_middle_month(self):
+        months = [add_months(self.old_month, offset) for offset in (-1, 0, 1)]
+        for month in (months[0], months[2]):
+            message = Message.objects.create(chat=self.chat, sender=self.user, content=f"{month:%Y-%m}")
+            Message.objects.filter(pk=message.pk).update(created_at=month)
+        names = [create_partition(month) for month in months]
+        for name in names:
+            archive_partition(name, self.archive_dir)
+        catalogue_cache.clear()
+        rehydrate_partition(names[1])
+
+        contents = [row['content'] for row in export_rows(self.chat.id)]
+        self.assertEqual(contents, [
+            f"{months[0]:%Y-%m}", 'old 0', 'old 1', 'old 2', 'old 3', f"{months[2]:%Y-%m}", 'new 0', 'new 1'
+        ])
+
+    async def test_export_streams_under_asgi(self):
+        admin = await sync_to_async(User.objects.create_user)(username='admin', password='pass', role='ADMIN')
+        response = await self.async_client.get(
+            f'/api/chats/{self.chat.id}/export/', headers={'Authorization': f"Bearer {AccessToken.for_user(admin)}"}
+        )
+        self.assertEqual(response.status_code, 200)
+        # A sync iterator would be collected into a list before the first byte is sent
+        self.assertTrue(response.is_async)
+        lines = b''.join([chunk async for chunk in response.streaming_content]).decode().splitlines()
+        self.assertEqual(
+            [json.loads(line)['content'] for line in lines], ['old 0', 'old 1', 'old 2', 'old 3', 'new 0', 'new 1']
+        )
+
+
+class ConnectionPoolTests(TestCase):
+    def connect(self):
+        return psycopg2.connect(**connection.get_connection_params())
+
+    def test_reuses_connections_and_times_out(self):
+        pool = ConnectionPool(max_size=1, timeout=0.05)
+        self.addCleanup(pool.close_all)
+        first = pool.getconn(self.connect)
+        with self.assertRaises(psycopg2.OperationalError):
+            pool.getconn(self.connect)
+        pool.putconn(first)
+
+        second = pool.getconn(self.connect)
+        self.assertIs(second, first)
+        # A transaction left open is rolled back, not handed to the next user
+        second.cursor().execute('SELECT 1')
+        pool.putconn(second)
+        self.assertEqual(first.info.transaction_status, psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        self.assertEqual(pool.snapshot()['connects'], 1)
+
+    def test_server_timing_header(self):
+        response = self.client.get('/api/csrf/')
+        self.assertTrue(response['Server-Timing'].startswith('db-connect;dur='))
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        chat_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='metrics', password='pass'))
+
+    def test_metrics_endpoint(self):
+        self.client.get('/api/interests/')
+        body = self.client.get('/metrics/').content.decode()
+        self.assertIn('chat_request_db_queries_count{view="InterestViewSet",action="list",method="GET"}', body)
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+    @override_settings(QUERY_BUDGETS={'InterestViewSet.list': 0}, QUERY_BUDGET_MODE='raise')
+    def test_query_budget(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get('/api/interests/')
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class FastSerializationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='fast', password='pass', role='USER', age=30, email=None)
+        other = User.objects.create_user(username='другой', password='pass', gender='female')
+        self.chat = Chat.objects.create(name='fast \u2028 чат', type=ChatType.GROUP, preferences={'min_age': 18, 'tags': ['a']})
+        self.chat.add_participant(self.user)
+        self.chat.add_participant(other)
+        ChatInterest.objects.create(chat=self.chat, interest=Interest.objects.create(interest='music'))
+        Chat.objects.create(name='empty', type=ChatType.GROUP).add_participant(self.user)
+        for n in range(5):
+            Message.objects.create(chat=self.chat, sender=[self.user, other][n % 2], content=f'"{n}" ✓\n<b>')
+        self.client = APIClient(headers={'Authorization': f"Bearer {AccessToken.for_user(self.user)}"})
+
+    def test_output_matches_serializers(self):
+        for url in ('/api/chats/', f'/api/messages/?chat={self.chat.id}&page_size=2', f'/api/async/messages/?chat={self.chat.id}'):
+            with self.subTest(url=url):
+                fast = self.client.get(url).content
+                with override_settings(FAST_SERIALIZATION=False), mock.patch('chat.renderers.orjson', None):
+                    expected = self.client.get(url).content
+                self.assertEqual(fast, expected)
+
+
+@override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    RESPONSE_COMPRESSION={'MIN_BYTES': 100, 'GZIP_LEVEL': 6, 'BROTLI_QUALITY': 5},
+)
+class ResponseFormatTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='formats', password='pass', role='USER')
+        self.chat = Chat.objects.create(name='formats', type=ChatType.GROUP)
+        self.chat.add_participant(self.user)
+        for n in range(5):
+            Message.objects.create(chat=self.chat, sender=self.user, content=f"message {n}")
+        self.url = f'/api/messages/?chat={self.chat.id}'
+        self.client = APIClient(headers={'Authorization': f"Bearer {AccessToken.for_user(self.user)}"})
+
+    def test_msgpack_columns(self):
+        rows = self.client.get(self.url).json()['results']
+        response = self.client.get(self.url + '&layout=columns', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        page = msgpack.unpackb(response.content)
+        self.assertEqual(page['results']['content'], [m['content'] for m in rows])
+        self.assertEqual(page['users'][str(self.user.id)]['username'], 'formats')
+
+    def test_compression(self):
+        rows = self.client.get(self.url).json()['results']
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='br;q=0, gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content))['results'], rows)
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+        # A malformed q-value drops that entry instead of failing the request
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip;q=.')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_non_finite_floats_are_refused(self):
+        renderer = JSONRenderer()
+        for value in (float('nan'), float('inf'), -float('inf')):
+            with self.assertRaises(ValueError):
+                renderer.render({'results': [{'score': value, 'note': None}]})
+        self.assertEqual(renderer.render({'score': 1.5, 'note': None}), b'{"score":1.5,"note":null}')
+
+    def test_html_is_not_compressed(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='text/html', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class SyncTests(TransactionTestCase):
+    # Only committed transactions reach the sync, TestCase would hold everything in one
+    def setUp(self):
+        self.user = User.objects.create_user(username='syncer', password='pass', role='USER')
+        self.other = User.objects.create_user(username='peer', password='pass', role='USER')
+        self.chat = Chat.objects.create(name='sync', type=ChatType.GROUP)
+        self.chat.add_participant(self.user)
+        self.chat.add_participant(self.other)
+        self.client = APIClient(headers={'Authorization': f"Bearer {AccessToken.for_user(self.user)}"})
+
+    def sync(self, version):
+        # Pages are applied in order, an object changed in two of them comes twice
+        changes = {'chats': set(), 'messages': set(), 'deleted_chats': set(), 'deleted_messages': set()}
+        while True:
+            page = self.client.get('/api/chats/sync/', {'since': version}).json()
+            changes['chats'] |= {chat['id'] for chat in page['chats']}
+            changes['messages'] |= {message['content'] for message in page['messages']}
+            changes['deleted_chats'] |= set(page['deleted']['chats'])
+            changes['deleted_messages'] |= set(page['deleted']['messages'])
+            version = page['version']
+            if not page['has_more']:
+                return changes, version
+
+    @override_settings(SYNC={'MAX_CHANGES': 2, 'TOKEN_MAX_AGE': timedelta(days=7)})
+    def test_changes_since_version(self):
+        bootstrap = self.client.get('/api/chats/sync/').json()
+        self.assertEqual([chat['id'] for chat in bootstrap['chats']], [self.chat.id])
+
+        Message.objects.create(chat=self.chat, sender=self.other, content='hello')
+        Message.objects.create(chat=self.chat, sender=self.other, content='oops').delete()
+        old = Message.objects.create(chat=self.chat, sender=self.other, content='old')
+        Message.objects.filter(pk=old.pk).update(created_at=add_months(month_start(timezone.now()), -20))
+        other_chat = Chat.objects.create(name='left', type=ChatType.GROUP)
+        other_chat.add_participant(self.user)
+        Chat.objects.create(name='not mine', type=ChatType.GROUP).add_participant(self.other)
+
+        changes, version = self.sync(bootstrap['version'])
+        self.assertEqual(changes['messages'], {'old', 'hello'})
+        self.assertEqual(len(changes['deleted_messages']), 1)
+        self.assertEqual(changes['chats'], {other_chat.id})
+
+        # Moving rows into a new partition is no change, leaving a chat is
+        create_partition(add_months(month_start(timezone.now()), -20))
+        self.client.post(f'/api/chats/{other_chat.id}/leave_chat/')
+        changes, version = self.sync(version)
+        self.assertEqual(changes, {'chats': set(), 'messages': set(), 'deleted_chats': {other_chat.id}, 'deleted_messages': set()})
+        self.assertEqual(self.sync(version)[0]['deleted_chats'], set())
+
+        self.assertEqual(self.client.get('/api/chats/sync/', {'since': 'nonsense'}).status_code, 400)
+        with override_settings(SYNC={'MAX_CHANGES': 2, 'TOKEN_MAX_AGE': timedelta(0)}):
+            self.assertEqual(self.client.get('/api/chats/sync/', {'since': version}).status_code, 410)
+
+
+class BenchmarkDatasetTests(TestCase):
+    def setUp(self):
+        get_matchmaker.cache_clear()
+
+    def test_generate_and_drop(self):
+        counts = generate_dataset('t', users=20, group_chats=4, anonymous_chats=3, messages=50, members_per_chat=5)
+        self.assertEqual(counts, {'users': 23, 'group_chats': 4, 'anonymous_chats': 3, 'messages': 50})
+        self.assertEqual(Chat.objects.filter(type=ChatType.GROUP, participant_count=5).count(), 4)
+        matches = [get_matchmaker().match(MatchTicket(user_id=0, age=30, gender=g)) for g in ('male', 'female')]
+        self.assertTrue(any(matches))
+
+        drop_dataset('t')
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Chat.objects.exists())
+        self.assertFalse(Message.objects.exists())
+
+    def test_matchmaking_scenario_reruns(self):
+        for _ in range(2):
+            MatchmakingStorm('t', operations=5, seed=0)
+        self.assertEqual(User.objects.filter(username__startswith='bench_t_').count(), 10)
+        drop_dataset('t')
+        self.assertFalse(User.objects.exists())
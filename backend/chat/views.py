@@ -2,21 +2,49 @@ from django.shortcuts import render
 from rest_framework import viewsets, permissions, status, serializers
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from django.db.models import Q, Count, F
+from django.db import transaction
+from django.conf import settings
+from django.db.models import Q, Count, F, Value, FloatField, IntegerField, BigIntegerField
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, TrigramSimilarity
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from .models import Chat, Message, Interest, ChatUser, ChatInterest, User, ChatType
 from .serializers import (
     ChatSerializer, MessageSerializer, InterestSerializer,
-    ChatUserSerializer, ChatInterestSerializer, UserSerializer
+    ChatUserSerializer, ChatInterestSerializer, UserSerializer, MessageSearchSerializer,
+    MessageBulkItemSerializer
 )
 from rest_framework.permissions import AllowAny
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework.settings import api_settings
 from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from .consumers import broadcast_message
+from .cache import INTEREST_LIST_KEY, cached_response, chat_detail_key
+from .export import export_chat, streaming_chunks
+from .fast_serializers import get_plan
+from .functions import ArrayOverlapCount, HTMLEscape
+from .pagination import MessageCursorPagination, GroupChatPagination
+from .renderers import MessagePackRenderer
+from .matchmaking import MatchTicket, get_matchmaker
+from .sync import changes_since
+from .writer import get_message_writer, writer_settings
+from .authentication import ChatRefreshToken
 import logging
 
 logger = logging.getLogger(__name__)
 
 # Create your views here.
 
+class MessagePackMixin:
+    """Offer MessagePack next to JSON, see renderers.MessagePackRenderer"""
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, MessagePackRenderer]
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        patch_vary_headers(response, ('Accept',))
+        return response
+
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
@@ -34,7 +62,7 @@ class UserViewSet(viewsets.ModelViewSet):
             try:
                 user = serializer.save()
                 # Generate tokens for the new user
-                refresh = RefreshToken.for_user(user)
+                refresh = ChatRefreshToken.for_user(user)
                 return Response({
                     'user': serializer.data,
                     'access': str(refresh.access_token),
@@ -71,7 +99,7 @@ class UserViewSet(viewsets.ModelViewSet):
         if serializer.is_valid():
             try:
                 user = serializer.save()
-                refresh = RefreshToken.for_user(user)
+                refresh = ChatRefreshToken.for_user(user)
                 return Response({
                     'user': serializer.data,
                     'access': str(refresh.access_token),
@@ -84,7 +112,7 @@ class UserViewSet(viewsets.ModelViewSet):
                 )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class ChatViewSet(viewsets.ModelViewSet):
+class ChatViewSet(MessagePackMixin, viewsets.ModelViewSet):
     queryset = Chat.objects.all()
     serializer_class = ChatSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -98,20 +126,52 @@ class ChatViewSet(viewsets.ModelViewSet):
         """Get queryset for chat operations"""
         user = self.request.user
         if user.role == 'ADMIN':
-            return Chat.objects.all()
+            return self.eager_load(Chat.objects.all())
         
         # For retrieve action (viewing a single chat) and group_chats action, return all chats
         if self.action in ['retrieve', 'group_chats']:
-            return Chat.objects.all()
+            return self.eager_load(Chat.objects.all())
             
         # For other actions, return only chats where user is a participant
-        return Chat.objects.filter(participants=user)
+        return self.eager_load(Chat.objects.filter(participants=user))
+
+    def eager_load(self, queryset):
+        """Apply the prefetches declared by the serializer"""
+        return self.get_serializer_class().setup_eager_loading(queryset)
+
+    def retrieve(self, request, *args, **kwargs):
+        # Responses embedding the message history change with every message
+        if request.query_params.get('chat_id'):
+            return super().retrieve(request, *args, **kwargs)
+        # A cache hit needs no query at all, misses (and 404s) go through get_object
+        return cached_response(
+            request, chat_detail_key(kwargs[self.lookup_field]),
+            lambda: self.get_serializer(self.get_object()).data
+        )
+
+    def list(self, request, *args, **kwargs):
+        # An embedded history (?chat_id=) needs the serializer
+        if not settings.FAST_SERIALIZATION or request.query_params.get('chat_id'):
+            return super().list(request, *args, **kwargs)
+        plan = get_plan(self.get_serializer_class())
+        rows = plan.values(self.filter_queryset(self.get_queryset()))
+        return Response(plan.represent(rows))
+
+    def get_serialized_chat(self, chat):
+        """Re-read a chat with its relations prefetched and serialize it"""
+        chat = self.eager_load(Chat.objects.all()).get(pk=chat.pk)
+        return self.get_serializer(chat).data
 
     def get_permissions(self):
         if self.action in ['find_anonymous_chat']:
             return [AllowAny()]
         return super().get_permissions()
 
+    @action(detail=False, methods=['get'])
+    def sync(self, request):
+        """Chats, memberships and messages changed since ?since=<version>, see chat/sync.py"""
+        return Response(changes_since(request.user, since=request.query_params.get('since') or None))
+
     @action(detail=False, methods=['get'])
     def group_chats(self, request):
         """Get all group chats with optional filters"""
@@ -125,18 +185,38 @@ class ChatViewSet(viewsets.ModelViewSet):
         queryset = Chat.objects.filter(type=ChatType.GROUP).exclude(participants=request.user)
 
         if name:
-            queryset = queryset.filter(name__icontains=name)
+            # Both lookups are served by the trigram index on name, icontains would not be
+            queryset = queryset.filter(
+                Q(name__trgm_icontains=name) | Q(name__trigram_similar=name)
+            ).annotate(similarity=TrigramSimilarity('name', name))
+        else:
+            queryset = queryset.annotate(similarity=Value(0.0, output_field=FloatField()))
 
         if min_participants:
-            queryset = queryset.annotate(
-                participant_count=Count('participants')
-            ).filter(participant_count__gte=min_participants)
+            queryset = queryset.filter(participant_count__gte=min_participants)
 
         if interests:
-            queryset = queryset.filter(interests__interest__in=interests).distinct()
+            interest_ids = list(
+                Interest.objects.filter(interest__in=interests).values_list('id', flat=True)
+            )
+            queryset = queryset.filter(interest_ids__overlap=interest_ids).annotate(
+                interest_overlap=ArrayOverlapCount(
+                    'interest_ids', Value(interest_ids, output_field=ArrayField(BigIntegerField()))
+                )
+            )
+        else:
+            queryset = queryset.annotate(interest_overlap=Value(0, output_field=IntegerField()))
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        queryset = queryset.order_by('-similarity', '-interest_overlap', '-participant_count', 'id')
+
+        paginator = GroupChatPagination()
+        page = paginator.paginate_queryset(self.eager_load(queryset), request, view=self)
+        serializer = self.get_serializer(page, many=True)
+        response = paginator.get_paginated_response(serializer.data)
+        # Results depend on the user's memberships, so only the client may cache them
+        patch_cache_control(response, private=True, max_age=settings.GROUP_CHATS_CACHE_SECONDS)
+        patch_vary_headers(response, ['Authorization'])
+        return response
 
     @action(detail=False, methods=['post'])
     def find_anonymous_chat(self, request):
@@ -146,6 +226,15 @@ class ChatViewSet(viewsets.ModelViewSet):
             min_age = request.data.get('min_age')
             max_age = request.data.get('max_age')
             preferred_gender = request.data.get('preferred_gender')
+
+            try:
+                min_age = int(min_age) if min_age not in (None, '') else None
+                max_age = int(max_age) if max_age not in (None, '') else None
+            except (TypeError, ValueError):
+                return Response(
+                    {'error': 'min_age and max_age must be integers'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
             
             # Store preferences for future matching
             preferences = {
@@ -154,69 +243,50 @@ class ChatViewSet(viewsets.ModelViewSet):
                 'preferred_gender': preferred_gender
             }
 
-            # Build query for finding matching chats
-            chat_query = Chat.objects.filter(
-                type=ChatType.ANONYMOUS
-            ).annotate(
-                participant_count=Count('participants')
-            ).filter(
-                participant_count=1
-            )
-
-            # Get the existing participant's age and gender
-            chat_query = chat_query.annotate(
-                existing_user_age=F('participants__age'),
-                existing_user_gender=F('participants__gender')
+            ticket = MatchTicket(
+                user_id=request.user.id,
+                age=request.user.age,
+                gender=request.user.gender,
+                min_age=min_age,
+                max_age=max_age,
+                preferred_gender=preferred_gender
             )
-
-            # Filter by existing participant's age and gender based on current user's preferences
-            if min_age:
-                chat_query = chat_query.filter(existing_user_age__gte=min_age)
-            if max_age:
-                chat_query = chat_query.filter(existing_user_age__lte=max_age)
-            if preferred_gender:
-                chat_query = chat_query.filter(existing_user_gender=preferred_gender)
-
-            # Filter by preferences stored in the chat
-            if request.user.age:
-                chat_query = chat_query.filter(
-                    Q(preferences__isnull=True) |  # Include chats without preferences
-                    Q(preferences__min_age__isnull=True) |  # Include chats without min_age preference
-                    Q(preferences__min_age__lte=request.user.age)  # Check min_age preference
-                ).filter(
-                    Q(preferences__isnull=True) |
-                    Q(preferences__max_age__isnull=True) |
-                    Q(preferences__max_age__gte=request.user.age)
-                )
-            
-            if request.user.gender:
-                chat_query = chat_query.filter(
-                    Q(preferences__isnull=True) |
-                    Q(preferences__preferred_gender__isnull=True) |
-                    Q(preferences__preferred_gender=request.user.gender)
-                )
-
-            # Exclude chats where the current user is already a participant
-            chat_query = chat_query.exclude(participants=request.user)
-
-            # Get the first matching chat
-            existing_chat = chat_query.first()
-
-            if existing_chat:
-                # Add user to the chat
-                ChatUser.objects.create(user=request.user, chat=existing_chat)
-                serializer = self.get_serializer(existing_chat)
-                return Response(serializer.data)
-
-            # If no matching chat found, create a new one
+            matchmaker = get_matchmaker()
+
+            # Claimed tickets leave the queue, so a stale one (the chat was
+            # deleted or filled up meanwhile) is simply skipped
+            while True:
+                claimed = matchmaker.match(ticket)
+                if claimed is None:
+                    break
+                try:
+                    with transaction.atomic():
+                        # Claims the chat only if it is still waiting, the row stays locked until commit
+                        waiting = Chat.objects.filter(
+                            pk=claimed.chat_id, type=ChatType.ANONYMOUS, participant_count=1, matched_at__isnull=True
+                        ).update(matched_at=timezone.now())
+                        if waiting:
+                            existing_chat = Chat(pk=claimed.chat_id, type=ChatType.ANONYMOUS)
+                            existing_chat.add_participant(request.user)
+                except Exception:
+                    # Nothing was committed, the chat is still waiting for someone else
+                    matchmaker.enqueue(claimed)
+                    raise
+                if waiting:
+                    logger.info(f"Matched user {request.user.username} into anonymous chat {claimed.chat_id}")
+                    return Response(self.get_serialized_chat(existing_chat))
+                logger.info(f"Skipped stale matchmaking ticket for chat {claimed.chat_id}")
+
+            # If no matching chat found, create a new one and wait for a partner
             chat = Chat.objects.create(
                 type=ChatType.ANONYMOUS,
                 preferences=preferences
             )
-            ChatUser.objects.create(user=request.user, chat=chat)
+            chat.add_participant(request.user)
+            ticket.chat_id = chat.id
+            matchmaker.enqueue(ticket)
             
-            serializer = self.get_serializer(chat)
-            return Response(serializer.data)
+            return Response(self.get_serialized_chat(chat))
 
         except Exception as e:
             logger.error(f"Error in find_anonymous_chat: {str(e)}")
@@ -225,6 +295,30 @@ class ChatViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """Stream the whole message history of a chat as NDJSON, ?compress=gzip for a .jsonl.gz"""
+        if request.user.role != 'ADMIN':
+            return Response(
+                {'error': 'Only admins can export chats'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        if not Chat.objects.filter(pk=pk).exists():
+            return Response(
+                {'error': 'Chat not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        compress = request.query_params.get('compress') == 'gzip'
+        logger.info(f"User {request.user.username} exporting chat {pk}")
+        response = StreamingHttpResponse(
+            streaming_chunks(request, export_chat(pk, compress=compress)),
+            content_type='application/gzip' if compress else 'application/x-ndjson'
+        )
+        filename = f"chat-{pk}.jsonl.gz" if compress else f"chat-{pk}.jsonl"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
     @action(detail=True, methods=['post'])
     def join_chat(self, request, pk=None):
         """Join a group chat"""
@@ -253,10 +347,9 @@ class ChatViewSet(viewsets.ModelViewSet):
             )
 
         try:
-            ChatUser.objects.create(user=request.user, chat=chat)
+            chat.add_participant(request.user)
             logger.info(f"User {request.user.username} successfully joined chat {chat.id}")
-            serializer = self.get_serializer(chat)
-            return Response(serializer.data)
+            return Response(self.get_serialized_chat(chat))
         except Exception as e:
             logger.error(f"Error joining chat: {str(e)}")
             return Response(
@@ -289,7 +382,7 @@ class ChatViewSet(viewsets.ModelViewSet):
 
         # Delete the ChatUser record
         try:
-            chat_user.delete()
+            chat.remove_participant(chat_user)
             logger.info(f"Successfully removed user {request.user.username} from chat {chat.id}")
         except Exception as e:
             logger.error(f"Error removing user from chat: {str(e)}")
@@ -298,8 +391,12 @@ class ChatViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+        # Анонимный чат больше не ждёт собеседника
+        if chat.type == ChatType.ANONYMOUS:
+            get_matchmaker().remove(chat.id)
+
         # Проверяем, остались ли участники в чате
-        remaining_participants = ChatUser.objects.filter(chat=chat).count()
+        remaining_participants = chat.participant_count
         logger.info(f"Remaining participants in chat {chat.id}: {remaining_participants}")
 
         # Если это анонимный чат и в нем не осталось участников, удаляем его
@@ -326,14 +423,18 @@ class ChatViewSet(viewsets.ModelViewSet):
                 username = request.user.username
 
                 # Удаляем все связанные записи пользователя
-                ChatUser.objects.filter(user=request.user).delete()
+                with transaction.atomic():
+                    Chat.objects.filter(chatuser__user=request.user).update(
+                        participant_count=F('participant_count') - 1
+                    )
+                    ChatUser.objects.filter(user=request.user).delete()
                 Message.objects.filter(sender=request.user).delete()
 
                 # Blacklist the current refresh token
                 try:
                     refresh_token = request.data.get('refresh_token')
                     if refresh_token:
-                        token = RefreshToken(refresh_token)
+                        token = ChatRefreshToken(refresh_token)
                         token.blacklist()
                         logger.info(f"Blacklisted token for anonymous user {username}")
                 except Exception as e:
@@ -368,7 +469,7 @@ class ChatViewSet(viewsets.ModelViewSet):
         chat = serializer.save()
 
         # Add the creator as a participant
-        ChatUser.objects.create(user=request.user, chat=chat)
+        chat.add_participant(request.user)
 
         # Add interests if provided
         interests = request.data.get('interest_names', [])
@@ -379,25 +480,155 @@ class ChatViewSet(viewsets.ModelViewSet):
 
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-class MessageViewSet(viewsets.ModelViewSet):
+class MessageViewSet(MessagePackMixin, viewsets.ModelViewSet):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageCursorPagination
 
     def get_queryset(self):
         queryset = Message.objects.all()
         chat_id = self.request.query_params.get('chat')
         if chat_id:
             queryset = queryset.filter(chat_id=chat_id)
-        return queryset
+        return self.get_serializer_class().setup_eager_loading(queryset)
+
+    def paginate_queryset(self, queryset):
+        # История чата продолжается в архиве старых месяцев
+        # Пагинатор пускает в архив только участников чата
+        chat_id = self.request.query_params.get('chat')
+        if chat_id and chat_id.isdigit():
+            self.paginator.archive_chat_id = int(chat_id)
+            self.paginator.archive_user = self.request.user
+        return super().paginate_queryset(queryset)
+
+    def list(self, request, *args, **kwargs):
+        if not settings.FAST_SERIALIZATION:
+            return super().list(request, *args, **kwargs)
+        plan = get_plan(self.get_serializer_class())
+        page = self.paginate_queryset(plan.values(self.filter_queryset(self.get_queryset())))
+        data = plan.represent(page, fallback=lambda message: self.get_serializer(message).data)
+        return self.get_paginated_response(data)
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """Full-text search over messages of the chats the user is a member of.
+
+        ``headline`` is HTML: the message text escaped, matches wrapped in <mark>.
+        """
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return Response(
+                {'error': 'Query parameter q is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 20)), 100))
+        except ValueError:
+            limit = 20
+
+        query = SearchQuery(text, config='simple', search_type='websearch')
+        queryset = Message.objects.filter(
+            chat_id__in=ChatUser.objects.filter(user=request.user).values('chat_id'),
+            search_vector=query
+        )
+        chat_id = request.query_params.get('chat')
+        if chat_id:
+            queryset = queryset.filter(chat_id=chat_id)
+
+        queryset = queryset.annotate(
+            rank=SearchRank(F('search_vector'), query),
+            headline=SearchHeadline(
+                HTMLEscape('content'), query, config='simple',
+                start_sel='<mark>', stop_sel='</mark>', max_fragments=2
+            )
+        ).order_by('-rank', '-created_at')
+        queryset = MessageSearchSerializer.setup_eager_loading(queryset)[:limit]
+
+        serializer = MessageSearchSerializer(queryset, many=True)
+        return Response(serializer.data)
+
+    def create(self, request, *args, **kwargs):
+        if not writer_settings()['ENABLED']:
+            return super().create(request, *args, **kwargs)
+
+        # Queued mode: validate, journal and acknowledge, the INSERT happens in a batch later
+        serializer = MessageBulkItemSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        chat_id = serializer.validated_data['chat']
+        if not ChatUser.objects.filter(user=request.user, chat_id=chat_id).exists():
+            raise serializers.ValidationError({'chat': 'Chat not found or you are not a participant'})
+        entry = get_message_writer().submit(chat_id, request.user.id, serializer.validated_data['content'])
+        return Response({**entry.to_dict(), 'status': 'queued'}, status=status.HTTP_202_ACCEPTED)
 
     def perform_create(self, serializer):
         chat_id = self.request.data.get('chat')
-        try:
-            chat = Chat.objects.get(id=chat_id, participants=self.request.user)
-            serializer.save(sender=self.request.user, chat=chat)
-        except Chat.DoesNotExist:
+        # The chat and the whole sender row in one query, request.user only has the token claims loaded
+        membership = ChatUser.objects.select_related('chat', 'user').filter(
+            chat_id=chat_id, user=self.request.user
+        ).first()
+        if membership is None:
             raise serializers.ValidationError({'chat': 'Chat not found or you are not a participant'})
+        serializer.save(sender=membership.user, chat=membership.chat)
+        self.broadcast_message(membership.chat_id, serializer.data)
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Create up to MESSAGE_BULK_MAX_ITEMS messages across several chats at once"""
+        items = request.data.get('messages')
+        if not isinstance(items, list) or not items:
+            return Response(
+                {'error': 'messages must be a non-empty list'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(items) > settings.MESSAGE_BULK_MAX_ITEMS:
+            return Response(
+                {'error': f'At most {settings.MESSAGE_BULK_MAX_ITEMS} messages per request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            item_serializer = MessageBulkItemSerializer(data=item)
+            if item_serializer.is_valid():
+                valid.append((index, item_serializer.validated_data))
+            else:
+                results[index] = {'index': index, 'status': status.HTTP_400_BAD_REQUEST, 'errors': item_serializer.errors}
+
+        # One membership lookup for all chats in the batch
+        chat_ids = {data['chat'] for _, data in valid}
+        member_of = set(
+            ChatUser.objects.filter(user=request.user, chat_id__in=chat_ids).values_list('chat_id', flat=True)
+        )
+
+        to_create = []
+        for index, data in valid:
+            if data['chat'] not in member_of:
+                results[index] = {
+                    'index': index,
+                    'status': status.HTTP_400_BAD_REQUEST,
+                    'errors': {'chat': 'Chat not found or you are not a participant'}
+                }
+                continue
+            to_create.append((index, Message(chat_id=data['chat'], sender=request.user, content=data['content'])))
+
+        with transaction.atomic():
+            created = Message.objects.bulk_create([message for _, message in to_create])
+
+        for (index, _), message in zip(to_create, created):
+            data = MessageSerializer(message).data
+            results[index] = {'index': index, 'status': status.HTTP_201_CREATED, 'message': data}
+            self.broadcast_message(message.chat_id, data)
+
+        return Response({
+            'created': len(created),
+            'failed': len(items) - len(created),
+            'results': results,
+        }, status=status.HTTP_201_CREATED if len(created) == len(items) else status.HTTP_207_MULTI_STATUS)
+
+    def broadcast_message(self, chat_id, data):
+        broadcast_message(chat_id, data)
 
 class InterestViewSet(viewsets.ModelViewSet):
     queryset = Interest.objects.all()
@@ -406,3 +637,9 @@ class InterestViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         return Interest.objects.all()
+
+    def list(self, request, *args, **kwargs):
+        return cached_response(
+            request, INTEREST_LIST_KEY,
+            lambda: self.get_serializer(self.get_queryset(), many=True).data
+        )
@@ -0,0 +1,320 @@
+"""
+Queued write path for chat messages.
+
+With ``settings.MESSAGE_WRITER['ENABLED']`` a posted message is validated,
+appended to an on-disk journal and acknowledged with a provisional id. A
+background thread inserts the queue with ``bulk_create`` once it holds
+``BATCH_SIZE`` messages or ``FLUSH_INTERVAL`` seconds after the first one
+arrived, then broadcasts the stored messages, provisional id included, to
+the chat socket. A burst of posts costs one connection and a few INSERTs
+instead of one connection and one INSERT per request.
+
+Ordering: a process has a single writer draining one FIFO queue, so the
+messages it accepted for a chat get increasing ids in the order they were
+acknowledged.
+
+Crash safety: every process writes its own journal and holds a lock on its
+segments. On start the writer replays segments no live process holds. Messages keep
+the acceptance time of the journal as created_at and (provisional_id,
+created_at) is unique in the database, so messages that were inserted just
+before a crash are skipped on replay instead of duplicated.
+"""
+import atexit
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PendingMessage:
+    """A message acknowledged to the client but not inserted yet"""
+    fields = ('provisional_id', 'chat', 'sender', 'content', 'created_at')
+
+    def __init__(self, chat, sender, content, provisional_id=None, created_at=None):
+        self.chat = chat
+        self.sender = sender
+        self.content = content
+        self.provisional_id = provisional_id or str(uuid.uuid4())
+        self.created_at = created_at or timezone.now().isoformat()
+        # Journal segment holding the entry, None for replayed ones
+        self.segment = None
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class MessageJournal:
+    """Append-only log of accepted messages, one JSON object per line.
+
+    The log is a series of segment files, the writer starts a new one each
+    time it takes a batch. A segment is deleted once all of its messages are
+    in the database, so the journal holds what is still queued even when the
+    queue never runs empty.
+    """
+
+    def __init__(self, directory, fsync=True):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self.name = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.sequence = 0
+        # Open segments by sequence number, and how many of their messages are not written yet
+        self.segments = {}
+        self.pending = {}
+        self.open_segment()
+
+    @property
+    def path(self):
+        return self.segments[self.sequence][0]
+
+    @property
+    def file(self):
+        return self.segments[self.sequence][1]
+
+    def open_segment(self):
+        self.sequence += 1
+        path = self.directory / f"{self.name}-{self.sequence:08d}.log"
+        file = open(path, 'a', encoding='utf8')
+        # Marks the segment as owned by a live process
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.segments[self.sequence] = (path, file)
+        self.pending[self.sequence] = 0
+
+    def append(self, entry):
+        """Write an entry to the current segment, returns the segment's sequence number"""
+        self.file.write(json.dumps(entry.to_dict()) + '\n')
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.pending[self.sequence] += 1
+        return self.sequence
+
+    def rotate(self):
+        """Send the next entries to a new segment, unless the current one is still empty"""
+        if self.file.tell():
+            self.open_segment()
+
+    def acknowledge(self, sequences):
+        """Count one written message per sequence number, drop the segments with none left"""
+        for sequence in sequences:
+            self.pending[sequence] -= 1
+        for sequence in [s for s, count in self.pending.items() if not count and s != self.sequence]:
+            path, file = self.segments.pop(sequence)
+            del self.pending[sequence]
+            # Unlink before the lock goes with the file, no other process replays it
+            path.unlink()
+            file.close()
+        if not self.pending[self.sequence] and self.file.tell():
+            self.file.truncate(0)
+            self.file.flush()
+
+    def orphans(self):
+        """Journals left behind by processes that are gone, locked for the caller"""
+        for path in sorted(self.directory.glob('*.log')):
+            if path.name.startswith(self.name):
+                continue
+            handle = open(path, 'r', encoding='utf8')
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                continue
+            yield path, handle
+
+    @staticmethod
+    def read(handle):
+        entries = []
+        for line in handle:
+            try:
+                entries.append(PendingMessage.from_dict(json.loads(line)))
+            except (ValueError, TypeError):
+                # A line cut short by the crash, it was never acknowledged
+                logger.warning(f"Skipping unreadable journal line in {handle.name}")
+        return entries
+
+
+class MessageWriter:
+    """Single background thread inserting queued messages in batches"""
+
+    def __init__(self, batch_size=200, flush_interval=0.05, journal_dir=None, fsync=True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal = MessageJournal(journal_dir, fsync=fsync)
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.in_flight = 0
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        self.replay()
+        self.thread = threading.Thread(target=self.run, name='message-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=10):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def submit(self, chat_id, sender_id, content):
+        """Journal and queue a message, returns it with its provisional id"""
+        entry = PendingMessage(chat=chat_id, sender=sender_id, content=content)
+        with self.condition:
+            entry.segment = self.journal.append(entry)
+            self.queue.append(entry)
+            self.condition.notify()
+        return entry
+
+    def take_batch(self):
+        """Wait for a full batch or the flush interval, whichever comes first"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.queue or self.stopping)
+            deadline = time.monotonic() + self.flush_interval
+            self.condition.wait_for(
+                lambda: len(self.queue) >= self.batch_size or self.stopping,
+                timeout=max(deadline - time.monotonic(), 0)
+            )
+            count = min(len(self.queue), self.batch_size)
+            batch = [self.queue.popleft() for _ in range(count)]
+            self.in_flight = count
+            if batch:
+                self.journal.rotate()
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            if not batch:
+                if self.stopping:
+                    connection.close()
+                    break
+                continue
+            self.write_until_done(batch)
+            self.acknowledge(batch)
+
+    def acknowledge(self, batch):
+        """Release the journal entries of a batch that is in the database"""
+        with self.condition:
+            self.in_flight = 0
+            self.journal.acknowledge(entry.segment for entry in batch)
+
+    def write_until_done(self, batch):
+        delay = 0.1
+        while True:
+            try:
+                self.write(batch)
+                return
+            except Exception as e:
+                # Keep the batch, order matters more than latency
+                logger.error(f"Failed to write {len(batch)} queued messages: {str(e)}")
+                connection.close()
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    def flush(self):
+        """Write everything queued on the calling thread"""
+        while True:
+            with self.condition:
+                batch = list(self.queue)[:self.batch_size]
+                for _ in batch:
+                    self.queue.popleft()
+                if batch:
+                    self.journal.rotate()
+            if not batch:
+                break
+            self.write(batch)
+            with self.condition:
+                self.journal.acknowledge(entry.segment for entry in batch)
+
+    def write(self, batch, broadcast=True):
+        from .consumers import broadcast_message
+        from .models import Chat, Message, User
+        from .serializers import MessageSerializer
+
+        # Chats or users deleted since the message was accepted would fail the whole INSERT
+        chat_ids = set(Chat.objects.filter(id__in={e.chat for e in batch}).values_list('id', flat=True))
+        user_ids = set(User.objects.filter(id__in={e.sender for e in batch}).values_list('id', flat=True))
+        rows = []
+        for entry in batch:
+            if entry.chat not in chat_ids or entry.sender not in user_ids:
+                logger.warning(f"Dropping queued message {entry.provisional_id}, chat or sender is gone")
+                continue
+            rows.append(Message(
+                provisional_id=entry.provisional_id,
+                chat_id=entry.chat,
+                sender_id=entry.sender,
+                content=entry.content,
+                created_at=datetime.fromisoformat(entry.created_at),
+            ))
+
+        with transaction.atomic():
+            # Replayed messages that made it in before a crash are skipped
+            Message.objects.bulk_create(rows, batch_size=self.batch_size, ignore_conflicts=True)
+
+        if not broadcast or not rows:
+            return
+        queryset = MessageSerializer.setup_eager_loading(
+            Message.objects.filter(provisional_id__in=[row.provisional_id for row in rows])
+        ).order_by('id')
+        for message in queryset:
+            data = MessageSerializer(message).data
+            data['provisional_id'] = str(message.provisional_id)
+            broadcast_message(message.chat_id, data)
+
+    def replay(self):
+        """Insert the messages of journals whose process died before writing them"""
+        for path, handle in self.journal.orphans():
+            with handle:
+                entries = self.journal.read(handle)
+                for start in range(0, len(entries), self.batch_size):
+                    self.write(entries[start:start + self.batch_size], broadcast=False)
+            # Gone already if its process deleted it just before we got the lock
+            path.unlink(missing_ok=True)
+            if entries:
+                logger.info(f"Replayed {len(entries)} queued messages from {path.name}")
+
+
+def writer_settings():
+    config = {
+        'ENABLED': False,
+        'BATCH_SIZE': 200,
+        'FLUSH_INTERVAL': 0.05,
+        'JOURNAL_DIR': str(Path(settings.BASE_DIR) / 'var' / 'message_journal'),
+        'FSYNC': True,
+    }
+    config.update(getattr(settings, 'MESSAGE_WRITER', {}))
+    return config
+
+
+@lru_cache(maxsize=None)
+def get_message_writer():
+    """The process-wide writer, started on first use"""
+    config = writer_settings()
+    writer = MessageWriter(
+        batch_size=config['BATCH_SIZE'],
+        flush_interval=config['FLUSH_INTERVAL'],
+        journal_dir=config['JOURNAL_DIR'],
+        fsync=config['FSYNC'],
+    )
+    writer.start()
+    return writer
@@ -58,6 +58,18 @@ const AnonymousChat: React.FC = () => {
     loadInterests();
   }, []);
 
+  useEffect(() => {
+    if (!chat) return;
+    const socket = chatService.subscribeToMessages(chat.id, appendMessage, (userId, online) => {
+      // Собеседник вышел из анонимного чата, сокет закрывается вместе с чатом
+      if (!online && userId !== currentUser.id) {
+        setChat(null);
+        setError('Собеседник покинул чат');
+      }
+    });
+    return () => socket.close();
+  }, [chat?.id]);
+
   const loadInterests = async () => {
     try {
       const data = await interestService.getInterests();
@@ -154,6 +166,11 @@ const AnonymousChat: React.FC = () => {
     }
   };
 
+  // Своё сообщение приходит и в ответе POST, и через сокет
+  const appendMessage = (message: Message) => {
+    setMessages(prev => prev.some(m => m.id === message.id) ? prev : [...prev, message]);
+  };
+
   const loadMessages = async (chatId: number) => {
     try {
       const data = await chatService.getChatMessages(chatId);
@@ -169,7 +186,7 @@ const AnonymousChat: React.FC = () => {
 
     try {
       const message = await chatService.sendMessage(chat.id, newMessage);
-      setMessages(prev => [...prev, message]);
+      if (message) appendMessage(message);
       setNewMessage('');
     } catch (error) {
       setError('Failed to send message');
@@ -38,6 +38,17 @@ const Chat: React.FC = () => {
     }
   }, [id]);
 
+  useEffect(() => {
+    if (!id || !isParticipant) return;
+    const socket = chatService.subscribeToMessages(parseInt(id), appendMessage);
+    return () => socket.close();
+  }, [id, isParticipant]);
+
+  // Своё сообщение приходит и в ответе POST, и через сокет
+  const appendMessage = (message: Message) => {
+    setMessages(prev => prev.some(m => m.id === message.id) ? prev : [...prev, message]);
+  };
+
   const loadChat = async () => {
     try {
       const data = await chatService.getChat(parseInt(id!));
@@ -93,7 +104,7 @@ const Chat: React.FC = () => {
 
     try {
       const message = await chatService.sendMessage(parseInt(id!), newMessage);
-      setMessages(prev => [...prev, message]);
+      if (message) appendMessage(message);
       setNewMessage('');
     } catch (error) {
       setError('Failed to send message');
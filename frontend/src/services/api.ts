@@ -19,6 +19,7 @@ export interface AnonymousUserData {
 }
 
 const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
+const WS_URL = API_URL.replace(/^http/, 'ws');
 
 const api = axios.create({
   baseURL: API_URL,
@@ -110,8 +111,9 @@ export const authService = {
 
 export const chatService = {
   getGroupChats: async (filters?: GroupChatFilters): Promise<Chat[]> => {
+    // Первая страница результатов, отсортированных по релевантности
     const response = await api.get('/api/chats/group_chats/', { params: filters });
-    return response.data;
+    return response.data.results;
   },
 
   getUserChats: async (): Promise<Chat[]> => {
@@ -148,13 +150,41 @@ export const chatService = {
   },
 
   getChatMessages: async (chatId: number): Promise<Message[]> => {
+    // Последняя страница истории, более старые сообщения доступны по ссылке previous
     const response = await api.get(`/api/messages/`, { params: { chat: chatId } });
-    return response.data;
+    return response.data.results;
   },
 
-  sendMessage: async (chatId: number, content: string): Promise<Message> => {
+  // 202 — сообщение поставлено в очередь, сохранённое придёт через WebSocket
+  sendMessage: async (chatId: number, content: string): Promise<Message | null> => {
     const response = await api.post('/api/messages/', { chat: chatId, content });
-    return response.data;
+    return response.status === 202 ? null : response.data;
+  },
+
+  // Новые сообщения приходят через WebSocket, без повторных запросов к API
+  subscribeToMessages: (
+    chatId: number,
+    onMessage: (message: Message) => void,
+    onPresence?: (userId: number, online: boolean) => void
+  ): WebSocket => {
+    const token = localStorage.getItem('token');
+    const socket = new WebSocket(`${WS_URL}/ws/chats/${chatId}/?token=${token}`);
+    socket.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+      if (data.type === 'message') {
+        onMessage(data.message);
+      } else if (data.type === 'presence' && onPresence) {
+        onPresence(data.user_id, data.online);
+      }
+    };
+    // Присутствие в чате истекает без heartbeat (TTL на сервере 30 секунд)
+    const heartbeat = setInterval(() => {
+      if (socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({ type: 'heartbeat' }));
+      }
+    }, 15000);
+    socket.addEventListener('close', () => clearInterval(heartbeat));
+    return socket;
   },
 };
 